@@ -0,0 +1,446 @@
+
+### Crackle Viewer - benchmark suite for the viewer's hot paths
+#
+# Generates a synthetic surface volume, UV mesh and overlays and times the
+# viewer code paths on them. Results are written as JSON so that runs on
+# different commits can be compared.
+#
+#   python benchmark.py --layers 32 --width 2048 --height 2048 --output bench.json
+
+import argparse
+import functools
+import http.server
+import importlib.util
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+import view_gui
+from view_gui import RenderEngine, ViewState
+
+def synthetic_slice(rng, width, height, dtype):
+    """Smooth noise that looks enough like papyrus for projections and flood fill to do real work."""
+    small = rng.random((max(1, height // 32), max(1, width // 32))).astype(np.float32)
+    image = np.asarray(Image.fromarray(small).resize((width, height), Image.Resampling.BICUBIC))
+    image = np.clip(image + rng.normal(0, 0.05, (height, width)).astype(np.float32), 0, 1)
+    return (image * np.iinfo(dtype).max).astype(dtype)
+
+def write_tiled_tiff(path, image, tile_size):
+    """Write an uncompressed, tiled grayscale TIFF."""
+    height, width = image.shape
+    tiles_down, tiles_across = -(-height // tile_size), -(-width // tile_size)
+    padded = np.zeros((tiles_down * tile_size, tiles_across * tile_size), dtype=image.dtype)
+    padded[:height, :width] = image
+    tiles = [padded[ty * tile_size:(ty + 1) * tile_size, tx * tile_size:(tx + 1) * tile_size].astype("<" + image.dtype.str[1:]).tobytes()
+             for ty in range(tiles_down) for tx in range(tiles_across)]
+
+    count = len(tiles)
+    fields = [
+        (256, 4, [width]), (257, 4, [height]), (258, 3, [image.dtype.itemsize * 8]), (259, 3, [1]),
+        (262, 3, [1]), (277, 3, [1]), (322, 4, [tile_size]), (323, 4, [tile_size]),
+        (324, 4, None), (325, 4, [len(tile) for tile in tiles]), (339, 3, [1]),
+    ]
+    ifd_size = 2 + 12 * len(fields) + 4
+    arrays_offset = 8 + ifd_size
+    data_offset = arrays_offset + 8 * count
+    offsets = []
+    for tile in tiles:
+        offsets.append(data_offset)
+        data_offset += len(tile)
+
+    ifd = struct.pack("<H", len(fields))
+    arrays = b""
+    for tag, field_type, values in fields:
+        values = offsets if tag == 324 else values
+        value = struct.pack("<" + ("I" if field_type == 4 else "H") * len(values), *values)
+        if len(value) > 4:
+            ifd += struct.pack("<HHII", tag, field_type, len(values), arrays_offset + len(arrays))
+            arrays += value
+        else:
+            ifd += struct.pack("<HHI", tag, field_type, len(values)) + value.ljust(4, b"\0")
+    ifd += struct.pack("<I", 0)
+    with open(path, "wb") as file:
+        file.write(b"II*\0" + struct.pack("<I", 8) + ifd + arrays.ljust(8 * count, b"\0"))
+        for tile in tiles:
+            file.write(tile)
+
+def create_volume(folder, layers, width, height, dtype, tiled, tile_size=256, seed=0):
+    """Write a synthetic segment folder with a layers/ stack, returns the segment folder."""
+    layers_folder = os.path.join(folder, "layers")
+    os.makedirs(layers_folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(layers):
+        image = synthetic_slice(rng, width, height, dtype)
+        path = os.path.join(layers_folder, f"{i:02d}.tif")
+        if tiled:
+            write_tiled_tiff(path, image, tile_size)
+        else:
+            Image.fromarray(image).save(path)
+    return folder
+
+def create_zarr_volume(folder, layers, width, height, dtype, chunk_size=256, seed=0):
+    """Write the same synthetic layers as create_volume to a chunked layers.zarr store, returns the segment folder."""
+    import zarr
+    os.makedirs(folder, exist_ok=True)
+    depth = min(layers, 16)
+    array = zarr.open(os.path.join(folder, "layers.zarr"), mode="w", shape=(layers, height, width),
+                      chunks=(depth, chunk_size, chunk_size), dtype=dtype)
+    rng = np.random.default_rng(seed)
+    # Whole chunks along z at a time, so no chunk is rewritten
+    for start in range(0, layers, depth):
+        array[start:start + depth] = np.stack([synthetic_slice(rng, width, height, dtype) for _ in range(min(depth, layers - start))])
+    return folder
+
+def volume_matches(source, layers, width, height, dtype, window, seed=0):
+    """Whether source reads the synthetic layers of create_volume, every layer whole and in window."""
+    rng = np.random.default_rng(seed)
+    y0, y1, x0, x1 = window
+    for i in range(layers):
+        expected = view_gui.normalize_slice(synthetic_slice(rng, width, height, dtype))
+        if not (np.array_equal(source.read(i, i + 1)[0], expected) and np.array_equal(source.read(i, i + 1, window)[0], expected[y0:y1, x0:x1])):
+            return False
+    return True
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static files with keep-alive, single byte ranges and ETags, like the servers scroll data is published on."""
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    requests = 0
+
+    def setup(self):
+        super().setup()
+        RangeRequestHandler.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return super().send_head()
+        try:
+            with open(path, "rb") as file:
+                stat = os.fstat(file.fileno())
+                start, end = 0, stat.st_size
+                match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if match:
+                    start = int(match[1])
+                    end = min(end, int(match[2]) + 1) if match[2] else end
+                file.seek(start)
+                data = file.read(end - start)
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        RangeRequestHandler.requests += 1
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{stat.st_size}")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"')
+        self.end_headers()
+        return io.BytesIO(data)
+
+def serve_folder(folder):
+    """Serve folder over HTTP on 127.0.0.1 from a background thread, returns the server."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(RangeRequestHandler, directory=folder))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def create_overlay(width, height, seed):
+    """Sparse ink-like strokes as an "L" overlay."""
+    rng = np.random.default_rng(seed)
+    small = rng.random((max(1, height // 16), max(1, width // 16))).astype(np.float32)
+    image = np.asarray(Image.fromarray(small).resize((width, height), Image.Resampling.BILINEAR))
+    return Image.fromarray(np.where(image > 0.8, 255, 0).astype(np.uint8)).convert("L")
+
+def create_uv_mesh(grid_size, seed=0):
+    """A wavy grid surface with UV coordinates, shaped like an open3d triangle mesh."""
+    rng = np.random.default_rng(seed)
+    u, v = np.meshgrid(np.linspace(0, 1, grid_size), np.linspace(0, 1, grid_size))
+    vertices = np.stack([u.ravel() * 1000, v.ravel() * 1000, 50 * np.sin(u.ravel() * 20) + rng.normal(0, 1, u.size)], axis=1)
+    uvs = np.stack([u.ravel(), v.ravel()], axis=1)
+    index = np.arange(grid_size * grid_size).reshape(grid_size, grid_size)
+    a, b, c, d = index[:-1, :-1].ravel(), index[:-1, 1:].ravel(), index[1:, :-1].ravel(), index[1:, 1:].ravel()
+    triangles = np.concatenate([np.stack([a, b, c], axis=1), np.stack([b, d, c], axis=1)])
+    return SimpleNamespace(vertices=vertices, triangles=triangles, triangle_uvs=uvs[triangles].reshape(-1, 2))
+
+def measure(function, repeats, setup=None):
+    """Run function repeats times and return the wall clock seconds of each run."""
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+class BenchmarkSuite:
+    def __init__(self, repeats):
+        self.repeats = repeats
+        self.results = []
+
+    def run(self, name, function, setup=None, repeats=None, **params):
+        seconds = measure(function, repeats or self.repeats, setup)
+        result = {
+            "name": name,
+            "params": params,
+            "seconds": seconds,
+            "min": min(seconds),
+            "median": statistics.median(seconds),
+            "mean": statistics.mean(seconds),
+        }
+        self.results.append(result)
+        print(f"{name:<24} {json.dumps(params):<60} median {result['median'] * 1000:9.2f} ms  min {result['min'] * 1000:9.2f} ms")
+        return result
+
+def import_viewer():
+    """Import view_gui in a fresh interpreter, the startup work done before the window is created."""
+    subprocess.run([sys.executable, "-c", "import view_gui"], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_list(text, cast=int):
+    return [cast(value) for value in text.split(",") if value]
+
+def run_synthetic(args, suite):
+    canvas_width, canvas_height = parse_list(args.canvas.replace("x", ","))
+    dtype = np.dtype(args.dtype)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="crackle_benchmark_")
+    server = None
+
+    startup = suite.run("startup", import_viewer, target=args.startup_target)
+    startup["target_met"] = startup["median"] <= args.startup_target
+    if not startup["target_met"]:
+        print(f"Startup takes {startup['median']:.2f} s, more than the {args.startup_target:.2f} s target")
+
+    try:
+        for layout in args.layouts.split(","):
+            if layout == "zarr" and importlib.util.find_spec("zarr") is None:
+                print("Skipping the zarr layout, the zarr package is not installed")
+                continue
+            print(f"Generating {layout} volume: {args.layers} x {args.height} x {args.width} {args.dtype}")
+            if layout == "zarr":
+                segment = create_zarr_volume(os.path.join(workdir, layout), args.layers, args.width, args.height, dtype, chunk_size=args.tile_size)
+            else:
+                # Remote volumes are read range by range, served as tiled TIFFs
+                segment = create_volume(os.path.join(workdir, layout), args.layers, args.width, args.height, dtype,
+                                        tiled=layout in ("tiled", "http"), tile_size=args.tile_size)
+            volume = {"layout": layout, "layers": args.layers, "width": args.width, "height": args.height, "dtype": args.dtype}
+            window_height, window_width = min(args.height, canvas_height), min(args.width, canvas_width)
+            window = ((args.height - window_height) // 2, (args.height + window_height) // 2, (args.width - window_width) // 2, (args.width + window_width) // 2)
+
+            if layout == "http":
+                if server is None:
+                    server = serve_folder(workdir)
+                url = f"http://127.0.0.1:{server.server_port}/{layout}"
+                cache_folder = os.path.join(workdir, "http_cache")
+                sources = []
+                def open_http_source():
+                    # A fresh session on an empty disk cache, the listing and TIFF headers are not timed
+                    shutil.rmtree(cache_folder, ignore_errors=True)
+                    sources[:] = [view_gui.HttpTiffSource(url, cache=view_gui.DiskCache(cache_folder, view_gui.HTTP_CACHE_MAX_BYTES, name="benchmark_http"))]
+                    sources[0].header(0)
+                    RangeRequestHandler.connections = RangeRequestHandler.requests = 0
+                result = suite.run("read_window", lambda: sources[0].read(0, args.layers, window), setup=open_http_source, cache="cold", window=window, **volume)
+                result["requests"], result["connections"] = RangeRequestHandler.requests, RangeRequestHandler.connections
+                source = sources[0]
+                # A new session reads the ranges from the disk cache, keyed by the url, its ETag and the range
+                def reopen_http_source():
+                    sources[:] = [view_gui.HttpTiffSource(url, cache=source.cache)]
+                    sources[0].header(0)
+                    RangeRequestHandler.requests = 0
+                result = suite.run("read_window", lambda: sources[0].read(0, args.layers, window), setup=reopen_http_source, cache="disk", window=window, **volume)
+                result["requests"] = RangeRequestHandler.requests
+            else:
+                source = view_gui.open_volume_source(segment)
+                suite.run("read_window", lambda: source.read(0, args.layers, window), window=window, **volume)
+            if layout in ("untiled", "tiled"):
+                suite.run("load_image_disk", lambda: view_gui.load_image_disk(source.layer_names[0]), **volume)
+            if not volume_matches(source, args.layers, args.width, args.height, dtype, window):
+                raise RuntimeError(f"The {layout} volume source does not read the layers that were written")
+
+            # Accounted in the memory budget like the viewer's engine, the only one of this process
+            engine = RenderEngine(track_memory=True)
+            engine.open_volume(source)
+            state = ViewState(canvas_width=canvas_width, canvas_height=canvas_height, image_index=len(source.layer_names) // 2)
+            # Preloaded layers raw and compressed with the default slice codec, Zarr volumes preload raw arrays only
+            codecs = [None]
+            if hasattr(source, "preloaded_images") and view_gui.slice_codec(view_gui.SLICE_CODEC) is not None:
+                codecs.append(view_gui.SLICE_CODEC)
+            for codec in codecs:
+                source.slice_codec = codec
+                suite.run("preload_all_images", source.preload, setup=source.flush, repeats=1, codec=codec, **volume)
+                print(f"Preloaded layers ({codec or 'raw'}): {view_gui.format_bytes(source.memory_usage())}")
+            for preloaded, codec in [(False, None)] + [(True, codec) for codec in codecs]:
+                source.slice_codec = codec
+                if preloaded:
+                    source.preload()
+                else:
+                    source.flush()
+                for operation in args.operations.split(","):
+                    for radius in parse_list(args.radii):
+                        state.operation = operation
+                        state.radius = radius
+                        suite.run("process_images", lambda: engine.process_images(state), operation=operation, radius=radius, preloaded=preloaded, codec=codec, **volume)
+            source.flush()
+
+        # Rendering, flood fill and mesh lookups only depend on the projection, not the file layout
+        state.operation = "max"
+        state.radius = 2
+        engine.process_images(state)
+        overlays = [create_overlay(args.width, args.height, seed) for seed in range(max(parse_list(args.overlays)) + 1)]
+        state.overlay_image = overlays[0]
+        state.sub_overlay_colors = ['white', 'red', 'green', 'blue', 'yellow', 'cyan', 'magenta']
+        for backend in engine.render_backends:
+            state.render_backend = backend
+            for count in parse_list(args.overlays):
+                state.sub_overlays = overlays[:count + 1]
+                for zoom in parse_list(args.zooms, float):
+                    fit = view_gui.zoom_fit_affine(args.width, args.height, canvas_width, canvas_height)
+                    scale = zoom / view_gui.affine_scale_factor(fit)
+                    fit = view_gui.affine_translate(fit, -canvas_width / 2, -canvas_height / 2)
+                    state.mat_affine = view_gui.affine_translate(view_gui.affine_scale(fit, scale), canvas_width / 2, canvas_height / 2)
+                    suite.run("draw_image", lambda: engine.render_frame(state), backend=backend,
+                              sub_overlays=count, zoom=zoom, canvas=args.canvas)
+
+        state.render_backend = "auto"
+        state.sub_overlays = overlays[:2]
+        export_path = os.path.join(workdir, "export.tif")
+        suite.run("export_tiff", lambda: engine.export_tiff(state, export_path), repeats=1, width=args.width, height=args.height)
+        # Every layer of the volume, sliding the projection against projecting each range on its own
+        for radius in parse_list(args.radii):
+            state.radius = radius
+            suite.run("sweep_projections", lambda: list(engine.sweep_projections(state, range(args.layers))), radius=radius, layers=args.layers)
+        state.radius = 2
+
+        flood_fill_overlay = []
+        def reset_flood_fill():
+            flood_fill_overlay[:] = [Image.new("L", engine.pil_image.size, "black")]
+        center = (args.width // 2, args.height // 2)
+        suite.run("flood_fill_2d", lambda: view_gui.flood_fill_image(engine.pil_image, flood_fill_overlay[0], center, 255, args.flood_fill_steps),
+                  setup=reset_flood_fill, steps=args.flood_fill_steps)
+
+        start_index = max(0, state.image_index - args.flood_fill_layers)
+        volume_block = source.read(start_index, min(args.layers, state.image_index + args.flood_fill_layers + 1))
+        seed = (state.image_index - start_index, args.height // 2, args.width // 2)
+        mask = view_gui.flood_fill_volume(volume_block, seed, 255, volume_block.size)
+        suite.run("flood_fill_3d", lambda: view_gui.flood_fill_volume(volume_block, seed, 255, volume_block.size),
+                  layers=len(volume_block), voxels=int(np.count_nonzero(mask)))
+
+        mesh = create_uv_mesh(args.mesh_size)
+        suite.run("preprocess_uv_triangles", lambda: view_gui.preprocess_uv_triangles(mesh), triangles=len(mesh.triangles))
+        kd_tree, triangle_data = view_gui.preprocess_uv_triangles(mesh)
+        uv_points = np.random.default_rng(1).random((args.queries, 2))
+        suite.run("find_uv_triangle", lambda: [view_gui.find_uv_triangle(mesh.vertices, uv, kd_tree, triangle_data) for uv in uv_points],
+                  triangles=len(mesh.triangles), queries=args.queries)
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def run_replay(args, suite):
+    """Replay a recorded session repeats times and report the frame latency percentiles per input event."""
+    latencies = {}
+    recorded = {}
+    for _ in range(args.repeats):
+        replay = view_gui.SessionReplay(args.replay)
+        for event, seconds, recorded_seconds in replay.run():
+            latencies.setdefault(event, []).append(seconds)
+            if recorded_seconds is not None:
+                recorded.setdefault(event, []).append(recorded_seconds)
+    latencies["all"] = [value for values in latencies.values() for value in values]
+    recorded["all"] = [value for values in recorded.values() for value in values]
+    for event, seconds in sorted(latencies.items()):
+        percentiles = view_gui.latency_percentiles(seconds)
+        recorded_seconds = recorded.get(event)
+        suite.results.append({
+            "name": "replay",
+            "params": {"session": os.path.basename(args.replay), "event": event},
+            "seconds": seconds,
+            "percentiles": percentiles,
+            "recorded_percentiles": view_gui.latency_percentiles(recorded_seconds) if recorded_seconds else None,
+        })
+        print(f"replay {event:<28} frames {percentiles['count']:6d}  p50 {percentiles['p50'] * 1000:8.2f} ms  "
+              f"p90 {percentiles['p90'] * 1000:8.2f} ms  p99 {percentiles['p99'] * 1000:8.2f} ms  max {percentiles['max'] * 1000:8.2f} ms")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Crackle Viewer hot paths on synthetic data.")
+    parser.add_argument("--layers", type=int, default=32, help="number of layers in the synthetic volume")
+    parser.add_argument("--width", type=int, default=2048)
+    parser.add_argument("--height", type=int, default=2048)
+    parser.add_argument("--dtype", choices=["uint8", "uint16"], default="uint16")
+    parser.add_argument("--layouts", default="untiled,tiled,zarr,http",
+                        help="comma separated volume layouts to benchmark: untiled, tiled, zarr, http (tiled tiffs from a local server)")
+    parser.add_argument("--tile-size", type=int, default=256, help="tile size of the tiled tiff layouts and chunk size of the zarr layout")
+    parser.add_argument("--radii", default="0,2,5,10", help="comma separated projection radii")
+    parser.add_argument("--operations", default="max,min,mean")
+    parser.add_argument("--overlays", default="0,1,4", help="comma separated numbers of sub-overlays for draw_image")
+    parser.add_argument("--zooms", default="0.25,1,4", help="comma separated zoom factors for draw_image")
+    parser.add_argument("--canvas", default="1920x1080", help="canvas size WIDTHxHEIGHT")
+    parser.add_argument("--flood-fill-steps", type=int, default=20000)
+    parser.add_argument("--flood-fill-layers", type=int, default=5, help="layers before and after the seed for flood_fill_3d")
+    parser.add_argument("--mesh-size", type=int, default=300, help="vertices per side of the synthetic UV mesh")
+    parser.add_argument("--queries", type=int, default=200, help="number of find_uv_triangle lookups")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--startup-target", type=float, default=0.5, help="seconds the viewer module may take to import in a fresh interpreter")
+    parser.add_argument("--workdir", default=None, help="folder for the synthetic volumes, a temporary folder by default")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are written to")
+    parser.add_argument("--replay", default=None, help="replay a session recorded with View > Record Session instead of the synthetic benchmarks")
+    parser.add_argument("--trace", default=None, help="also write the timing spans of the run as a Chrome trace to this file")
+    args = parser.parse_args(argv)
+
+    suite = BenchmarkSuite(args.repeats)
+    if args.trace:
+        view_gui.profiler.start_recording()
+    if args.replay:
+        run_replay(args, suite)
+    else:
+        run_synthetic(args, suite)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": sys.version.split()[0],
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pillow": Image.__version__,
+        },
+        "args": vars(args),
+        "results": suite.results,
+        "cache_counters": {name: {"hits": hits, "misses": misses} for name, (hits, misses) in view_gui.profiler.counters.items()},
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+    if args.trace:
+        view_gui.profiler.stop_recording()
+        view_gui.profiler.save_trace(args.trace)
+
+if __name__ == "__main__":
+    main()
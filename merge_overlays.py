@@ -0,0 +1,29 @@
+### Crackle Viewer - consensus merge of overlays from several annotators
+#
+# Merges the overlays labeled by several annotators for the same segment into
+# union, intersection, k-of-N vote and agreement images (tiled TIFFs) and
+# writes the pairwise IoU of the annotators to stats.json. Runs without a
+# display, with the same merge engine as the viewer's "Merge Overlays" button.
+#
+#   python merge_overlays.py alice.png bob.png carol.tif --votes 2 --output merged
+
+import argparse
+
+from view_gui import merge_overlays
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge the overlays of several annotators of a segment.")
+    parser.add_argument("overlays", nargs="+", help="overlay files (PNG or TIF) of the same size")
+    parser.add_argument("--output", default="merged", help="folder the merged images and stats.json are written to")
+    parser.add_argument("--votes", type=int, default=None, help="annotators that must agree for the vote image, a majority by default")
+    parser.add_argument("--threshold", type=int, default=128, help="8 bit value from which an overlay pixel counts as labeled")
+    parser.add_argument("--tile-size", type=int, default=512, help="rows merged per band and tile size of the output TIFFs")
+    parser.add_argument("--workers", type=int, default=None, help="bands merged in parallel, the number of CPUs by default")
+    args = parser.parse_args(argv)
+
+    stats = merge_overlays(args.overlays, args.output, args.votes, args.threshold, args.tile_size, args.workers)
+    for pair in stats["pairs"]:
+        print(f"IoU {pair['iou']:.3f}  {pair['a']}  {pair['b']}")
+
+if __name__ == "__main__":
+    main()
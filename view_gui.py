@@ -3,35 +3,1329 @@
 
 import tkinter as tk
 import tkinter.colorchooser
+import tkinter.simpledialog
 import threading
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
 from tkinter import filedialog
 import textwrap
-from PIL import Image, ImageTk, ImageDraw, ImageChops, ImageEnhance
+import tempfile
+import shutil
+from PIL import Image, ImageTk, ImageDraw, ImageChops, ImageEnhance, ImageColor
 # Increase the image pixel limit to the desired value
 # Image.MAX_IMAGE_PIXELS = 300000000
 Image.MAX_IMAGE_PIXELS = None
 import math
+import time
 import numpy as np
 import os
+import io
+import re
 import sys
 import glob
-from tqdm import tqdm
-from multiprocessing import Pool
-from scipy.spatial import KDTree
-import open3d as o3d
-import cv2
+import json
+import queue
+import struct
+import zlib
+import pickle
+import hashlib
+import http.client
+import urllib.parse
+import importlib
+import importlib.util
+# open3d, scipy, cv2, tqdm, multiprocessing and zarr are imported where they are first used, they take most of the
+# startup time. warm_up_imports loads them in the background once the window is shown.
+
+class ProfileSpan:
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+class Profiler:
+    """
+    Timing spans and hit/miss counters for the hot paths. Spans are summed per frame for the performance HUD
+    and, while recording, kept as Chrome trace events that chrome://tracing or Perfetto can open.
+    Spans from the tile worker threads are summed too, so a frame breakdown can exceed the frame time.
+    """
+    max_trace_events = 1000000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.epoch = time.perf_counter()
+        self.pid = os.getpid()
+        self.frame_start = None
+        self.frame_spans = {}
+        self.last_frame = {}
+        self.last_frame_seconds = 0.0
+        # Most recent duration of every span, also the ones outside of a frame such as the hover lookup
+        self.latest = {}
+        self.counters = {}
+        self.recording = False
+        self.trace_events = deque(maxlen=self.max_trace_events)
+
+    def span(self, name, **args):
+        return ProfileSpan(self, name, args)
+
+    def add(self, name, start, end, args=None):
+        seconds = end - start
+        with self.lock:
+            self.latest[name] = seconds
+            if self.frame_start is not None:
+                total = self.frame_spans.get(name)
+                self.frame_spans[name] = (total[0] + seconds, total[1] + 1) if total else (seconds, 1)
+            if self.recording:
+                event = {"name": name, "ph": "X", "ts": (start - self.epoch) * 1e6, "dur": seconds * 1e6,
+                         "pid": self.pid, "tid": threading.get_ident()}
+                if args:
+                    event["args"] = args
+                self.trace_events.append(event)
+
+    def count(self, name, hit):
+        """Count a cache lookup of the named cache."""
+        with self.lock:
+            hits, misses = self.counters.get(name, (0, 0))
+            self.counters[name] = (hits + 1, misses) if hit else (hits, misses + 1)
+
+    def hit_rate(self, name):
+        hits, misses = self.counters.get(name, (0, 0))
+        return hits / (hits + misses) if hits + misses else None
+
+    def begin_frame(self):
+        with self.lock:
+            if self.frame_start is None:
+                self.frame_start = time.perf_counter()
+                self.frame_spans = {}
+
+    def end_frame(self):
+        if self.frame_start is None:
+            return
+        end = time.perf_counter()
+        self.add("frame", self.frame_start, end)
+        with self.lock:
+            self.last_frame = self.frame_spans
+            self.last_frame_seconds = end - self.frame_start
+            self.frame_start = None
+            self.frame_spans = {}
+
+    def summary_lines(self):
+        """Text lines of the last frame breakdown, the latest hover lookup and the cache hit rates."""
+        lines = [f"frame {self.last_frame_seconds * 1000:7.1f} ms"]
+        for name, (seconds, count) in sorted(self.last_frame.items(), key=lambda item: -item[1][0]):
+            if name == "frame":
+                continue
+            lines.append(f"{name:<18} {seconds * 1000:7.1f} ms" + (f" x{count}" if count > 1 else ""))
+        if "hover_lookup" in self.latest:
+            lines.append(f"{'hover_lookup':<18} {self.latest['hover_lookup'] * 1000:7.1f} ms")
+        for name in sorted(self.counters):
+            hits, misses = self.counters[name]
+            lines.append(f"{name:<18} {100.0 * self.hit_rate(name):5.1f} % hits of {hits + misses}")
+        return lines
+
+    def start_recording(self):
+        with self.lock:
+            self.trace_events.clear()
+            self.recording = True
+
+    def stop_recording(self):
+        with self.lock:
+            self.recording = False
+
+    def save_trace(self, path):
+        """Write the recorded spans in the Chrome trace event format."""
+        with self.lock:
+            events = list(self.trace_events)
+        events.append({"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": "Crackle Viewer"}})
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+        print(f"Saved {len(events) - 1} trace events to {path}")
+
+# Shared by the volume sources, the render engine and the application
+profiler = Profiler()
+
+def default_memory_budget():
+    """Half of the physical memory, 8 GB where it cannot be queried. CRACKLE_MEMORY_BUDGET (bytes) overrides it."""
+    if "CRACKLE_MEMORY_BUDGET" in os.environ:
+        return int(os.environ["CRACKLE_MEMORY_BUDGET"])
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+    except (AttributeError, ValueError, OSError):
+        return 8 * 1024**3
+
+def image_nbytes(image):
+    """Memory held by a numpy array or PIL image, 0 for None."""
+    if image is None:
+        return 0
+    if isinstance(image, np.ndarray):
+        return image.nbytes
+    return image.width * image.height * len(image.getbands()) * (2 if image.mode in ("I;16", "I;16B") else 4 if image.mode in ("I", "F") else 1)
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+class MemoryBudget:
+    """
+    Accounts the memory of every cache and buffer and keeps the total under a budget.
+    Consumers register a category with a function that reports its size and, if the data can be
+    dropped and reloaded, a function that frees at least the given number of bytes of it.
+    Evictable categories are freed in priority order, lowest first, before a reservation fails.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget if budget is not None else default_memory_budget()
+        self.lock = threading.RLock()
+        # name -> (priority, size(), evict(bytes) or None)
+        self.categories = {}
+
+    def register(self, name, size, evict=None, priority=0):
+        with self.lock:
+            self.categories[name] = (priority, size, evict)
+
+    def unregister(self, name):
+        with self.lock:
+            self.categories.pop(name, None)
+
+    def usage(self):
+        with self.lock:
+            categories = list(self.categories.items())
+        return {name: size() for name, (_, size, _) in categories}
+
+    def total(self):
+        return sum(self.usage().values())
+
+    def reserve(self, nbytes, priority=None):
+        """
+        Make room for nbytes more by evicting categories with a lower priority than the requester
+        (all evictable categories if priority is None). Returns whether the allocation fits the budget.
+        """
+        with self.lock:
+            categories = sorted(self.categories.items(), key=lambda item: item[1][0])
+            used = sum(size() for _, (_, size, _) in categories)
+            for name, (category_priority, size, evict) in categories:
+                if used + nbytes <= self.budget:
+                    break
+                if evict is None or (priority is not None and category_priority >= priority):
+                    continue
+                before = size()
+                evict(used + nbytes - self.budget)
+                freed = before - size()
+                if freed > 0:
+                    print(f"Memory budget: evicted {format_bytes(freed)} of {name}")
+                used -= freed
+            return used + nbytes <= self.budget
+
+    def enforce(self):
+        return self.reserve(0)
+
+    def status(self):
+        usage = self.usage()
+        parts = ", ".join(f"{name} {format_bytes(size)}" for name, size in usage.items() if size > 0)
+        text = f"Memory {format_bytes(sum(usage.values()))} / {format_bytes(self.budget)}"
+        return f"{text} ({parts})" if parts else text
+
+# Priorities of the memory categories, lower ones are evicted first
+MEMORY_PRIORITY_PREFETCH = 0
+MEMORY_PRIORITY_VISIBLE = 1
+
+# Shared by the volume sources, the render engine and the application
+memory = MemoryBudget()
+
+WARM_UP_MODULES = ("cv2", "tqdm", "multiprocessing", "scipy.spatial", "scipy.ndimage", "open3d")
+
+def warm_up_imports(modules=WARM_UP_MODULES):
+    """Import the heavy subsystems in the background so that their first use does not wait for them."""
+    for name in modules:
+        try:
+            with profiler.span("import", module=name):
+                importlib.import_module(name)
+        except ImportError as e:
+            print(f"Could not import {name}: {e}")
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """A long running operation on the job scheduler, the function receives the job to report progress and poll cancellation."""
+    def __init__(self, scheduler, name, function, key=None, on_done=None, on_progress=None):
+        self.scheduler = scheduler
+        self.name = name
+        self.function = function
+        self.key = key
+        self.on_done = on_done
+        self.on_progress = on_progress
+        self.progress = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check(self):
+        """Raise JobCancelled once the job was cancelled, for loops that have no cleaner place to stop."""
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def report(self, done, total=None):
+        """Report progress from the worker thread, total None for an amount without a known end."""
+        self.progress = (done, total)
+        self.scheduler.events.put(("progress", self, None))
+
+    def run(self):
+        try:
+            result = self.function(self)
+            self.scheduler.events.put(("done", self, result))
+        except JobCancelled:
+            self.scheduler.events.put(("cancelled", self, None))
+        except Exception as e:
+            self.scheduler.events.put(("failed", self, e))
+
+class JobScheduler:
+    """
+    Runs long operations on a bounded worker pool. Progress, results and errors are queued and handed to the callbacks
+    by poll, which the Tk thread calls from an after loop, so the callbacks may touch the widgets and images.
+    At most one job runs per key, e.g. one mutating job per overlay.
+    """
+    def __init__(self, max_workers=2):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.events = queue.Queue()
+        self.jobs = []
+
+    def busy(self, key):
+        return key is not None and any(job.key is key for job in self.jobs)
+
+    def submit(self, name, function, key=None, on_done=None, on_progress=None):
+        """Queue function(job), returns the job or None if a job with the same key is still running."""
+        if self.busy(key):
+            print(f"{name}: waiting for the running job on the same data to finish.")
+            return None
+        job = Job(self, name, function, key=key, on_done=on_done, on_progress=on_progress)
+        self.jobs.append(job)
+        self.pool.submit(job.run)
+        return job
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def poll(self):
+        """Deliver the queued events on the calling thread, progress is coalesced to the latest value per job."""
+        progress = set()
+        while True:
+            try:
+                kind, job, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                progress.add(job)
+                continue
+            progress.discard(job)
+            self.jobs.remove(job)
+            if kind == "done":
+                if job.on_done is not None:
+                    job.on_done(value)
+            elif kind == "cancelled":
+                print(f"{job.name} cancelled.")
+            else:
+                print(f"{job.name} failed: {value!r}")
+        for job in progress:
+            if job.on_progress is not None:
+                job.on_progress(job)
+
+    def status(self):
+        """One line summary of the running jobs for the status bar."""
+        parts = []
+        for job in self.jobs:
+            if job.progress is None:
+                parts.append(job.name)
+            elif job.progress[1]:
+                parts.append(f"{job.name} {100.0 * job.progress[0] / job.progress[1]:.0f}%")
+            else:
+                parts.append(f"{job.name} {job.progress[0]}")
+        return " | ".join(parts) + (" (Esc to cancel)" if parts else "")
 
-def load_image_disk(filename):
-    pil_image = np.array(Image.open(filename))
+def normalize_slice(image):
     # Convert to 8-bit and grayscale if needed
-    if pil_image.dtype == np.uint16:
-        pil_image = np.uint16(pil_image//256)
-    return pil_image
+    if image.dtype == np.uint16:
+        image = np.uint16(image//256)
+    return image
+
+def load_image_disk(filename):
+    return normalize_slice(np.array(Image.open(filename)))
 
 def load_image_parallel(filename):
     return filename, load_image_disk(filename)
 
+# Preloaded layers are kept compressed with this codec: a Blosc compressor of numcodecs (lz4, zstd, blosclz, ...)
+# or zlib. CRACKLE_SLICE_CODEC=none keeps them raw.
+SLICE_CODEC = os.environ.get("CRACKLE_SLICE_CODEC", "lz4")
+# Compressed layers are split into bands of rows that decompress in parallel, windows only decompress their bands
+SLICE_BAND_ROWS = 256
+# Decompressed layers kept for the next reads, enough for the layers of a projection and the neighbouring steps
+SLICE_HOT_LAYERS = 32
+
+class ZlibCodec:
+    def encode(self, data):
+        return zlib.compress(data, 1)
+
+    def decode(self, data):
+        return zlib.decompress(data)
+
+def slice_codec(name):
+    """Codec with encode and decode for a SLICE_CODEC name, None for raw layers. Falls back to zlib without numcodecs."""
+    if name is None or name.lower() in ("", "none"):
+        return None
+    if name.lower() != "zlib":
+        try:
+            from numcodecs import Blosc
+            # Byte shuffle groups the high bytes of the uint16 layers, which are all zero after normalize_slice
+            return Blosc(cname=name.lower(), clevel=5, shuffle=Blosc.SHUFFLE)
+        except (ImportError, ValueError):
+            print(f"Slice codec {name} is not available, using zlib")
+    return ZlibCodec()
+
+class CompressedSlice:
+    """A layer compressed in bands of SLICE_BAND_ROWS rows, the bands are bytes or memoryviews of shared memory."""
+    def __init__(self, shape, dtype, bands):
+        self.shape, self.dtype, self.bands = shape, dtype, bands
+        self.nbytes = sum(len(band) for band in bands)
+
+def compress_slice(image, codec):
+    if codec is None:
+        return image
+    bands = [codec.encode(np.ascontiguousarray(image[y0:y0 + SLICE_BAND_ROWS])) for y0 in range(0, image.shape[0], SLICE_BAND_ROWS)]
+    return CompressedSlice(image.shape, image.dtype, bands)
+
+def load_image_compressed(args):
+    filename, codec_name = args
+    return filename, compress_slice(load_image_disk(filename), slice_codec(codec_name))
+
+class SliceCache:
+    """
+    Preloaded layers of a volume source by key. Compressed layers are decompressed band by band in worker threads
+    when they are read, and the most recently read ones are kept raw in a small hot set.
+    Raw layers (codec None) are stored and returned as they are.
+    """
+    def __init__(self, codec_name=SLICE_CODEC, hot_layers=SLICE_HOT_LAYERS):
+        self.codec_name = codec_name
+        self.codec = slice_codec(codec_name)
+        self.layers = OrderedDict()
+        self.hot = OrderedDict()
+        self.hot_layers = hot_layers
+        self.lock = threading.Lock()
+        self.decoders = self.decoders_pid = None
+        # Shared memory the layers are read from, in the worker processes of the sweep export
+        self.shared_block = None
+
+    def __getstate__(self):
+        # Picklable without the lock and the decoder threads
+        return dict(self.__dict__, lock=None, decoders=None)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, lock=threading.Lock())
+
+    def share(self):
+        """
+        Copy the stored layers into one block of shared memory for worker processes. Returns the block, which
+        the caller closes and unlinks once the workers are done, and the picklable spec to attach() it with.
+        """
+        from multiprocessing import shared_memory
+        with self.lock:
+            layers = list(self.layers.items())
+        entries, chunks, size = [], [], 0
+        for key, layer in layers:
+            raw = isinstance(layer, np.ndarray)
+            parts = [memoryview(np.ascontiguousarray(layer)).cast("B")] if raw else layer.bands
+            bands = []
+            for part in parts:
+                bands.append((size, len(part)))
+                chunks.append((size, part))
+                size += len(part)
+            entries.append((key, tuple(layer.shape), np.dtype(layer.dtype).str, raw, bands))
+        block = shared_memory.SharedMemory(create=True, size=max(1, size))
+        for offset, part in chunks:
+            block.buf[offset:offset + len(part)] = part
+        return block, {"name": block.name, "codec_name": self.codec_name, "layers": entries}
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        SliceCache of the layers shared by share() in a process spawned by its creator, read in place from the
+        shared memory. Spawned processes use the resource tracker of their parent, which unlinks the block.
+        """
+        from multiprocessing import shared_memory
+        cache = cls(spec["codec_name"])
+        cache.shared_block = block = shared_memory.SharedMemory(name=spec["name"])
+        for key, shape, dtype, raw, bands in spec["layers"]:
+            views = [block.buf[offset:offset + length] for offset, length in bands]
+            cache.layers[key] = np.frombuffer(views[0], dtype=dtype).reshape(shape) if raw else CompressedSlice(shape, np.dtype(dtype), views)
+        return cache
+
+    def decoder_pool(self):
+        # Forked processes inherit the executor but not its threads
+        if self.decoders is None or self.decoders_pid != os.getpid():
+            self.decoders, self.decoders_pid = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)), os.getpid()
+        return self.decoders
+
+    def __contains__(self, key):
+        return key in self.layers
+
+    def __len__(self):
+        return len(self.layers)
+
+    def put(self, key, image):
+        """Store a raw layer or one compressed by compress_slice (e.g. in a worker process). Returns its size in memory."""
+        if isinstance(image, np.ndarray):
+            image = compress_slice(image, self.codec)
+        with self.lock:
+            self.layers[key] = image
+        return image.nbytes
+
+    def get(self, key, window=None):
+        """The layer, or its (y0, y1, x0, x1) window, None if it is not stored."""
+        with self.lock:
+            layer = self.layers.get(key)
+            image = self.hot.get(key)
+            if image is not None:
+                self.hot.move_to_end(key)
+        if layer is None:
+            return None
+        if isinstance(layer, np.ndarray):
+            image = layer
+        else:
+            profiler.count("hot_slices", image is not None)
+        if image is None:
+            rows = (0, layer.shape[0]) if window is None else window[:2]
+            image = self.decompress(layer, *rows)
+            if window is not None:
+                return image[:, window[2]:window[3]]
+            # The hot set only grows while the budget has room for it
+            if memory.reserve(image.nbytes, MEMORY_PRIORITY_PREFETCH):
+                with self.lock:
+                    self.hot[key] = image
+                    while len(self.hot) > self.hot_layers:
+                        self.hot.popitem(last=False)
+        if window is not None:
+            y0, y1, x0, x1 = window
+            image = image[y0:y1, x0:x1]
+        return image
+
+    def decompress(self, layer, y0, y1):
+        """Rows [y0, y1) of a compressed layer, its bands are decompressed in parallel."""
+        height, width = layer.shape
+        y0, y1 = max(0, y0), min(height, max(y0, y1))
+        first, last = y0 // SLICE_BAND_ROWS, math.ceil(y1 / SLICE_BAND_ROWS)
+        image = np.empty((y1 - y0, width), dtype=layer.dtype)
+
+        def decode(band):
+            top = band * SLICE_BAND_ROWS
+            rows = np.frombuffer(self.codec.decode(layer.bands[band]), dtype=layer.dtype).reshape(-1, width)
+            start, end = max(y0, top), min(y1, top + len(rows))
+            image[start - y0:end - y0] = rows[start - top:end - top]
+
+        with profiler.span("slice_decompress", bands=last - first):
+            list(self.decoder_pool().map(decode, range(first, last)))
+        return image
+
+    def memory_usage(self):
+        with self.lock:
+            layers, hot = list(self.layers.values()), list(self.hot.values())
+        return sum(layer.nbytes for layer in layers) + sum(image.nbytes for image in hot if image is not None)
+
+    def evict(self, nbytes):
+        """Drop the hot set first, then the layers last loaded first, until nbytes are freed."""
+        freed = 0
+        with self.lock:
+            while freed < nbytes and self.hot:
+                freed += self.hot.popitem()[1].nbytes
+            while freed < nbytes and self.layers:
+                key, layer = self.layers.popitem()
+                self.hot.pop(key, None)
+                freed += layer.nbytes
+        return freed
+
+VOLUME_MANIFEST_NAME = ".crackle_manifest.json"
+VOLUME_MANIFEST_VERSION = 1
+VOLUME_EXTENSIONS = [".tif", ".png", ".jpg"]
+PIL_MODE_DTYPES = {"1": "bool", "L": "uint8", "P": "uint8", "I;16": "uint16", "I;16B": "uint16", "I;16L": "uint16", "I": "int32", "F": "float32"}
+
+def natural_sort_key(path):
+    """Sort key that orders 'layer_2.tif' before 'layer_10.tif'."""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', os.path.basename(path))]
+
+def scan_volume_folder(folder):
+    """List the slices of a surface volume folder: tif files, else png files, else jpg files."""
+    with os.scandir(folder) as entries:
+        names = [entry.name for entry in entries if entry.is_file()]
+    for extension in VOLUME_EXTENSIONS:
+        slices = [name for name in names if name.endswith(extension)]
+        if slices:
+            return sorted(slices, key=natural_sort_key)
+    return []
+
+def probe_slice(path):
+    """Read the header of a slice image: shape, dtype and tiff tiling, without decoding pixels."""
+    stat = os.stat(path)
+    with Image.open(path) as image:
+        info = {
+            "name": os.path.basename(path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "width": image.width,
+            "height": image.height,
+            "mode": image.mode,
+            "dtype": PIL_MODE_DTYPES.get(image.mode, image.mode),
+            "tile": None,
+            "rows_per_strip": None,
+        }
+        tags = getattr(image, "tag_v2", None)
+        if tags is not None:
+            if 322 in tags and 323 in tags: # TileWidth, TileLength
+                info["tile"] = [int(tags[322]), int(tags[323])]
+            elif 278 in tags: # RowsPerStrip
+                info["rows_per_strip"] = int(tags[278])
+    return info
+
+def build_volume_manifest(folder):
+    """Scan the folder, probe every slice header in parallel and write the manifest next to the slices."""
+    names = scan_volume_folder(folder)
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        slices = list(pool.map(probe_slice, [os.path.join(folder, name) for name in names]))
+    manifest = {
+        "version": VOLUME_MANIFEST_VERSION,
+        "folder_mtime_ns": os.stat(folder).st_mtime_ns,
+        "slices": slices,
+    }
+    manifest_path = os.path.join(folder, VOLUME_MANIFEST_NAME)
+    try:
+        # Create the file before recording the folder mtime, rewriting an existing file leaves the folder mtime as is
+        open(manifest_path, "a").close()
+        manifest["folder_mtime_ns"] = os.stat(folder).st_mtime_ns
+        with open(manifest_path, "w") as file:
+            json.dump(manifest, file)
+    except OSError as e:
+        print(f"Could not write volume manifest: {e}")
+    return manifest
+
+def load_volume_manifest(folder):
+    """Return the cached manifest of the folder, or None if it is missing or the folder changed since."""
+    try:
+        with open(os.path.join(folder, VOLUME_MANIFEST_NAME), "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    # Adding, removing or renaming slices updates the folder mtime, a single stat validates the list of slices
+    if manifest.get("version") != VOLUME_MANIFEST_VERSION or manifest.get("folder_mtime_ns") != os.stat(folder).st_mtime_ns:
+        return None
+    # Slices rewritten in place keep the folder mtime, their size and mtime are checked in one scandir pass
+    with os.scandir(folder) as entries:
+        stats = {entry.name: entry.stat() for entry in entries if entry.is_file()}
+    stale = [i for i, info in enumerate(manifest["slices"])
+             if info["name"] not in stats or (stats[info["name"]].st_size, stats[info["name"]].st_mtime_ns) != (info["size"], info["mtime_ns"])]
+    if stale:
+        print(f"Reindexing {len(stale)} changed slices of {folder}")
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            slices = list(pool.map(probe_slice, [os.path.join(folder, manifest["slices"][i]["name"]) for i in stale]))
+        for i, info in zip(stale, slices):
+            manifest["slices"][i] = info
+        try:
+            with open(os.path.join(folder, VOLUME_MANIFEST_NAME), "w") as file:
+                json.dump(manifest, file)
+        except OSError as e:
+            print(f"Could not write volume manifest: {e}")
+    return manifest
+
+def open_volume_manifest(folder):
+    manifest = load_volume_manifest(folder)
+    if manifest is None:
+        print(f"Indexing {folder} ...")
+        manifest = build_volume_manifest(folder)
+    return manifest
+
+def is_zarr_store(path):
+    return any(os.path.exists(os.path.join(path, name)) for name in (".zarray", ".zgroup", "zarr.json"))
+
+def find_zarr_volume(path):
+    """Return the Zarr store of a segment folder, the folder itself or layers.zarr/surface_volume.zarr inside it."""
+    for candidate in (path, os.path.join(path, "layers.zarr"), os.path.join(path, "surface_volume.zarr")):
+        if os.path.isdir(candidate) and is_zarr_store(candidate):
+            return candidate
+    return None
+
+def open_zarr_levels(path):
+    """Open the resolution levels of a Zarr store, full resolution first. OME-Zarr multiscales are used when present."""
+    import zarr
+    root = zarr.open(path, mode="r")
+    if hasattr(root, "shape"):
+        return [root]
+    attrs = dict(root.attrs)
+    multiscales = attrs.get("multiscales") or attrs.get("ome", {}).get("multiscales")
+    if multiscales:
+        names = [dataset["path"] for dataset in multiscales[0]["datasets"]]
+    else:
+        names = [name for name, _ in root.arrays()]
+    levels = [root[name] for name in names]
+    return sorted(levels, key=lambda level: -level.shape[-1])
+
+class TiffStackSource:
+    """Surface volume stored as one image file per layer."""
+    # Each layer is one file, a window still decodes the whole file
+    windowed = False
+
+    def __init__(self, folder, manifest):
+        self.folder = folder
+        self.manifest = manifest
+        self.layer_names = [os.path.join(folder, info["name"]) for info in manifest["slices"]]
+        self.num_levels = 1
+        self.slice_codec = SLICE_CODEC
+        self.preloaded_images = SliceCache(None)
+
+    def shape(self, level=0):
+        info = self.manifest["slices"][0]
+        return info["height"], info["width"]
+
+    def reopen(self):
+        """(constructor, args) that open this volume again in another process, without its preloaded layers."""
+        return TiffStackSource, (self.folder, self.manifest)
+
+    def identity(self, start, end):
+        """Names, sizes and mtimes of the layer files [start, end) on disk, to key the data derived from them."""
+        identity = [os.path.abspath(self.folder)]
+        for path in self.layer_names[start:end]:
+            # A live stat, layers can be rewritten while the volume is open
+            stat = os.stat(path)
+            identity.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+        return identity
+
+    def load_slice(self, index):
+        filename = self.layer_names[index]
+        image = self.preloaded_images.get(filename)
+        profiler.count("preloaded_slices", image is not None)
+        if image is not None:
+            return image
+        return load_image_disk(filename)
+
+    def read(self, start, end, window=None, level=0):
+        """Read layers [start, end) as a (layers, height, width) array, window is (y0, y1, x0, x1)."""
+        from tqdm import tqdm
+        images = [self.load_slice(i) for i in tqdm(range(start, end))]
+        if window is not None:
+            y0, y1, x0, x1 = window
+            images = [image[y0:y1, x0:x1] for image in images]
+        return np.stack(images)
+
+    def preload(self, progress=None):
+        """
+        Load all layers into memory, progress(done, total) is called after every layer.
+        Stops early when the memory budget is exhausted, the remaining layers are read from disk.
+        """
+        from multiprocessing import Pool
+        from tqdm import tqdm
+        self.preloaded_images = preloaded_images = SliceCache(self.slice_codec)
+        # The workers compress the layers they decode, only the compressed bytes come back
+        tasks = [(filename, self.slice_codec) for filename in self.layer_names]
+        with Pool() as pool:
+            for done, (filename, image) in enumerate(tqdm(pool.imap(load_image_compressed, tasks), total=len(self.layer_names)), 1):
+                if not memory.reserve(image.nbytes, MEMORY_PRIORITY_PREFETCH):
+                    print(f"Memory budget reached, preloaded {len(preloaded_images)} of {len(self.layer_names)} layers")
+                    break
+                preloaded_images.put(filename, image)
+                if progress is not None:
+                    progress(done, len(self.layer_names))
+
+    def memory_usage(self):
+        return self.preloaded_images.memory_usage()
+
+    def evict(self, nbytes):
+        """Drop preloaded layers, last loaded first, until nbytes are freed."""
+        self.preloaded_images.evict(nbytes)
+
+    def flush(self):
+        self.preloaded_images = SliceCache(None)
+
+class ZarrVolumeSource:
+    """Chunked surface volume in a Zarr store, (z, y, x) axes last. Pyramid levels come from OME-Zarr multiscales."""
+    windowed = True
+
+    def __init__(self, path):
+        if importlib.util.find_spec("zarr") is None:
+            raise ImportError("Reading Zarr volumes requires the zarr package.")
+        self.folder = path
+        self.levels = open_zarr_levels(path)
+        self.num_levels = len(self.levels)
+        self.layer_names = [os.path.join(path, f"{i:05d}") for i in range(self.levels[0].shape[-3])]
+        self.preloaded = None
+
+    def shape(self, level=0):
+        return tuple(self.levels[level].shape[-2:])
+
+    def reopen(self):
+        return ZarrVolumeSource, (self.folder,)
+
+    def read(self, start, end, window=None, level=0):
+        """Read layers [start, end) as a (layers, height, width) array, window is (y0, y1, x0, x1) in level pixels."""
+        y0, y1, x0, x1 = window if window is not None else (0, None, 0, None)
+        profiler.count("preloaded_slices", level == 0 and self.preloaded is not None)
+        if level == 0 and self.preloaded is not None:
+            return self.preloaded[start:end, y0:y1, x0:x1]
+        array = self.levels[level]
+        # Levels that are also downsampled along z cover several layers per plane
+        z_factor = self.levels[0].shape[-3] / array.shape[-3]
+        z_start, z_end = int(start // z_factor), max(int(start // z_factor) + 1, math.ceil(end / z_factor))
+        index = (0,) * (array.ndim - 3) + (slice(z_start, z_end), slice(y0, y1), slice(x0, x1))
+        return normalize_slice(np.asarray(array[index]))
+
+    def preload(self, progress=None):
+        self.preloaded = None
+        num_layers = len(self.layer_names)
+        height, width = self.shape()
+        if not memory.reserve(num_layers * height * width * self.levels[0].dtype.itemsize, MEMORY_PRIORITY_PREFETCH):
+            print(f"Not preloading, the volume does not fit the memory budget of {format_bytes(memory.budget)}")
+            return
+        # Read in blocks of layers so that progress can be reported
+        step = self.levels[0].chunks[-3] if hasattr(self.levels[0], "chunks") else 16
+        preloaded = None
+        for start in range(0, num_layers, step):
+            block = self.read(start, min(num_layers, start + step))
+            if preloaded is None:
+                preloaded = np.empty((num_layers,) + block.shape[1:], dtype=block.dtype)
+            preloaded[start:start + len(block)] = block
+            if progress is not None:
+                progress(min(num_layers, start + step), num_layers)
+        self.preloaded = preloaded
+
+    def memory_usage(self):
+        return image_nbytes(self.preloaded)
+
+    def evict(self, nbytes):
+        # One contiguous array, it can only be dropped as a whole
+        self.preloaded = None
+
+    def flush(self):
+        self.preloaded = None
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "crackle_viewer")
+HTTP_CACHE_MAX_BYTES = 2 * 1024**3
+# Size cap of the projections and mesh indices kept across sessions, CRACKLE_CACHE_MAX_BYTES=0 disables the cache
+DERIVED_CACHE_MAX_BYTES = int(os.environ.get("CRACKLE_CACHE_MAX_BYTES", 8 * 1024**3))
+
+class DiskCache:
+    """Size-bounded directory of cached blobs, the least recently used entries are evicted first."""
+    def __init__(self, folder, max_bytes, name="disk_cache"):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.name = name
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        # Oldest entry first, rebuilt from the file mtimes that get refreshed on every hit
+        entries = []
+        with os.scandir(folder) as files:
+            for entry in files:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        self.entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.total_bytes = sum(self.entries.values())
+
+    def file_name(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        name = self.file_name(key)
+        path = os.path.join(self.folder, name)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            profiler.count(self.name, False)
+            return None
+        profiler.count(self.name, True)
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        name = self.file_name(key)
+        path = os.path.join(self.folder, name)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Could not write cache entry: {e}")
+            return
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_name, old_size = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+                try:
+                    os.remove(os.path.join(self.folder, old_name))
+                except OSError:
+                    pass
+
+derived_cache = None
+
+def open_derived_cache():
+    """The shared cache of derived data, None if it is disabled or the cache folder is not writable."""
+    global derived_cache
+    if derived_cache is None and DERIVED_CACHE_MAX_BYTES > 0:
+        try:
+            derived_cache = DiskCache(os.path.join(CACHE_DIR, "derived"), DERIVED_CACHE_MAX_BYTES, name="derived_cache")
+        except OSError as e:
+            print(f"Derived data cache disabled: {e}")
+            return None
+    return derived_cache
+
+def file_identity(path):
+    """Path, size and mtime of a file, part of the cache keys of data derived from it."""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+def derived_cache_key(kind, identity, **params):
+    return json.dumps([kind, identity, params], sort_keys=True)
+
+def encode_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+def decode_array(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+class HttpConnectionPool:
+    """Keep-alive HTTP(S) connections to one host, shared between the reader threads."""
+    def __init__(self, url, max_connections=8, timeout=30):
+        parsed = urllib.parse.urlsplit(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.netloc
+        self.timeout = timeout
+        self.connections = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def new_connection(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def request(self, method, url, headers=None):
+        """Send a request on a pooled connection, returns the response and its body."""
+        path = urllib.parse.urlsplit(url)._replace(scheme="", netloc="").geturl()
+        with self.slots:
+            try:
+                connection = self.connections.get_nowait()
+            except queue.Empty:
+                connection = self.new_connection()
+            # A pooled connection may have been closed by the server, retry once on a fresh one
+            for attempt in range(2):
+                try:
+                    connection.request(method, path, headers=headers or {})
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    if attempt:
+                        raise
+                    connection = self.new_connection()
+            if response.will_close:
+                connection.close()
+            else:
+                self.connections.put(connection)
+        return response, data
+
+    def head(self, url):
+        """Response headers of a HEAD request for url."""
+        response, _ = self.request("HEAD", url)
+        if response.status != 200:
+            raise OSError(f"HEAD {url} failed: {response.status} {response.reason}")
+        return response.headers
+
+    def get(self, url, start=None, end=None):
+        """GET a url, or only the bytes [start, end) of it with a Range request."""
+        headers = {} if start is None else {"Range": f"bytes={start}-{end - 1}"}
+        response, data = self.request("GET", url, headers)
+        if response.status not in (200, 206):
+            raise OSError(f"GET {url} failed: {response.status} {response.reason}")
+        if start is not None and response.status == 200:
+            # The server ignored the Range header
+            data = data[start:end]
+        return data
+
+TIFF_FIELD_TYPES = {1: "B", 2: "B", 3: "H", 4: "I", 6: "b", 7: "B", 8: "h", 9: "i", 16: "Q", 17: "q"}
+
+def parse_tiff_header(read):
+    """
+    Parse the first IFD of a grayscale TIFF through read(start, end).
+    Returns the image geometry and the byte ranges of its strips or tiles.
+    """
+    head = read(0, 16)
+    byteorder = "<" if head[:2] == b"II" else ">"
+    magic = struct.unpack(byteorder + "H", head[2:4])[0]
+    bigtiff = magic == 43
+    if bigtiff:
+        ifd_offset = struct.unpack(byteorder + "Q", head[8:16])[0]
+        count_format, entry_format, entry_size, inline_size = "Q", "HHQ", 20, 8
+    else:
+        ifd_offset = struct.unpack(byteorder + "I", head[4:8])[0]
+        count_format, entry_format, entry_size, inline_size = "H", "HHI", 12, 4
+
+    count_size = struct.calcsize(count_format)
+    entry_count = struct.unpack(byteorder + count_format, read(ifd_offset, ifd_offset + count_size))[0]
+    entries = read(ifd_offset + count_size, ifd_offset + count_size + entry_count * entry_size)
+    tags = {}
+    for i in range(entry_count):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        tag, field_type, count = struct.unpack(byteorder + entry_format, entry[:struct.calcsize(byteorder + entry_format)])
+        value_format = TIFF_FIELD_TYPES.get(field_type)
+        if value_format is None:
+            continue
+        size = struct.calcsize(value_format) * count
+        value = entry[-inline_size:]
+        if size > inline_size:
+            offset = struct.unpack(byteorder + ("Q" if bigtiff else "I"), value)[0]
+            value = read(offset, offset + size)
+        if field_type == 7:
+            tags[tag] = bytes(value[:size])
+        else:
+            tags[tag] = struct.unpack(byteorder + value_format * count, value[:size])
+
+    width, height = tags[256][0], tags[257][0]
+    info = {
+        "byteorder": byteorder,
+        "width": width,
+        "height": height,
+        "bits": tags.get(258, (1,))[0],
+        "compression": tags.get(259, (1,))[0],
+        "photometric": tags.get(262, (1,))[0],
+        "samples": tags.get(277, (1,))[0],
+        "predictor": tags.get(317, (1,))[0],
+        "sample_format": tags.get(339, (1,))[0],
+        "jpeg_tables": tags.get(347),
+    }
+    info["tiled"] = 322 in tags
+    if info["tiled"]:
+        info["block"] = (tags[322][0], tags[323][0])
+        info["offsets"], info["bytecounts"] = tags[324], tags[325]
+    else:
+        info["block"] = (width, tags.get(278, (height,))[0])
+        info["offsets"], info["bytecounts"] = tags[273], tags[279]
+    return info
+
+def decode_tiff_block(info, data, width, height):
+    """Decode one strip or tile by wrapping it in a minimal single strip TIFF that PIL can open."""
+    byteorder = info["byteorder"]
+    if info["compression"] == 1 and info["bits"] in (8, 16) and info["sample_format"] == 1 and info["photometric"] == 1:
+        # Uncompressed samples are read directly, without the cost of opening a TIFF per block
+        dtype = np.dtype(f"{byteorder}u{info['bits'] // 8}")
+        return np.frombuffer(data, dtype=dtype, count=width * height).reshape(height, width).astype(dtype.newbyteorder("="))
+    fields = [
+        (256, 4, [width]), (257, 4, [height]), (258, 3, [info["bits"]]), (259, 3, [info["compression"]]),
+        (262, 3, [info["photometric"]]), (273, 4, [0]), (277, 3, [1]), (278, 4, [height]),
+        (279, 4, [len(data)]), (317, 3, [info["predictor"]]), (339, 3, [info["sample_format"]]),
+    ]
+    if info["jpeg_tables"]:
+        fields.append((347, 7, list(info["jpeg_tables"])))
+    data_offset = 8 + 2 + 12 * len(fields) + 4
+    extra = b""
+    ifd = struct.pack(byteorder + "H", len(fields))
+    for tag, field_type, values in fields:
+        if tag == 273:
+            values = [data_offset]
+        value = struct.pack(byteorder + TIFF_FIELD_TYPES[field_type] * len(values), *values)
+        if len(value) > 4:
+            ifd += struct.pack(byteorder + "HHII", tag, field_type, len(values), data_offset + len(data) + len(extra))
+            extra += value
+        else:
+            ifd += struct.pack(byteorder + "HHI", tag, field_type, len(values)) + value.ljust(4, b"\0")
+    header = (b"II*\0" if byteorder == "<" else b"MM\0*") + struct.pack(byteorder + "I", 8)
+    with Image.open(io.BytesIO(header + ifd + struct.pack(byteorder + "I", 0) + data + extra)) as image:
+        return np.array(image)
+
+class TiledTiffWriter:
+    """
+    Streams RGB (or grayscale with samples=1) tiles into a tiled BigTIFF, one IFD per resolution level.
+    Levels after the first are marked as reduced resolution images, which makes the file a pyramidal TIFF.
+    Tiles are written as they arrive and only their offsets are kept in memory.
+    """
+    def __init__(self, path, tile_size=512, compression="deflate", samples=3):
+        self.file = open(path, "wb")
+        self.tile_size = tile_size
+        self.samples = samples
+        self.compression = compression
+        self.levels = []
+        # Header with the first IFD offset patched in close()
+        self.file.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+
+    def encode_tile(self, tile):
+        """Pad a tile to the full tile size and compress it, safe to call from worker threads."""
+        if self.samples == 1:
+            data = np.zeros((self.tile_size, self.tile_size), dtype=np.uint8)
+            data[:tile.shape[0], :tile.shape[1]] = tile
+        else:
+            data = np.zeros((self.tile_size, self.tile_size, self.samples), dtype=np.uint8)
+            data[:tile.shape[0], :tile.shape[1]] = tile[:, :, :self.samples]
+        data = data.tobytes()
+        return zlib.compress(data, 6) if self.compression == "deflate" else data
+
+    def begin_level(self, width, height):
+        self.levels.append({"width": width, "height": height, "offsets": [], "bytecounts": []})
+
+    def write_tile(self, data):
+        """Append the next encoded tile of the current level, tiles go in row major order."""
+        level = self.levels[-1]
+        level["offsets"].append(self.file.tell())
+        level["bytecounts"].append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        """Write the IFDs of all levels after the tile data and link them from the header."""
+        next_ifd_position = 8
+        for index, level in enumerate(self.levels):
+            fields = [
+                (254, 4, [1 if index else 0]), (256, 4, [level["width"]]), (257, 4, [level["height"]]),
+                (258, 3, [8] * self.samples), (259, 3, [8 if self.compression == "deflate" else 1]),
+                (262, 3, [2 if self.samples == 3 else 1]), (277, 3, [self.samples]), (284, 3, [1]), (322, 4, [self.tile_size]), (323, 4, [self.tile_size]),
+                (324, 16, level["offsets"]), (325, 16, level["bytecounts"]),
+            ]
+            # Values that do not fit in an entry go before the IFD
+            entries = []
+            for tag, field_type, values in fields:
+                value = struct.pack("<" + TIFF_FIELD_TYPES[field_type] * len(values), *values)
+                if len(value) > 8:
+                    offset = self.file.tell()
+                    self.file.write(value)
+                    value = struct.pack("<Q", offset)
+                entries.append(struct.pack("<HHQ", tag, field_type, len(values)) + value.ljust(8, b"\0"))
+            if self.file.tell() % 2:
+                self.file.write(b"\0")
+            ifd_offset = self.file.tell()
+            self.file.write(struct.pack("<Q", len(entries)) + b"".join(entries))
+            link_position = self.file.tell()
+            self.file.write(struct.pack("<Q", 0))
+            self.file.seek(next_ifd_position)
+            self.file.write(struct.pack("<Q", ifd_offset))
+            self.file.seek(0, os.SEEK_END)
+            next_ifd_position = link_position
+        self.file.close()
+
+class HttpTiffSource:
+    """
+    Surface volume served over HTTP as one TIFF per layer.
+    Only the strips or tiles covering the requested window are fetched, with Range requests
+    over pooled keep-alive connections, and the fetched byte ranges are kept in a local disk cache.
+    """
+    windowed = True
+
+    def __init__(self, url, cache=None, max_connections=8):
+        self.url = url
+        self.folder = url.rstrip("/")
+        self.pool = HttpConnectionPool(url, max_connections=max_connections)
+        self.cache = cache if cache is not None else DiskCache(os.path.join(CACHE_DIR, "http"), HTTP_CACHE_MAX_BYTES)
+        self.readers = ThreadPoolExecutor(max_workers=max_connections)
+        self.num_levels = 1
+        self.headers = {}
+        self.validators = {}
+        self.headers_lock = threading.Lock()
+        self.slice_codec = SLICE_CODEC
+        self.preloaded_images = SliceCache(None)
+        self.layer_names = self.list_layers()
+
+    def list_layers(self):
+        """Find the layer TIFFs in layers/ or surface_volume/, from a published manifest or the server's index page."""
+        for folder in ("layers", "surface_volume"):
+            url = f"{self.folder}/{folder}/"
+            try:
+                manifest = json.loads(self.pool.get(url + VOLUME_MANIFEST_NAME))
+                names = [info["name"] for info in manifest["slices"]]
+            except (OSError, ValueError, KeyError):
+                try:
+                    index = self.pool.get(url).decode("utf-8", "replace")
+                except OSError:
+                    continue
+                names = {urllib.parse.unquote(href).rsplit("/", 1)[-1] for href in re.findall(r'href="([^"?#]+)"', index)}
+                names = sorted((name for name in names if name.endswith(".tif")), key=natural_sort_key)
+            if names:
+                self.folder = url.rstrip("/")
+                return [url + urllib.parse.quote(name) for name in names]
+        return []
+
+    def validator(self, url):
+        """ETag or Last-Modified of url, asked once per session so that cached ranges of a rewritten file are not reused."""
+        with self.headers_lock:
+            validator = self.validators.get(url)
+        if validator is None:
+            try:
+                headers = self.pool.head(url)
+                validator = headers.get("ETag") or headers.get("Last-Modified") or headers.get("Content-Length") or ""
+            except OSError:
+                # Servers without HEAD support, the cached ranges are only keyed by the url
+                validator = ""
+            with self.headers_lock:
+                self.validators[url] = validator
+        return validator
+
+    def read_range(self, url, start, end):
+        key = f"{url}:{self.validator(url)}:{start}-{end}"
+        data = self.cache.get(key)
+        if data is None:
+            data = self.pool.get(url, start, end)
+            self.cache.put(key, data)
+        return data
+
+    def header(self, index):
+        url = self.layer_names[index]
+        with self.headers_lock:
+            info = self.headers.get(url)
+        if info is None:
+            # The IFD is usually at the start of the file, one request covers it
+            head = self.read_range(url, 0, 65536)
+            info = parse_tiff_header(lambda start, end: head[start:end] if end <= len(head) else self.read_range(url, start, end))
+            with self.headers_lock:
+                self.headers[url] = info
+        return info
+
+    def shape(self, level=0):
+        info = self.header(0)
+        return info["height"], info["width"]
+
+    def reopen(self):
+        return HttpTiffSource, (self.url,)
+
+    def load_slice(self, index, window=None):
+        image = self.preloaded_images.get(index, window)
+        if image is not None:
+            return image
+
+        url = self.layer_names[index]
+        info = self.header(index)
+        y0, y1, x0, x1 = window if window is not None else (0, info["height"], 0, info["width"])
+        block_width, block_height = info["block"]
+        blocks_across = math.ceil(info["width"] / block_width)
+        blocks = [(by, bx) for by in range(y0 // block_height, math.ceil(y1 / block_height))
+                  for bx in range(x0 // block_width, math.ceil(x1 / block_width))]
+
+        def fetch(block):
+            by, bx = block
+            i = by * blocks_across + bx
+            offset, bytecount = info["offsets"][i], info["bytecounts"][i]
+            # Tiles are padded to full size, the last strip only holds the remaining rows
+            rows = block_height if info["tiled"] else min(block_height, info["height"] - by * block_height)
+            return decode_tiff_block(info, self.read_range(url, offset, offset + bytecount), block_width, rows)
+
+        image = None
+        for (by, bx), block in zip(blocks, self.readers.map(fetch, blocks)):
+            if image is None:
+                image = np.zeros((y1 - y0, x1 - x0), dtype=block.dtype)
+            # Paste the part of the block that falls inside the window
+            top, left = by * block_height, bx * block_width
+            sy0, sx0 = max(y0, top), max(x0, left)
+            sy1, sx1 = min(y1, top + block.shape[0]), min(x1, left + block.shape[1])
+            image[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = block[sy0 - top:sy1 - top, sx0 - left:sx1 - left]
+        if image is None:
+            image = np.zeros((max(0, y1 - y0), max(0, x1 - x0)), dtype=np.uint8)
+        return normalize_slice(image)
+
+    def read(self, start, end, window=None, level=0):
+        """Read layers [start, end) as a (layers, height, width) array, window is (y0, y1, x0, x1)."""
+        from tqdm import tqdm
+        return np.stack([self.load_slice(i, window) for i in tqdm(range(start, end))])
+
+    def preload(self, progress=None):
+        from tqdm import tqdm
+        self.preloaded_images = SliceCache(None)
+        preloaded_images = SliceCache(self.slice_codec)
+        for index in tqdm(range(len(self.layer_names))):
+            image = compress_slice(self.load_slice(index), preloaded_images.codec)
+            if not memory.reserve(image.nbytes, MEMORY_PRIORITY_PREFETCH):
+                print(f"Memory budget reached, preloaded {len(preloaded_images)} of {len(self.layer_names)} layers")
+                break
+            preloaded_images.put(index, image)
+            self.preloaded_images = preloaded_images
+            if progress is not None:
+                progress(index + 1, len(self.layer_names))
+
+    def memory_usage(self):
+        return self.preloaded_images.memory_usage()
+
+    def evict(self, nbytes):
+        """Drop preloaded layers, last loaded first, until nbytes are freed."""
+        self.preloaded_images.evict(nbytes)
+
+    def flush(self):
+        self.preloaded_images = SliceCache(None)
+
+def open_volume_source(path):
+    """Open the surface volume of a segment folder or url, a Zarr store or a folder of layer images."""
+    if path.startswith(("http://", "https://")):
+        return HttpTiffSource(path)
+    zarr_path = find_zarr_volume(path)
+    if zarr_path:
+        return ZarrVolumeSource(zarr_path)
+    # Create surface volume dir
+    surface_volume_path = os.path.join(path, "layers")
+    if not os.path.exists(surface_volume_path):
+        surface_volume_path = os.path.join(path, "surface_volume")
+    print(surface_volume_path)
+    # Cached file list and slice headers, only rebuilt when the folder changed
+    return TiffStackSource(surface_volume_path, open_volume_manifest(surface_volume_path))
+
+def load_uv_mesh(folder, job=None):
+    """Load the first obj file with uv coordinates in the folder, returns (mesh, vertices, kd_tree, triangle_data) or None."""
+    # Load the obj file(s) from the folder
+    obj_files = sorted(glob.glob(os.path.join(folder, f'*.obj')))
+    # filter the obj files with uv coordinates. load and check
+    cache = open_derived_cache()
+    for obj_file in obj_files:
+        if job is not None:
+            job.check()
+        cache_key = derived_cache_key("uv_mesh", file_identity(obj_file))
+        data = cache.get(cache_key) if cache is not None else None
+        if data is not None:
+            # Vertices and uv index of an obj file seen before, open3d is not needed
+            result = pickle.loads(data)
+            if result is not None:
+                print(f"Loaded obj file index from cache: {obj_file}")
+                return (None,) + result
+            continue
+        # open3d open
+        import open3d as o3d
+        mesh = o3d.io.read_triangle_mesh(obj_file)
+        result = None
+        if len(mesh.triangle_uvs) > 0:
+            print(f"Loaded obj file: {obj_file}")
+            print("Preprocessing obj transformation ... ")
+            kd_tree, triangle_data = preprocess_uv_triangles(mesh)
+            print("Preprocessing obj transformation done.")
+            result = (np.array(mesh.vertices), kd_tree, triangle_data)
+        if cache is not None:
+            cache.put(cache_key, pickle.dumps(result))
+        if result is not None:
+            return (mesh,) + result
+    return None
+
 def compute_uv_bounding_box(uv_vertices):
     """Compute the bounding box of a triangle in UV space."""
     min_uv = np.min(uv_vertices, axis=0)
@@ -62,6 +1356,7 @@ def preprocess_uv_triangles(mesh):
     
     print(f"UV bounding box: {min_uv_} - {max_uv_}")
     # Create KDTree for the bounding boxes' centers
+    from scipy.spatial import KDTree
     kd_tree = KDTree(bounding_boxes)
     return kd_tree, triangle_data
 
@@ -108,9 +1403,2021 @@ def find_uv_triangle(mesh_vertices, uv_point, kd_tree, triangle_data):
     # If no triangle contains the uv point
     return None
 
+def build_mesh_index_3d(mesh_vertices, triangle_data):
+    """Spatial index for the reverse lookup (3D point -> UV): a KDTree over the 3D centroids of the triangles, with their corners and UVs."""
+    from scipy.spatial import cKDTree
+    triangles = np.array([triangle for triangle, _, _, _ in triangle_data], dtype=np.int64)
+    corners = np.asarray(mesh_vertices, dtype=np.float64)[triangles]
+    uvs = np.array([uv_vertices for _, uv_vertices, _, _ in triangle_data], dtype=np.float64)
+    return {"tree": cKDTree(corners.mean(axis=1)), "corners": corners, "uvs": uvs}
+
+def closest_triangle_points(points, a, b, c):
+    """
+    Barycentric coordinates (..., 3) of the points of triangles abc closest to points, and their distances.
+    The projection onto the plane is used if it falls inside the triangle, else the closest point of the edges.
+    """
+    v0, v1, v2 = b - a, c - a, points - a
+    d00, d01, d11 = (v0 * v0).sum(-1), (v0 * v1).sum(-1), (v1 * v1).sum(-1)
+    d20, d21 = (v2 * v0).sum(-1), (v2 * v1).sum(-1)
+    denom = d00 * d11 - d01 * d01
+    # Degenerate triangles only get their edges
+    safe = np.where(denom == 0, 1.0, denom)
+    v = (d11 * d20 - d01 * d21) / safe
+    w = (d00 * d21 - d01 * d20) / safe
+    inside = (denom != 0) & (v >= 0) & (w >= 0) & (v + w <= 1)
+    candidates = [np.stack([1.0 - v - w, v, w], axis=-1)]
+    for start, end, i, j in ((a, b, 0, 1), (b, c, 1, 2), (c, a, 2, 0)):
+        edge = end - start
+        length = (edge * edge).sum(-1)
+        t = np.clip(((points - start) * edge).sum(-1) / np.where(length == 0, 1.0, length), 0.0, 1.0)
+        weights = np.zeros(t.shape + (3,))
+        weights[..., i], weights[..., j] = 1.0 - t, t
+        candidates.append(weights)
+    candidates = np.stack(candidates)
+    corners = np.stack([a, b, c], axis=-2)
+    distances = np.linalg.norm(np.einsum("n...k,...kd->n...d", candidates, corners) - points, axis=-1)
+    distances[0][~inside] = np.inf
+    best = distances.argmin(axis=0)
+    return np.take_along_axis(candidates, best[None, ..., None], axis=0)[0], np.take_along_axis(distances, best[None], axis=0)[0]
+
+def find_3d_points_uv(points, mesh_index, k=16):
+    """
+    Reverse lookup of find_uv_triangle for (n, 3) points: the closest point on the k triangles with the nearest
+    centroids, vectorized over all points. Returns the (n, 2) UV coordinates and the (n,) distances to the mesh.
+    """
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    k = min(k, len(mesh_index["uvs"]))
+    _, idxs = mesh_index["tree"].query(points, k=k)
+    idxs = idxs.reshape(len(points), k)
+    corners = mesh_index["corners"][idxs]
+    weights, distances = closest_triangle_points(points[:, None, :], corners[..., 0, :], corners[..., 1, :], corners[..., 2, :])
+    best = distances.argmin(axis=1)
+    rows = np.arange(len(points))
+    uv = np.einsum("nk,nkd->nd", weights[rows, best], mesh_index["uvs"][idxs[rows, best]])
+    return uv, distances[rows, best]
+
+def uv_to_image_points(uv, width, height):
+    """Image pixel (x, y) of UV coordinates, the inverse of the hover lookup's uv_point."""
+    return np.stack([uv[:, 0] * width, (1.0 - uv[:, 1]) * height], axis=1)
+
+def parse_points(text):
+    """(n, 3) points from text with one x y z point per line (or separated by ;), other columns are ignored."""
+    points = []
+    for line in re.split(r"[;\n]", text):
+        values = re.findall(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?", line)
+        if len(values) >= 3:
+            points.append([float(value) for value in values[:3]])
+    return np.array(points, dtype=np.float64).reshape(-1, 3)
+
+def canvas_tiles(width, height, tile_size):
+    """Split a canvas into (x0, y0, width, height) tiles of at most tile_size pixels."""
+    return [(x0, y0, min(tile_size, width - x0), min(tile_size, height - y0))
+            for y0 in range(0, height, tile_size)
+            for x0 in range(0, width, tile_size)]
+
+# Placement of a projection that covers the whole volume at full resolution
+FULL_RESOLUTION = (1.0, 1.0, 0, 0)
+
+def tile_affine(affine_inv, x0, y0):
+    """Shift the inverse canvas affine so that it maps a tile starting at (x0, y0)."""
+    a, b, c, d, e, f = affine_inv
+    return (a, b, a * x0 + b * y0 + c, d, e, d * x0 + e * y0 + f)
+
+def scale_affine(affine, scale_x, scale_y, offset_x=0.0, offset_y=0.0):
+    """
+    Map an inverse affine into the pixel grid of an image downsampled by (scale_x, scale_y)
+    whose top left pixel is at (offset_x, offset_y) of the full resolution.
+    """
+    a, b, c, d, e, f = affine
+    return (a / scale_x, b / scale_x, (c - offset_x) / scale_x, d / scale_y, e / scale_y, (f - offset_y) / scale_y)
+
+def colorize_overlay(overlay_transformed, color, brightness, opacity):
+    """Turn a transformed grayscale overlay into a colored RGBA layer ready to be pasted."""
+    # Ensure the image is RGBA (has an alpha channel)
+    if overlay_transformed.mode != 'RGBA':
+        overlay_transformed = overlay_transformed.convert('RGBA')
+
+    grayscale = overlay_transformed.convert("L")
+    # Scale the RGB values based on the brightness slider
+    if brightness is not None:
+        grayscale = ImageEnhance.Brightness(grayscale).enhance(brightness)
+    color_image = Image.new('RGB', overlay_transformed.size, color)
+    final_overlay = Image.composite(color_image, overlay_transformed, grayscale)
+
+    # Adjust the opacity based on the value of the slider
+    alpha = ImageEnhance.Brightness(grayscale).enhance(opacity)
+    final_overlay.putalpha(alpha)
+    return final_overlay
+
+def render_tile(base_image, overlays, affine_inv, tile, resample, base_scale=(1.0, 1.0)):
+    """
+    Render one canvas tile: transform the base image and composite the overlays on top.
+    overlays is a list of (image, scale, color, brightness, opacity) tuples drawn in order.
+    base_scale and the overlay scales are the downsampling of the images that are pyramid levels,
+    they can also carry the (x, y) offset of images that only cover a window of the volume.
+    """
+    x0, y0, width, height = tile
+    affine = tile_affine(affine_inv, x0, y0)
+    with profiler.span("base_transform"):
+        dst = base_image.transform((width, height), Image.Transform.AFFINE, scale_affine(affine, *base_scale), resample)
+        if dst.mode != 'RGBA':
+            dst = dst.convert('RGBA')
+
+    for i, (overlay, overlay_scale, color, brightness, opacity) in enumerate(overlays):
+        with profiler.span(f"overlay{i}_transform"):
+            overlay_transformed = overlay.transform((width, height), Image.Transform.AFFINE, scale_affine(affine, *overlay_scale), resample)
+        with profiler.span(f"overlay{i}_composite"):
+            final_overlay = colorize_overlay(overlay_transformed, color, brightness, opacity)
+            dst.paste(final_overlay, (0, 0), final_overlay)
+    return dst
+
+class PILRenderBackend:
+    """Transforms and composites canvas tiles with PIL.Image.transform."""
+    name = "PIL"
+
+    def render_tile(self, base_image, overlays, affine_inv, tile, resample, base_scale=(1.0, 1.0)):
+        return render_tile(base_image, overlays, affine_inv, tile, resample, base_scale)
+
+class OpenCVRenderBackend:
+    """Transforms canvas tiles with cv2.warpAffine and composites them with NumPy."""
+    name = "OpenCV"
+
+    def warp(self, image, affine, size, interpolation):
+        """Warp only the source region the tile maps to, so a tile never converts the full image."""
+        import cv2
+        width, height = size
+        a, b, c, d, e, f = affine
+        xs = [a * x + b * y + c for x in (0, width) for y in (0, height)]
+        ys = [d * x + e * y + f for x in (0, width) for y in (0, height)]
+        # Keep a margin so that the interpolation kernel sees the real neighbours of the crop
+        left, top = max(0, math.floor(min(xs)) - 2), max(0, math.floor(min(ys)) - 2)
+        right, bottom = min(image.width, math.ceil(max(xs)) + 2), min(image.height, math.ceil(max(ys)) + 2)
+        if right <= left or bottom <= top:
+            return np.zeros((height, width), dtype=np.uint8)
+
+        src = image.crop((left, top, right, bottom))
+        if src.mode != "L":
+            src = src.convert("L")
+        src = np.asarray(src)
+        # PIL samples at pixel centers, OpenCV at integer coordinates. Nearest rounds where PIL floors,
+        # the small bias keeps exact pixel borders on the same side as PIL despite OpenCV's fixed point math.
+        shift = 0.5 if interpolation != cv2.INTER_NEAREST else 0.5 - 1.0 / 2048
+        matrix = np.array([
+            [a, b, c + 0.5 * (a + b) - shift - left],
+            [d, e, f + 0.5 * (d + e) - shift - top],
+        ])
+        flags = cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP
+        if interpolation == cv2.INTER_NEAREST:
+            return cv2.warpAffine(src, matrix, (width, height), flags=flags, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        # PIL interpolates with clamped neighbours and only blanks samples that fall outside the image
+        warped = cv2.warpAffine(src, matrix, (width, height), flags=interpolation | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        inside = cv2.warpAffine(np.ones_like(src), matrix, (width, height), flags=flags, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        return warped * inside
+
+    def render_tile(self, base_image, overlays, affine_inv, tile, resample, base_scale=(1.0, 1.0)):
+        import cv2
+        x0, y0, width, height = tile
+        affine = tile_affine(affine_inv, x0, y0)
+        interpolation = {
+            Image.Resampling.NEAREST: cv2.INTER_NEAREST,
+            Image.Resampling.BILINEAR: cv2.INTER_LINEAR,
+            Image.Resampling.BICUBIC: cv2.INTER_CUBIC,
+        }[resample]
+
+        with profiler.span("base_transform"):
+            base = self.warp(base_image, scale_affine(affine, *base_scale), (width, height), interpolation)
+            if not overlays:
+                return Image.fromarray(base).convert("RGBA")
+
+        # Channel planes, the overlays are blended in place: dst += weight * (src - dst)
+        dst = np.empty((4, height, width), dtype=np.float32)
+        dst[:3] = base
+        dst[3] = 255.0
+        for i, (overlay, overlay_scale, color, brightness, opacity) in enumerate(overlays):
+            with profiler.span(f"overlay{i}_transform"):
+                overlay_transformed = self.warp(overlay, scale_affine(affine, *overlay_scale), (width, height), interpolation).astype(np.float32)
+            composite_start = time.perf_counter()
+            grayscale = overlay_transformed
+            if brightness is not None:
+                grayscale = np.minimum(np.rint(grayscale * brightness), 255)
+            alpha = np.minimum(np.rint(grayscale * opacity), 255)
+            if not alpha.any():
+                profiler.add(f"overlay{i}_composite", composite_start, time.perf_counter())
+                continue
+            # Same rules as colorize_overlay followed by a masked paste
+            mask = grayscale * (1.0 / 255.0)
+            weight = alpha * (1.0 / 255.0)
+            for channel, value in enumerate(ImageColor.getrgb(color)[:3]):
+                colored = overlay_transformed + mask * (value - overlay_transformed)
+                dst[channel] += weight * (colored - dst[channel])
+            dst[3] += weight * (alpha - dst[3])
+            profiler.add(f"overlay{i}_composite", composite_start, time.perf_counter())
+
+        return Image.fromarray(cv2.merge([channel for channel in np.rint(dst).astype(np.uint8)]), "RGBA")
+
+def benchmark_render_backends(backends, resample, tile_size=256, canvas_size=512, repeats=3):
+    """Time each backend on a synthetic rotated and zoomed frame. Returns (seconds, backend) sorted fastest first."""
+    rng = np.random.default_rng(0)
+    base_image = Image.fromarray(rng.integers(0, 256, (canvas_size, canvas_size), dtype=np.uint8))
+    overlay = Image.fromarray(rng.integers(0, 256, (canvas_size, canvas_size), dtype=np.uint8))
+    overlays = [(overlay, (1.0, 1.0), 'red', 1.0, 0.4), (overlay, (1.0, 1.0), 'white', None, 1.0)]
+    angle = math.pi / 7
+    affine_inv = (0.7 * math.cos(angle), -0.7 * math.sin(angle), 100.0, 0.7 * math.sin(angle), 0.7 * math.cos(angle), 20.0)
+    tiles = canvas_tiles(canvas_size, canvas_size, tile_size)
+
+    timings = []
+    for backend in backends:
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for tile in tiles:
+                backend.render_tile(base_image, overlays, affine_inv, tile, resample)
+            best = min(best, time.perf_counter() - start)
+        timings.append((best, backend))
+    timings.sort(key=lambda timing: timing[0])
+    return timings
+
+RESAMPLING_METHODS = {
+    "NEAREST": Image.Resampling.NEAREST,
+    "BILINEAR": Image.Resampling.BILINEAR,
+    "BICUBIC": Image.Resampling.BICUBIC,
+}
+
+def affine_translate(mat_affine, offset_x, offset_y):
+    mat = np.eye(3)
+    mat[0, 2] = float(offset_x)
+    mat[1, 2] = float(offset_y)
+    return np.dot(mat, mat_affine)
+
+def affine_scale(mat_affine, scale):
+    mat = np.eye(3)
+    mat[0, 0] = scale
+    mat[1, 1] = scale
+
+    mat_affine = np.dot(mat, mat_affine)
+    # Correct small errors in the affine matrix
+    mat_affine[1, 1] = mat_affine[0, 0]
+    mat_affine[1, 0] = -mat_affine[0, 1]
+    return mat_affine
+
+def affine_rotate(mat_affine, deg):
+    mat = np.eye(3)
+    mat[0, 0] = math.cos(math.pi * deg / 180)
+    mat[1, 0] = math.sin(math.pi * deg / 180)
+    mat[0, 1] = -mat[1, 0]
+    mat[1, 1] = mat[0, 0]
+    return np.dot(mat, mat_affine)
+
+def affine_scale_factor(mat_affine):
+    """Canvas pixels per image pixel of a rotation and uniform scale affine."""
+    return (mat_affine[0, 0]**2 + mat_affine[0, 1]**2)**0.5
+
+def zoom_fit_affine(image_width, image_height, canvas_width, canvas_height):
+    """Affine that centers the whole image on the canvas, None if either size is empty."""
+    if (image_width * image_height <= 0) or (canvas_width * canvas_height <= 0):
+        return None
+
+    scale = 1.0
+    offsetx = 0.0
+    offsety = 0.0
+
+    if (canvas_width * image_height) > (image_width * canvas_height):
+        scale = canvas_height / image_height
+        offsetx = (canvas_width - image_width * scale) / 2
+    else:
+        scale = canvas_width / image_width
+        offsety = (canvas_height - image_height * scale) / 2
+
+    return affine_translate(affine_scale(np.eye(3), scale), offsetx, offsety)
+
+def canvas_to_image(mat_affine, x, y):
+    mat_inv = np.linalg.inv(mat_affine)
+    return np.dot(mat_inv, (x, y, 1.))
+
+def create_ruler(img_width, img_height, width, height, unit_size, min_unit_length=15):
+    """
+    Create a ruler image with the specified width, height, and unit size.
+    """
+    unit_size = int(unit_size)
+    unit_size = max(1, unit_size)  # Ensure unit size is at least 1
+    ruler = Image.new('RGBA', (img_width, img_height), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(ruler)
+
+    unit_range = range(height, width, unit_size)
+    if len(unit_range) < min_unit_length:
+        unit_range = [i for i in range(height, height + min_unit_length*unit_size, unit_size)]
+
+    # Draw ruler lines and numbers
+    for i in unit_range:
+        line_height = height // 2 if (i - height) % (5 * unit_size) else height
+        draw.line([(i + height, 0), (i + height, line_height)], fill="white", width=1)
+        draw.text((i + height, line_height), str((i - height) // unit_size), fill="white")
+
+    # Draw ruler lines and numbers
+    for i in unit_range:
+        line_height = height // 2 if (i - height) % (5 * unit_size) else height
+        draw.line([(0, i + height), (line_height, i + height)], fill="white", width=1)
+        draw.text((line_height, i + height), str((i - height) // unit_size), fill="white")
+
+    return ruler
+
+def flood_fill_image(image, overlay, start_coord, threshold, max_steps, is_active=lambda: True, on_progress=None):
+    """
+    Paint into the overlay the pixels connected to start_coord whose value in image is within threshold
+    of the start pixel, at most max_steps of them. Returns the number of painted pixels.
+    """
+    invalidate_overlay_pyramid(overlay)
+    pixel_queue = deque([start_coord])
+    target_color = int(image.getpixel(start_coord))
+    visited = set()
+    counter = 0
+    if overlay.mode == 'RGB':
+        # Convert to a tuple of integers for RGB
+        value = (int(255), int(255), int(255))
+    else:
+        value = int(255)
+    while is_active() and pixel_queue and counter < max_steps:
+        cx, cy = pixel_queue.popleft()
+
+        if (cx, cy) in visited or not (0 <= cx < image.width and 0 <= cy < image.height):
+            continue
+
+        visited.add((cx, cy))
+
+
+        pixel_value = int(image.getpixel((cx,cy)))
+
+        if abs(pixel_value - target_color) <= threshold:
+            try:
+                overlay.putpixel((int(cx), int(cy)), value)
+            except TypeError as e:
+                print(f"Error: {e}, Coordinates: ({cx}, {cy}), Value: {value}, Mode: {overlay.mode}")
+            counter += 1
+            for dx in [-1, 0, 1]:
+                for dy in [-1, 0, 1]:
+                    if dx == 0 and dy == 0:
+                        continue
+                    pixel_queue.append((cx + dx, cy + dy))
+
+        if counter % 10 == 0 and on_progress is not None:
+            on_progress()
+    return counter
+
+# The 8-bit volume read for the fill, the visited and region states and the returned mask
+FLOOD_FILL_BYTES_PER_VOXEL = 3
+
+def flood_fill_volume(volume, seed, threshold, max_voxels, is_active=lambda: True, on_progress=None):
+    """
+    Grow the 26-connected region of the (layers, height, width) volume around the seed (z, y, x) whose values are
+    within threshold of the seed value, at most max_voxels of them in breadth first order. Returns a boolean mask.
+    The growth is vectorized per frontier ring. Besides the volume and the returned mask, the only full size
+    array is one padded byte per voxel that holds both the unvisited voxels and the region, so the memory grows
+    with the whole volume and not with the region: reserve FLOOD_FILL_BYTES_PER_VOXEL per voxel for it.
+    """
+    target = int(volume[seed])
+    shape = tuple(n + 2 for n in volume.shape)
+    # 1 for unvisited voxels within the threshold, 2 for the region, 0 elsewhere.
+    # Padded with a border of 0 so that neighbour indices never wrap around.
+    voxels = np.zeros(shape, dtype=np.uint8)
+    for z in range(volume.shape[0]):
+        voxels[z + 1, 1:-1, 1:-1] = np.abs(volume[z].astype(np.int16) - target) <= threshold
+    voxels = voxels.ravel()
+
+    steps = np.array([(dz, dy, dx) for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dz or dy or dx])
+    offsets = steps @ np.array([shape[1] * shape[2], shape[2], 1])
+    start = np.ravel_multi_index(tuple(s + 1 for s in seed), shape)
+    voxels[start] = 2
+    frontier = np.array([start], dtype=np.int64)
+    count = 1
+    while frontier.size and count < max_voxels and is_active():
+        ring = []
+        for offset in offsets:
+            # Adding the new voxels to the region right away keeps the ring free of duplicates without sorting
+            neighbours = frontier + offset
+            neighbours = neighbours[voxels[neighbours] == 1]
+            voxels[neighbours] = 2
+            ring.append(neighbours)
+        frontier = np.concatenate(ring)
+        if frontier.size > max_voxels - count:
+            # The part of the last ring past max_voxels is left out of the region
+            voxels[frontier[max_voxels - count:]] = 1
+            frontier = frontier[:max_voxels - count]
+        count += frontier.size
+        if on_progress is not None:
+            on_progress(count)
+    return voxels.reshape(shape)[1:-1, 1:-1, 1:-1] == 2
+
+def paint_mask(overlay, mask, offset):
+    """Set the overlay pixels under the 2D mask, placed at the (x, y) offset, to white."""
+    x0, y0 = offset
+    height, width = mask.shape
+    invalidate_overlay_pyramid(overlay)
+    patch = np.array(overlay.crop((x0, y0, x0 + width, y0 + height)))
+    patch[mask] = 255
+    overlay.paste(Image.fromarray(patch, overlay.mode), (x0, y0))
+
+# Overlay values written by the brush modes
+BRUSH_VALUES = {"paint": 255, "erase": 0}
+
+class Brush:
+    """
+    Rasterizes strokes into an "L" overlay with NumPy. A precomputed disk mask is stamped along the segment
+    between two motion events at a fraction of the radius apart, so fast strokes with large brushes stay
+    continuous, and only the bounding box of the segment is read and written back.
+    """
+    def __init__(self):
+        self.disks = {}
+
+    def disk(self, width):
+        if width not in self.disks:
+            offsets = np.arange(width) - (width - 1) / 2.0
+            self.disks[width] = offsets[:, None] ** 2 + offsets[None, :] ** 2 <= (width / 2.0) ** 2
+        return self.disks[width]
+
+    def stroke(self, overlay, start, end, width, mode="paint"):
+        """Draw a round-capped stroke from start to end (x, y) and return the changed (x0, y0, x1, y1) box, None if it is outside."""
+        width = max(1, int(round(width)))
+        disk = self.disk(width)
+        (sx, sy), (ex, ey) = start, end
+        steps = max(1, int(math.ceil(math.hypot(ex - sx, ey - sy) / max(1.0, width / 8.0))))
+        t = np.linspace(0.0, 1.0, steps + 1)
+        # Top left corners of the stamps
+        xs = np.round(sx + t * (ex - sx) - (width - 1) / 2.0).astype(np.int64)
+        ys = np.round(sy + t * (ey - sy) - (width - 1) / 2.0).astype(np.int64)
+        x0, y0 = max(0, int(xs.min())), max(0, int(ys.min()))
+        x1, y1 = min(overlay.width, int(xs.max()) + width), min(overlay.height, int(ys.max()) + width)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        # Stamp into a mask padded by the brush size, so stamps over the image border need no clipping
+        left, top = int(xs.min()), int(ys.min())
+        mask = np.zeros((int(ys.max()) - top + width, int(xs.max()) - left + width), dtype=bool)
+        for x, y in set(zip((xs - left).tolist(), (ys - top).tolist())):
+            mask[y:y + width, x:x + width] |= disk
+        mask = mask[y0 - top:y1 - top, x0 - left:x1 - left]
+        invalidate_overlay_pyramid(overlay)
+        patch = np.array(overlay.crop((x0, y0, x1, y1)))
+        patch[mask] = BRUSH_VALUES[mode]
+        overlay.paste(Image.fromarray(patch, overlay.mode), (x0, y0))
+        return x0, y0, x1, y1
+
+class OverlayStatistics:
+    """
+    Ink statistics of the active overlay: labeled area, number of 8-connected strokes, and the coverage of every
+    sub-overlay and its overlap with the overlay. They are kept per tile square and only dirty tiles are
+    recomputed, a few at a time within a time budget. Strokes crossing tile borders are joined with a
+    union-find over the labels on the tile borders, so no full-image labeling is ever needed.
+    The sums over the tiles are running totals, the union-find only runs again when a border changed
+    and the summary is cached until a tile is recomputed.
+    """
+    def __init__(self, tile=256, threshold=128):
+        self.tile = tile
+        self.threshold = threshold
+        self.reset(None)
+
+    def reset(self, overlay, sub_overlays=()):
+        """Track another overlay or set of sub-overlays, every tile is recomputed."""
+        self.overlay = overlay
+        self.sub_overlays = list(sub_overlays)
+        self.tiles = {}
+        self.edges = {}
+        self.dirty = set()
+        self.totals = {"area": 0, "components": 0, "coverage": [0] * len(self.sub_overlays), "overlap": [0] * len(self.sub_overlays)}
+        # Strokes joined across tile borders, None when the border edges changed since they were joined
+        self.joined = 0
+        self.cached_summary = None
+        if overlay is not None:
+            self.mark_dirty(0, 0, overlay.width, overlay.height)
+
+    def mark_dirty(self, x0, y0, x1, y1):
+        """Mark the tiles under the overlay pixels [x0, x1) x [y0, y1) as changed."""
+        if self.overlay is None:
+            return
+        tx0, ty0 = max(0, int(x0) // self.tile), max(0, int(y0) // self.tile)
+        tx1 = min(math.ceil(self.overlay.width / self.tile), math.ceil(x1 / self.tile))
+        ty1 = min(math.ceil(self.overlay.height / self.tile), math.ceil(y1 / self.tile))
+        self.dirty.update((ty, tx) for ty in range(ty0, ty1) for tx in range(tx0, tx1))
+        self.cached_summary = None
+
+    def compute_tile(self, ty, tx):
+        from scipy import ndimage
+        box = (tx * self.tile, ty * self.tile, min(self.overlay.width, (tx + 1) * self.tile), min(self.overlay.height, (ty + 1) * self.tile))
+        mask = np.asarray(self.overlay.crop(box)) >= self.threshold
+        labels, count = ndimage.label(mask, structure=np.ones((3, 3), dtype=bool))
+        coverage, overlap = [], []
+        for sub_overlay in self.sub_overlays:
+            sub_mask = np.asarray(sub_overlay.crop(box)) >= self.threshold
+            coverage.append(int(np.count_nonzero(sub_mask)))
+            overlap.append(int(np.count_nonzero(sub_mask & mask)))
+        tile = {
+            "area": int(np.count_nonzero(mask)), "components": count, "coverage": coverage, "overlap": overlap,
+            "top": labels[0].copy(), "bottom": labels[-1].copy(), "left": labels[:, 0].copy(), "right": labels[:, -1].copy(),
+        }
+        # The totals lose the old values of the tile and gain the new ones
+        for old, sign in ((self.tiles.get((ty, tx)), -1), (tile, 1)):
+            if old is None:
+                continue
+            self.totals["area"] += sign * old["area"]
+            self.totals["components"] += sign * old["components"]
+            for i in range(len(self.sub_overlays)):
+                self.totals["coverage"][i] += sign * old["coverage"][i]
+                self.totals["overlap"][i] += sign * old["overlap"][i]
+        self.tiles[(ty, tx)] = tile
+
+    def border_edges(self, a, b, shift):
+        """Unique (label a, label b) pairs of border pixels that touch, b is compared shifted by -1, 0 and +1."""
+        pairs = []
+        for offset in shift:
+            if offset >= 0:
+                left, right = a[:len(a) - offset], b[offset:]
+            else:
+                left, right = a[-offset:], b[:len(b) + offset]
+            length = min(len(left), len(right))
+            left, right = left[:length], right[:length]
+            touching = (left > 0) & (right > 0)
+            pairs.append(np.stack([left[touching], right[touching]], axis=1))
+        return np.unique(np.concatenate(pairs), axis=0)
+
+    def update_edges(self, ty, tx):
+        """Recompute the label pairs joining a tile with its computed neighbours."""
+        for dy, dx in ((0, 1), (1, -1), (1, 0), (1, 1), (0, -1), (-1, 1), (-1, 0), (-1, -1)):
+            first, second = (ty, tx), (ty + dy, tx + dx)
+            if second < first:
+                first, second = second, first
+            if first not in self.tiles or second not in self.tiles:
+                continue
+            a, b = self.tiles[first], self.tiles[second]
+            (fy, fx), (sy, sx) = first, second
+            if fy == sy:
+                edges = self.border_edges(a["right"], b["left"], (-1, 0, 1))
+            elif fx == sx:
+                edges = self.border_edges(a["bottom"], b["top"], (-1, 0, 1))
+            elif sx > fx:
+                edges = np.array([[a["bottom"][-1], b["top"][0]]]) if a["bottom"][-1] and b["top"][0] else np.zeros((0, 2), dtype=int)
+            else:
+                edges = np.array([[a["bottom"][0], b["top"][-1]]]) if a["bottom"][0] and b["top"][-1] else np.zeros((0, 2), dtype=int)
+            old = self.edges.get((first, second))
+            if old is None or not np.array_equal(old, edges):
+                self.joined = None
+            self.edges[(first, second)] = edges
+
+    def update(self, budget=0.01):
+        """Recompute dirty tiles for at most budget seconds. Returns whether the statistics are complete."""
+        if not self.dirty:
+            return True
+        deadline = time.perf_counter() + budget
+        with profiler.span("ink_statistics", tiles=len(self.dirty)):
+            while self.dirty and time.perf_counter() < deadline:
+                ty, tx = self.dirty.pop()
+                self.compute_tile(ty, tx)
+                self.update_edges(ty, tx)
+        self.cached_summary = None
+        return not self.dirty
+
+    def join_strokes(self):
+        """Number of joins of stroke labels across tile borders, from a union-find over all border edges."""
+        parents = {}
+        def find(node):
+            while parents.get(node, node) != node:
+                parents[node] = parents.get(parents[node], parents[node])
+                node = parents[node]
+            return node
+        joined = 0
+        for (first, second), edges in self.edges.items():
+            for label_a, label_b in edges:
+                root_a, root_b = find((first, int(label_a))), find((second, int(label_b)))
+                if root_a != root_b:
+                    parents[root_a] = root_b
+                    joined += 1
+        return joined
+
+    def summary(self, micron_factor):
+        """Labeled area in pixels and um^2, strokes, and per sub-overlay coverage and overlap in pixels."""
+        if self.cached_summary is not None and self.cached_summary[0] == micron_factor:
+            return self.cached_summary[1]
+        if self.joined is None:
+            self.joined = self.join_strokes()
+        area = self.totals["area"]
+        summary = {
+            "area": area,
+            # micron_factor is the pixel size in mm
+            "area_um2": area * (micron_factor * 1000.0) ** 2,
+            "strokes": self.totals["components"] - self.joined,
+            "coverage": list(self.totals["coverage"]),
+            "overlap": list(self.totals["overlap"]),
+            "complete": not self.dirty,
+        }
+        self.cached_summary = (micron_factor, summary)
+        return summary
+
+def save_mask_stack(folder, mask, start_index, offset, size):
+    """Write one full size mask image per layer, named by the layer index."""
+    os.makedirs(folder, exist_ok=True)
+    x0, y0 = offset
+    for z, layer_mask in enumerate(mask):
+        layer = Image.new("L", size, "black")
+        if layer_mask.any():
+            layer.paste(Image.fromarray(np.uint8(layer_mask) * 255), (x0, y0))
+        layer.save(os.path.join(folder, f"{start_index + z:05d}.png"))
+    print(f"Saved {len(mask)} mask layers to {folder}")
+
+# Auto window presets of the Min Max entries: (scope, low percentile, high percentile), None resets the range
+AUTO_WINDOW_PRESETS = {
+    "Layers 0.5-99.5%": ("layers", 0.5, 99.5),
+    "Layers 2-98%": ("layers", 2.0, 98.0),
+    "View 0.5-99.5%": ("view", 0.5, 99.5),
+    "View 2-98%": ("view", 2.0, 98.0),
+    "Full Range": (None, 0.0, 100.0),
+}
+
+# Every HISTOGRAM_STRIDE-th pixel of every HISTOGRAM_STRIDE-th row is counted in the histograms,
+# projection histograms are kept per HISTOGRAM_TILE square so that any viewport can be summed from them
+HISTOGRAM_STRIDE = 4
+HISTOGRAM_TILE = 256
+
+def histogram_sample(image, stride=HISTOGRAM_STRIDE):
+    """Strided 8 bit values of a slice or projection, the range the projections are computed in."""
+    sample = image[::stride, ::stride]
+    if sample.dtype != np.uint8:
+        sample = np.clip(np.rint(sample), 0, 255).astype(np.uint8)
+    return sample
+
+def slice_histogram(image, stride=HISTOGRAM_STRIDE):
+    return np.bincount(histogram_sample(image, stride).ravel(), minlength=256).astype(np.int64)
+
+def tile_histograms(image, tile=HISTOGRAM_TILE, stride=HISTOGRAM_STRIDE):
+    """(tiles down, tiles across, 256) histograms of the tile squares of an image, in one bincount."""
+    sample = histogram_sample(image, stride)
+    tiles_down, tiles_across = math.ceil(image.shape[0] / tile), math.ceil(image.shape[1] / tile)
+    rows = (np.arange(sample.shape[0]) * stride) // tile
+    columns = (np.arange(sample.shape[1]) * stride) // tile
+    bins = (rows[:, None] * tiles_across + columns[None, :]) * 256 + sample
+    counts = np.bincount(bins.ravel(), minlength=tiles_down * tiles_across * 256)
+    return counts.reshape(tiles_down, tiles_across, 256).astype(np.int32)
+
+def histogram_window(histogram, low=0.5, high=99.5):
+    """Min and max image values (16 bit units, like the Min Max entries) at the low and high percentiles of a histogram."""
+    cumulative = np.cumsum(histogram)
+    if cumulative[-1] == 0:
+        return 0.0, 65535.0
+    low_value = int(np.searchsorted(cumulative, cumulative[-1] * low / 100.0, side="right"))
+    high_value = int(np.searchsorted(cumulative, cumulative[-1] * high / 100.0, side="left"))
+    high_value = max(high_value, low_value + 1)
+    return float(low_value * 256), float(min(65535, high_value * 256 + 255))
+
+class SlidingProjection:
+    """
+    Max, min or mean over a sliding window of layers, with layers pushed at the back and popped at the front.
+    Mean keeps a running sum. Max and min use two stacks: popping from the front reads suffix aggregates
+    that are rebuilt only when the front runs empty, so every step costs a constant number of array operations.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+        self.reduce = {"max": np.maximum, "min": np.minimum}.get(operation)
+        self.layers = deque()
+        self.back_value = None
+        self.front = []
+
+    def push(self, layer):
+        self.layers.append(layer)
+        if self.reduce is None:
+            if self.back_value is None:
+                self.back_value = np.zeros(layer.shape, dtype=np.int64)
+            self.back_value += layer
+        elif self.back_value is None:
+            self.back_value = layer.copy()
+        else:
+            self.reduce(self.back_value, layer, out=self.back_value)
+
+    def pop(self):
+        layer = self.layers.popleft()
+        if self.reduce is None:
+            self.back_value -= layer
+            return
+        if not self.front:
+            # Everything behind the front becomes the front, the oldest layer's suffix on top
+            value = None
+            for back_layer in reversed([layer] + list(self.layers)):
+                value = back_layer.copy() if value is None else self.reduce(value, back_layer)
+                self.front.append(value)
+            self.back_value = None
+        self.front.pop()
+
+    def value(self):
+        if self.reduce is None:
+            return self.back_value / len(self.layers)
+        if not self.front:
+            return self.back_value
+        if self.back_value is None:
+            return self.front[-1]
+        return self.reduce(self.front[-1], self.back_value)
+
+# Video containers of the layer sweep export and their codecs, other paths are written as PNG sequences
+VIDEO_CODECS = {".mp4": "mp4v", ".avi": "MJPG"}
+
+sweep_worker = None
+
+def init_sweep_worker(reopen, shared_slices, state, overlays, folder):
+    """
+    Pool initializer of the layer sweep: every worker process opens the volume itself from the picklable
+    reopen() of the parent's source, reads the parent's preloaded layers from shared memory if shared_slices
+    is the spec of SliceCache.share(), and renders state with the frame overlays prepared by the parent.
+    """
+    global sweep_worker
+    constructor, args = reopen
+    volume_source = constructor(*args)
+    if shared_slices is not None:
+        volume_source.preloaded_images = SliceCache.attach(shared_slices)
+    engine = RenderEngine(workers=1)
+    engine.open_volume(volume_source)
+    sweep_worker = (engine, state, overlays, folder)
+
+def render_sweep_chunk(indices):
+    """
+    Render the frames of a run of consecutive layers. Returns the frames as BGR arrays for the video writer,
+    or the paths of folder/{index:05d}.png if the frames are written to a folder.
+    """
+    engine, state, overlays, folder = sweep_worker
+    if engine.volume_source.windowed:
+        level = engine.get_display_level(state)
+        window, engine.projection_placement = engine.level_window(engine.get_visible_window(state), level)
+    else:
+        level, window = 0, None
+    frames = []
+    for index, projection in engine.sweep_projections(state, indices, window, level):
+        engine.pil_image = Image.fromarray(projection).convert("L")
+        state.image_index = index
+        frame = engine.render_frame(state, overlays).convert("RGB")
+        if folder is None:
+            frames.append(np.ascontiguousarray(np.asarray(frame)[:, :, ::-1]))
+        else:
+            path = os.path.join(folder, f"{index:05d}.png")
+            frame.save(path)
+            frames.append(path)
+    return frames
+
+def crop_frame_overlays(overlays, window):
+    """
+    Crop the (image, scale, color, brightness, opacity) overlays of a frame to a full resolution (y0, y1, x0, x1)
+    window, with a margin for the interpolation kernel. The scales get the offsets of the crops.
+    """
+    y0, y1, x0, x1 = window
+    cropped = []
+    for image, (scale_x, scale_y, *_), color, brightness, opacity in overlays:
+        left, top = max(0, math.floor(x0 / scale_x) - 2), max(0, math.floor(y0 / scale_y) - 2)
+        right, bottom = min(image.width, math.ceil(x1 / scale_x) + 2), min(image.height, math.ceil(y1 / scale_y) + 2)
+        cropped.append((image.crop((left, top, right, bottom)), (scale_x, scale_y, left * scale_x, top * scale_y), color, brightness, opacity))
+    return cropped
+
+class ViewState:
+    """Everything the render engine needs to produce a frame: view transform, projection and overlay settings."""
+    def __init__(self, canvas_width=800, canvas_height=600, mat_affine=None, image_index=0, radius=0, direction="omi",
+                 operation="max", min_value=0.0, max_value=65535.0, contrast_enhance=False, sub_overlays=(),
+                 sub_overlay_colors=(), overlay_image=None, overlay_visibility=True, overlay_opacity=1.0,
+                 suboverlay_opacity=0.4, suboverlay_brightness=1.0, resample_method="NEAREST", render_backend="auto",
+                 micron_factor=0.00324):
+        self.canvas_width = canvas_width
+        self.canvas_height = canvas_height
+        self.mat_affine = np.eye(3) if mat_affine is None else mat_affine
+        self.image_index = image_index
+        self.radius = radius
+        self.direction = direction
+        self.operation = operation
+        self.min_value = min_value
+        self.max_value = max_value
+        self.contrast_enhance = contrast_enhance
+        self.sub_overlays = list(sub_overlays)
+        self.sub_overlay_colors = list(sub_overlay_colors)
+        self.overlay_image = overlay_image
+        self.overlay_visibility = overlay_visibility
+        self.overlay_opacity = overlay_opacity
+        self.suboverlay_opacity = suboverlay_opacity
+        self.suboverlay_brightness = suboverlay_brightness
+        self.resample_method = resample_method
+        self.render_backend = render_backend
+        self.micron_factor = micron_factor
+
+    @property
+    def global_scale_factor(self):
+        return affine_scale_factor(self.mat_affine)
+
+    def to_dict(self):
+        """JSON serializable settings, the overlay images themselves are not included."""
+        values = {name: value for name, value in vars(self).items() if name not in ("mat_affine", "sub_overlays", "overlay_image")}
+        values["mat_affine"] = self.mat_affine.tolist()
+        values["sub_overlay_colors"] = list(self.sub_overlay_colors)
+        return values
+
+    @classmethod
+    def from_dict(cls, values):
+        values = dict(values)
+        values["mat_affine"] = np.array(values["mat_affine"])
+        return cls(**values)
+
+class RenderEngine:
+    """
+    Projects the volume layers and composes frames from an explicit ViewState. It has no Tk dependency,
+    so frames can be rendered, profiled and tested without a display.
+    """
+    def __init__(self, render_tile_size=256, workers=None, cache=None, parent=None, name=None, track_memory=False):
+        """
+        parent: the engine of the main view if this one renders another pane of a split view. It then shares
+        the volume, the caches and the render threads of parent and only has a projection of its own.
+        track_memory: account the projection and the preloaded layers in the global memory budget. Only for the
+        engine of the application and its panes, the categories have fixed names and keep the engine alive.
+        """
+        self.parent = parent
+        self.track_memory = track_memory
+        self.name = name
+        self.panes = []
+        self.pil_image = None
+        # Windowed sources project the part of the volume around the view at the pyramid level it is drawn from,
+        # pil_image then covers loaded_window and is placed by the (scale_x, scale_y, offset_x, offset_y) placement
+        self.loaded_window = None
+        self.projection_level = 0
+        self.projection_placement = FULL_RESOLUTION
+        # Projection settings of pil_image, panes with the same settings share it
+        self.projected_params = None
+        self.projection_histograms = None
+        self.window_margin = 256
+        self.render_tile_size = render_tile_size
+        if parent is None:
+            self.volume_source = None
+            # Projections of layer files, kept across sessions
+            self.cache = cache
+            self.cache_writer = ThreadPoolExecutor(max_workers=1)
+            # Histograms of the layers by index and of the tiles of the current projection at its (y, x) offset
+            self.layer_histograms = {}
+            # Canvas tiles rendered in parallel, PIL releases the GIL inside transform and paste
+            self.render_pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+            self.render_backends = {backend.name: backend for backend in (PILRenderBackend(), OpenCVRenderBackend())}
+            self.auto_render_backends = {}
+            # The panes of a split view render concurrently, the backends are measured once
+            self.render_backends_lock = threading.Lock()
+        else:
+            self.volume_source = parent.volume_source
+            self.cache, self.cache_writer = parent.cache, parent.cache_writer
+            self.layer_histograms = parent.layer_histograms
+            self.render_pool = parent.render_pool
+            self.render_backends, self.auto_render_backends = parent.render_backends, parent.auto_render_backends
+            self.render_backends_lock = parent.render_backends_lock
+        if track_memory:
+            suffix = f" ({name})" if name else ""
+            memory.register("projection" + suffix, lambda: 0 if self.shares_projection() else image_nbytes(self.pil_image), priority=MEMORY_PRIORITY_VISIBLE)
+
+    def add_pane(self, name):
+        """Engine for another pane of a split view of this engine's volume."""
+        pane = RenderEngine(self.render_tile_size, parent=self, name=name, track_memory=self.track_memory)
+        self.panes.append(pane)
+        return pane
+
+    def remove_pane(self, pane):
+        self.panes.remove(pane)
+        if pane.track_memory:
+            memory.unregister(f"projection ({pane.name})")
+
+    def shares_projection(self):
+        return self.parent is not None and self.pil_image is not None and self.pil_image is self.parent.pil_image
+
+    def open_volume(self, volume_source):
+        self.volume_source = volume_source
+        self.pil_image = None
+        self.loaded_window = None
+        self.projection_level = 0
+        self.projection_placement = FULL_RESOLUTION
+        self.projected_params = None
+        self.projection_histograms = None
+        if self.parent is None:
+            # Cleared in place, the panes share the dict
+            self.layer_histograms.clear()
+            if self.track_memory:
+                memory.register("slices", volume_source.memory_usage, evict=volume_source.evict, priority=MEMORY_PRIORITY_PREFETCH)
+        for pane in self.panes:
+            pane.open_volume(volume_source)
+
+    def get_render_backend(self, state):
+        if state.render_backend != "auto":
+            return self.render_backends[state.render_backend]
+        method = state.resample_method
+        with self.render_backends_lock:
+            if method not in self.auto_render_backends:
+                timings = benchmark_render_backends(self.render_backends.values(), RESAMPLING_METHODS[method], tile_size=self.render_tile_size)
+                for seconds, backend in timings:
+                    print(f"Render backend {backend.name} ({method}): {seconds * 1000:.1f} ms")
+                self.auto_render_backends[method] = timings[0][1]
+                print(f"Using render backend {timings[0][1].name} for {method}")
+        return self.auto_render_backends[method]
+
+    def calculate_image_range(self, state):
+        num_layers = len(self.volume_source.layer_names)
+        if state.direction == "omi":
+            start_index = max(0, state.image_index - state.radius)
+            end_index = min(num_layers, state.image_index + state.radius + 1)
+        elif state.direction == "front":
+            start_index = state.image_index
+            end_index = min(num_layers, state.image_index + state.radius + 1)
+        elif state.direction == "back":
+            start_index = max(0, state.image_index - state.radius)
+            end_index = state.image_index + 1
+        return start_index, end_index
+
+    def enhance_image(self, image, state):
+        if state.contrast_enhance:
+            with profiler.span("enhance"):
+                import cv2
+                clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(12,12))
+                image = clahe.apply(image.astype(np.uint8))
+        return image
+
+    def reduce_images(self, images, state):
+        """Project a (layers, height, width) stack with the selected operation, before the value range is applied."""
+        with profiler.span("projection", layers=len(images), operation=state.operation):
+            if images.size == 1:
+                return images[0]
+            if state.operation == "max":
+                return np.max(images, axis=0)
+            elif state.operation == "min":
+                return np.min(images, axis=0)
+            elif state.operation == "mean":
+                return np.mean(images, axis=0)
+
+    def project_images(self, images, state):
+        """Project a (layers, height, width) stack with the selected operation, value range and contrast enhancement."""
+        return self.enhance_image(self.scale_projection(self.reduce_images(images, state), state), state)
+
+    def scale_projection(self, result_image, state):
+        """Map the selected value range of a projection to 8 bit."""
+        if state.min_value != 0 or state.max_value != 65535:
+            result_image = (result_image - (state.min_value / 256.0)) * ( 65535.0 / (state.max_value - state.min_value))
+            result_image = np.clip(result_image, 0, 255)
+        return result_image.astype(np.uint8)
+
+    def sweep_projections(self, state, indices, window=None, level=0):
+        """
+        Yield (index, projection) for consecutive layer indices, identical to project_images of each range.
+        The layers are read once and the projection slides over them, every step only adds the layers
+        entering the range and drops the ones leaving it. window is in pixels of the pyramid level.
+        """
+        ranges = [self.calculate_image_range(ViewState(image_index=index, radius=state.radius, direction=state.direction)) for index in indices]
+        first, last = ranges[0][0], max(end for _, end in ranges)
+        with profiler.span("slice_load", start=first, end=last, level=level):
+            layers = self.volume_source.read(first, last, window, level=level)
+        sliding = SlidingProjection(state.operation)
+        start = end = first
+        for index, (range_start, range_end) in zip(indices, ranges):
+            with profiler.span("projection", layers=range_end - range_start, operation=state.operation):
+                for layer in range(end, range_end):
+                    sliding.push(layers[layer - first])
+                for layer in range(start, range_start):
+                    sliding.pop()
+                start, end = range_start, range_end
+                result_image = self.scale_projection(sliding.value(), state)
+            yield index, self.enhance_image(result_image, state)
+
+    def process_images(self, state):
+        """Project the layers around state.image_index into self.pil_image. Returns it, or None if nothing was read."""
+        if self.volume_source is None:
+            return None
+        start_index, end_index = self.calculate_image_range(state)
+        params = self.projection_params(state)
+        if self.parent_projection(params) is not None:
+            # Same projection as the main view, drawn from its image
+            self.pil_image, self.projection_histograms = self.parent.pil_image, self.parent.projection_histograms
+            self.projection_level, self.projection_placement = self.parent.projection_level, self.parent.projection_placement
+            self.projected_params = params
+            return self.pil_image
+
+        if self.volume_source.windowed:
+            # Chunked and remote sources only read the visible part of the layers, zoomed out views from a coarser level
+            level = self.get_display_level(state)
+            self.loaded_window = self.get_visible_window(state, margin=self.window_margin)
+            window, placement = self.level_window(self.loaded_window, level)
+            with profiler.span("slice_load", start=start_index, end=end_index, level=level):
+                images = self.volume_source.read(start_index, end_index, window, level=level)
+            if images.size > 0:
+                reduced_image = self.reduce_images(images, state)
+                self.projection_histograms = (tile_histograms(reduced_image), placement)
+                result_image = self.enhance_image(self.scale_projection(reduced_image, state), state)
+                self.projection_level, self.projection_placement = level, placement
+        else:
+            self.loaded_window = None
+            self.projection_level, self.projection_placement = 0, FULL_RESOLUTION
+            cache_key = self.projection_cache_key(start_index, end_index, state)
+            data = self.cache.get(cache_key) if cache_key is not None else None
+            if data is not None:
+                with profiler.span("projection_cache"):
+                    result_image = decode_array(data)
+                    histograms = self.cache.get(self.projection_histograms_cache_key(start_index, end_index, state))
+                    self.projection_histograms = (decode_array(histograms), FULL_RESOLUTION) if histograms is not None else None
+                images = result_image
+            else:
+                # Room for the stacked 8 or 16 bit layers, prefetched slices are dropped first
+                height, width = self.volume_source.shape()
+                stack_bytes = 2 * (end_index - start_index) * height * width
+                if memory.reserve(stack_bytes, MEMORY_PRIORITY_VISIBLE):
+                    # Stack images as a 3D NumPy array
+                    with profiler.span("slice_load", start=start_index, end=end_index):
+                        images = self.volume_source.read(start_index, end_index)
+                    if images.size > 0:
+                        with profiler.span("histograms"):
+                            for index, image in enumerate(images, start_index):
+                                if index not in self.layer_histograms:
+                                    self.store_layer_histogram(index, slice_histogram(image))
+                        reduced_image = self.reduce_images(images, state)
+                else:
+                    # The layer histograms are computed from single layers when they are needed
+                    images = reduced_image = self.reduce_bands(start_index, end_index, state, stack_bytes)
+                if images.size > 0:
+                    with profiler.span("histograms"):
+                        self.projection_histograms = (tile_histograms(reduced_image), FULL_RESOLUTION)
+                    result_image = self.enhance_image(self.scale_projection(reduced_image, state), state)
+                    if cache_key is not None:
+                        self.cache_writer.submit(self.cache.put, cache_key, encode_array(result_image))
+                        self.cache_writer.submit(self.cache.put, self.projection_histograms_cache_key(start_index, end_index, state),
+                                                 encode_array(self.projection_histograms[0]))
+        if images.size == 0:
+            return None
+        self.pil_image = Image.fromarray(result_image).convert("L")
+        self.projected_params = params
+        return self.pil_image
+
+    def reduce_bands(self, start_index, end_index, state, stack_bytes):
+        """
+        Project layers [start_index, end_index) band of rows by band, for ranges whose stacked layers
+        (stack_bytes) do not fit the memory budget at once. The bands fit the part of the budget still free.
+        """
+        height, width = self.volume_source.shape()
+        available = max(0, memory.budget - memory.total())
+        band_rows = max(1, height * available // stack_bytes)
+        print(f"Projecting layers {start_index}-{end_index - 1} in bands of {band_rows} rows to fit the memory budget")
+        bands = []
+        for y0 in range(0, height, band_rows):
+            with profiler.span("slice_load", start=start_index, end=end_index):
+                images = self.volume_source.read(start_index, end_index, (y0, min(height, y0 + band_rows), 0, width))
+            bands.append(self.reduce_images(images, state))
+        return np.concatenate(bands)
+
+    def projection_params(self, state):
+        return (self.calculate_image_range(state), state.operation, state.min_value, state.max_value, bool(state.contrast_enhance))
+
+    def parent_projection(self, params):
+        """The projection of the main view if it has the settings params and can be shared, else None."""
+        parent = self.parent
+        if parent is None or self.volume_source.windowed or parent.projected_params != params:
+            return None
+        return parent.pil_image
+
+    def render_view(self, state):
+        """
+        Render a frame of a split view pane: project the layers first if the projection settings of state
+        changed, the view left the part of a chunked volume read so far or the main view has a new projection
+        with the same settings. None if there is nothing to draw.
+        """
+        if self.volume_source is None:
+            return None
+        params = self.projection_params(state)
+        shared = self.parent_projection(params)
+        if self.projected_params != params or not self.visible_window_loaded(state) or (shared is not None and shared is not self.pil_image):
+            if self.process_images(state) is None:
+                return None
+        return self.render_frame(state)
+
+    def projection_cache_key(self, start_index, end_index, state):
+        """Cache key of a projection of several layer files, None if it is not worth caching."""
+        if self.cache is None or not hasattr(self.volume_source, "identity"):
+            return None
+        if end_index - start_index < 2 and not state.contrast_enhance:
+            # A single layer without enhancement is as fast to read as its cached copy
+            return None
+        return derived_cache_key("projection", self.volume_source.identity(start_index, end_index), operation=state.operation,
+                                 min_value=state.min_value, max_value=state.max_value, contrast_enhance=bool(state.contrast_enhance))
+
+    def projection_histograms_cache_key(self, start_index, end_index, state):
+        # Histograms are taken before the value range and the contrast enhancement
+        return derived_cache_key("projection_histograms", self.volume_source.identity(start_index, end_index), operation=state.operation)
+
+    def layer_histogram_cache_key(self, index):
+        if self.cache is None or not hasattr(self.volume_source, "identity"):
+            return None
+        return derived_cache_key("slice_histogram", self.volume_source.identity(index, index + 1), stride=HISTOGRAM_STRIDE)
+
+    def store_layer_histogram(self, index, histogram):
+        self.layer_histograms[index] = histogram
+        cache_key = self.layer_histogram_cache_key(index)
+        if cache_key is not None:
+            self.cache_writer.submit(self.cache.put, cache_key, encode_array(histogram))
+
+    def layer_histogram(self, index):
+        """
+        Histogram of a layer: from memory, from the volume cache, or computed once from the layer.
+        Pyramidal volumes are sampled from their coarsest level.
+        """
+        if index in self.layer_histograms:
+            return self.layer_histograms[index]
+        cache_key = self.layer_histogram_cache_key(index)
+        data = self.cache.get(cache_key) if cache_key is not None else None
+        if data is not None:
+            self.layer_histograms[index] = decode_array(data)
+        else:
+            level = self.volume_source.num_levels - 1
+            stride = HISTOGRAM_STRIDE if level == 0 else 1
+            self.store_layer_histogram(index, slice_histogram(self.volume_source.read(index, index + 1, level=level)[0], stride))
+        return self.layer_histograms[index]
+
+    def index_layer_histograms(self, progress=None):
+        """Compute the histograms of all layers that are not known yet, progress(done, total) after every layer."""
+        total = len(self.volume_source.layer_names)
+        for index in range(total):
+            self.layer_histogram(index)
+            if progress is not None:
+                progress(index + 1, total)
+
+    def auto_window(self, state, scope="layers", low=0.5, high=99.5):
+        """
+        Min and max image values at the low and high percentiles of the current layer range ("layers")
+        or of the projection visible on the canvas ("view"), from the stored histograms.
+        """
+        if scope == "view":
+            if self.projection_histograms is None:
+                return None
+            histograms, (scale_x, scale_y, offset_x, offset_y) = self.projection_histograms
+            y0, y1, x0, x1 = self.get_visible_window(state)
+            # Tiles of the projection pixels, which can be a window of a coarser level
+            ty0, tx0 = max(0, int((y0 - offset_y) / scale_y) // HISTOGRAM_TILE), max(0, int((x0 - offset_x) / scale_x) // HISTOGRAM_TILE)
+            ty1, tx1 = math.ceil((y1 - offset_y) / scale_y / HISTOGRAM_TILE), math.ceil((x1 - offset_x) / scale_x / HISTOGRAM_TILE)
+            histogram = histograms[ty0:max(ty0, ty1), tx0:max(tx0, tx1)].sum(axis=(0, 1), dtype=np.int64)
+        else:
+            start_index, end_index = self.calculate_image_range(state)
+            histogram = sum(self.layer_histogram(index) for index in range(start_index, end_index))
+        return histogram_window(histogram, low, high)
+
+    def get_visible_window(self, state, margin=0):
+        """Full resolution (y0, y1, x0, x1) bounds of the volume visible on the canvas, grown by margin pixels."""
+        height, width = self.volume_source.shape()
+        corners = np.array([canvas_to_image(state.mat_affine, x, y)[:2] for x in (0, state.canvas_width) for y in (0, state.canvas_height)])
+        x0, y0 = np.floor(corners.min(axis=0)).astype(int) - margin
+        x1, y1 = np.ceil(corners.max(axis=0)).astype(int) + margin
+        x0, x1 = min(max(0, x0), width), min(max(0, x1), width)
+        y0, y1 = min(max(0, y0), height), min(max(0, y1), height)
+        return (y0, max(y0, y1), x0, max(x0, x1))
+
+    def image_size(self):
+        """(width, height) of the volume at full resolution."""
+        height, width = self.volume_source.shape()
+        return width, height
+
+    def level_window(self, window, level):
+        """
+        The (y0, y1, x0, x1) pixels of a pyramid level that cover a full resolution window,
+        and the (scale_x, scale_y, offset_x, offset_y) placement of an image of them in the volume.
+        """
+        height, width = self.volume_source.shape()
+        level_height, level_width = self.volume_source.shape(level)
+        scale_x, scale_y = width / level_width, height / level_height
+        y0, y1, x0, x1 = window
+        ly0, lx0 = int(y0 // scale_y), int(x0 // scale_x)
+        ly1, lx1 = min(level_height, math.ceil(y1 / scale_y)), min(level_width, math.ceil(x1 / scale_x))
+        return (ly0, ly1, lx0, lx1), (scale_x, scale_y, lx0 * scale_x, ly0 * scale_y)
+
+    def tile_window(self, tile, scale, margin=0):
+        """Full resolution (y0, y1, x0, x1) bounds of the volume under an (x0, y0, width, height) tile of an image scaled by scale."""
+        height, width = self.volume_source.shape()
+        x0, y0, tile_width, tile_height = tile
+        return (max(0, math.floor(y0 / scale) - margin), min(height, math.ceil((y0 + tile_height) / scale) + margin),
+                max(0, math.floor(x0 / scale) - margin), min(width, math.ceil((x0 + tile_width) / scale) + margin))
+
+    def project_window(self, state, window, level=0):
+        """
+        Project the layers of state inside a full resolution window from a pyramid level,
+        returns the image and its (scale_x, scale_y, offset_x, offset_y) placement.
+        """
+        start_index, end_index = self.calculate_image_range(state)
+        level_window, placement = self.level_window(window, level)
+        images = self.volume_source.read(start_index, end_index, level_window, level=level)
+        return Image.fromarray(self.project_images(images, state)).convert("L"), placement
+
+    def visible_window_loaded(self, state):
+        if self.loaded_window is None or self.volume_source is None:
+            return True
+        if self.get_display_level(state) != self.projection_level:
+            return False
+        y0, y1, x0, x1 = self.get_visible_window(state)
+        if y1 <= y0 or x1 <= x0:
+            return True
+        ly0, ly1, lx0, lx1 = self.loaded_window
+        return ly0 <= y0 and y1 <= ly1 and lx0 <= x0 and x1 <= lx1
+
+    def get_display_level(self, state):
+        """Coarsest pyramid level that still has at least one level pixel per screen pixel."""
+        scale = state.global_scale_factor
+        if self.volume_source is None or self.volume_source.num_levels == 1 or scale >= 0.5:
+            return 0
+        level = int(math.floor(math.log2(1.0 / scale)))
+        return min(level, self.volume_source.num_levels - 1)
+
+    def get_display_image(self, state):
+        """Return the projection to display and its (scale_x, scale_y, offset_x, offset_y) placement in the volume."""
+        return self.pil_image, self.projection_placement
+
+    def full_resolution_projection(self):
+        """The projection and its (x, y) offset in the volume if it is at full resolution, else None."""
+        scale_x, scale_y, offset_x, offset_y = self.projection_placement
+        if self.pil_image is None or (scale_x, scale_y) != (1.0, 1.0):
+            return None
+        return self.pil_image, (int(offset_x), int(offset_y))
+
+    def render_frame(self, state, overlays=None):
+        """
+        Compose the transformed image, overlays and ruler into an RGBA frame of the canvas size.
+        overlays are the frame overlays of state if they were already prepared, see frame_overlays.
+        """
+        canvas_width, canvas_height = state.canvas_width, state.canvas_height
+        mat_inv = np.linalg.inv(state.mat_affine)
+
+        affine_inv = (
+            mat_inv[0, 0], mat_inv[0, 1], mat_inv[0, 2],
+            mat_inv[1, 0], mat_inv[1, 1], mat_inv[1, 2]
+            )
+        resample = RESAMPLING_METHODS[state.resample_method]
+        if overlays is None:
+            overlays = self.frame_overlays(state)
+
+        backend = self.get_render_backend(state)
+        # Zoomed out views of pyramidal volumes are drawn from a window of a coarser level
+        display_image, display_scale = self.get_display_image(state)
+        dst = Image.new('RGBA', (canvas_width, canvas_height))
+        tiles = canvas_tiles(canvas_width, canvas_height, self.render_tile_size)
+        rendered_tiles = self.render_pool.map(lambda tile: backend.render_tile(display_image, overlays, affine_inv, tile, resample, display_scale), tiles)
+        with profiler.span("tiles", count=len(tiles)):
+            for tile, tile_image in zip(tiles, rendered_tiles):
+                dst.paste(tile_image, tile[:2])
+
+        with profiler.span("ruler"):
+            # Add a ruler to the bottom right of the image
+            ruler_width, ruler_height = 500, 100  # Customize as needed
+            unit_size = state.global_scale_factor * (1.0 / state.micron_factor)  # Customize the unit size for the ruler
+            image_width, image_height = dst.size
+            ruler = create_ruler(image_width, image_height, ruler_width, ruler_height, unit_size)
+
+            # Calculate position for the ruler (bottom right)
+            ruler_position = (0, 0)
+
+            # Paste the ruler onto the image
+            dst.paste(ruler, ruler_position, ruler)
+        return dst
+
+    def frame_overlays(self, state):
+        """The (image, scale, color, brightness, opacity) overlays of a frame, in drawing order."""
+        overlays = []
+        if state.overlay_visibility:
+            # Overlaying SubOverlays
+            for i, sub_overlay in enumerate(state.sub_overlays):
+                if i == 0: continue # skip overlay image
+                overlays.append(overlay_display_level(sub_overlay, state.global_scale_factor) + (state.sub_overlay_colors[i], state.suboverlay_brightness, state.suboverlay_opacity))
+
+            # Overlaying the additional PNG
+            if state.overlay_image:
+                overlays.append(overlay_display_level(state.overlay_image, state.global_scale_factor) + (state.sub_overlay_colors[0], None, state.overlay_opacity))
+        return overlays
+
+    def export_layer_sweep(self, state, start, end, path, fps=10, workers=None, progress=None):
+        """
+        Render the view of state for every layer in [start, end) and write the frames to a video (.mp4, .avi)
+        or a folder of PNGs. Runs of consecutive frames render in spawned worker processes, which open the volume
+        themselves and share the preloaded layers of its slice cache, and each run slides its projection
+        from layer to layer.
+        progress(done, total) is called after every run.
+        """
+        if self.volume_source is None:
+            raise ValueError("Nothing to export, no volume loaded.")
+        import cv2
+        import multiprocessing
+        state = ViewState(**vars(state))
+        # Resolve the backend once instead of timing it in every worker
+        state.render_backend = self.get_render_backend(state).name
+        # The workers only get the visible part of the overlays, at the level they are drawn from
+        overlays = crop_frame_overlays(self.frame_overlays(state), self.get_visible_window(state))
+        state.sub_overlays, state.overlay_image = (), None
+        indices = list(range(start, end))
+        workers = workers or os.cpu_count()
+        # Runs long enough to amortize reading the window around their first frame, short enough to use all
+        # workers and to keep the layers of a run in each worker's share of the memory budget
+        window_layers = 2 * state.radius + 1
+        if self.volume_source.windowed:
+            y0, y1, x0, x1 = self.get_visible_window(state)
+        else:
+            (y0, x0), (y1, x1) = (0, 0), self.volume_source.shape()
+        layer_bytes = max(1, 2 * (y1 - y0) * (x1 - x0))
+        run_length = max(1, min(math.ceil(len(indices) / (2 * workers)), memory.budget // (2 * workers * layer_bytes) - window_layers))
+        runs = [indices[i:i + run_length] for i in range(0, len(indices), run_length)]
+
+        codec = VIDEO_CODECS.get(os.path.splitext(path)[1].lower())
+        writer = folder = None
+        if codec:
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (state.canvas_width, state.canvas_height))
+        else:
+            folder = path
+            os.makedirs(folder, exist_ok=True)
+        done = 0
+        # The compressed preloaded layers are copied once into shared memory that every worker reads
+        shared_block = shared_slices = None
+        preloaded = getattr(self.volume_source, "preloaded_images", None)
+        if preloaded is not None and len(preloaded) > 0:
+            if memory.reserve(preloaded.memory_usage(), MEMORY_PRIORITY_PREFETCH):
+                shared_block, shared_slices = preloaded.share()
+            else:
+                print("Not sharing the preloaded layers with the sweep workers, they do not fit the memory budget twice")
+        # Spawned, not forked: this runs on a job thread, and macOS and Windows only spawn
+        context = multiprocessing.get_context("spawn")
+        try:
+            initargs = (self.volume_source.reopen(), shared_slices, state, overlays, folder)
+            with context.Pool(workers, initializer=init_sweep_worker, initargs=initargs) as pool:
+                for frames in pool.imap(render_sweep_chunk, runs):
+                    if writer is not None:
+                        # Runs arrive in order, their frames are encoded while the next ones render
+                        for frame in frames:
+                            writer.write(frame)
+                    done += len(frames)
+                    if progress is not None:
+                        progress(done, len(indices))
+                # Let the workers exit cleanly, terminating them leaks their semaphores
+                pool.close()
+                pool.join()
+        except BaseException:
+            if writer is not None:
+                writer.release()
+                os.remove(path)
+            raise
+        finally:
+            if shared_block is not None:
+                shared_block.close()
+                shared_block.unlink()
+        if writer is not None:
+            writer.release()
+        print(f"Exported {len(indices)} frames of layers {start}-{end - 1} to {path}")
+
+    def export_tiff(self, state, path, scale=1.0, tile_size=512, pyramid=True, progress=None):
+        """
+        Render the composite of the projection, overlays and ruler at scale times the source resolution
+        into a tiled pyramidal BigTIFF. Tiles are rendered in parallel in batches, so memory stays bounded
+        by a few tiles whatever the output size. progress(done, total) is called after every batch.
+        Windowed volumes only hold the projection around the view, their tiles are projected from the source.
+        """
+        if self.pil_image is None:
+            raise ValueError("Nothing to export, no projection loaded.")
+        ruler_width, ruler_height = 500, 100
+        levels = []
+        width, height = self.image_size()
+        width, height = math.ceil(width * scale), math.ceil(height * scale)
+        while True:
+            levels.append((scale, width, height))
+            if not pyramid or max(width, height) <= tile_size:
+                break
+            scale, width, height = scale / 2, math.ceil(width / 2), math.ceil(height / 2)
+        total = sum(math.ceil(width / tile_size) * math.ceil(height / tile_size) for _, width, height in levels)
+        batch_size = 2 * self.render_pool._max_workers
+        done = 0
+
+        writer = TiledTiffWriter(path, tile_size)
+        try:
+            for scale, width, height in levels:
+                writer.begin_level(width, height)
+                level_state = ViewState(**dict(vars(state), mat_affine=affine_scale(np.eye(3), scale)))
+                overlays = self.frame_overlays(level_state)
+                backend = self.get_render_backend(level_state)
+                if self.volume_source.windowed:
+                    level = self.get_display_level(level_state)
+                    # Source pixels around each tile for the interpolation kernel, two level pixels
+                    margin = 2 * math.ceil(self.volume_source.shape()[1] / self.volume_source.shape(level)[1])
+                else:
+                    display_image, display_scale = self.get_display_image(level_state)
+                resample = RESAMPLING_METHODS[state.resample_method]
+                affine_inv = (1.0 / scale, 0.0, 0.0, 0.0, 1.0 / scale, 0.0)
+                # Only the tiles in the top left corner intersect the ruler
+                unit_size = scale / state.micron_factor
+                ruler_extent = min(max(width, height), ruler_height + max(ruler_width, ruler_height + 15 * max(1, int(unit_size))) + 50)
+                ruler = create_ruler(ruler_extent, ruler_extent, ruler_width, ruler_height, unit_size)
+
+                def render(tile):
+                    if self.volume_source.windowed:
+                        base_image, base_scale = self.project_window(state, self.tile_window(tile, scale, margin), level)
+                    else:
+                        base_image, base_scale = display_image, display_scale
+                    tile_image = backend.render_tile(base_image, overlays, affine_inv, tile, resample, base_scale)
+                    x0, y0 = tile[:2]
+                    if x0 < ruler_extent and y0 < ruler_extent:
+                        ruler_tile = ruler.crop((x0, y0, x0 + tile_size, y0 + tile_size))
+                        tile_image.paste(ruler_tile, (0, 0), ruler_tile)
+                    return writer.encode_tile(np.asarray(tile_image))
+
+                tiles = [(x0, y0, tile_size, tile_size) for y0 in range(0, height, tile_size) for x0 in range(0, width, tile_size)]
+                for start in range(0, len(tiles), batch_size):
+                    with profiler.span("export_tiles", count=len(tiles[start:start + batch_size])):
+                        for data in self.render_pool.map(render, tiles[start:start + batch_size]):
+                            writer.write_tile(data)
+                    done += len(tiles[start:start + batch_size])
+                    if progress is not None:
+                        progress(done, total)
+        except BaseException:
+            # Cancelled or failed, do not leave a truncated file behind
+            writer.close()
+            os.remove(path)
+            raise
+        writer.close()
+        print(f"Exported {len(levels)} levels of {levels[0][1]}x{levels[0][2]} pixels to {path}")
+
+# Overlays get downsampled levels until their short side would drop below this
+OVERLAY_PYRAMID_MIN_SIZE = 512
+
+class OverlayPyramidBuilder:
+    """
+    Builds the display pyramid of an "L" overlay while its rows are being filled in.
+    Whole blocks of the coarsest level are box-downsampled as soon as their rows are complete,
+    so an import needs only one pass and one band of extra memory.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.factors = []
+        factor = 2
+        while min(image.size) // factor >= OVERLAY_PYRAMID_MIN_SIZE:
+            self.factors.append(factor)
+            factor *= 2
+        self.levels = [Image.new("L", (math.ceil(image.width / factor), math.ceil(image.height / factor))) for factor in self.factors]
+        self.done_rows = 0
+
+    def rows_ready(self, rows):
+        """Downsample the rows above `rows` that were not downsampled yet."""
+        if not self.factors:
+            return
+        align = self.factors[-1]
+        end = rows if rows >= self.image.height else rows // align * align
+        if end <= self.done_rows:
+            return
+        band = self.image.crop((0, self.done_rows, self.image.width, end))
+        for factor, level in zip(self.factors, self.levels):
+            level.paste(band.reduce(factor), (0, self.done_rows // factor))
+        self.done_rows = end
+
+    def finish(self):
+        self.rows_ready(self.image.height)
+        self.image.pyramid_levels = self.levels
+        return self.image
+
+def build_overlay_pyramid(image):
+    return OverlayPyramidBuilder(image).finish()
+
+def overlay_display_level(image, scale):
+    """Pyramid level of an overlay to draw at the given zoom and its (x, y) scale, the image itself if it has none."""
+    levels = getattr(image, "pyramid_levels", None)
+    if not levels or scale >= 0.5:
+        return image, (1.0, 1.0)
+    level = levels[min(int(math.floor(math.log2(1.0 / scale))), len(levels)) - 1]
+    return level, (image.width / level.width, image.height / level.height)
+
+def invalidate_overlay_pyramid(image):
+    """Drop the pyramid of an overlay that is being edited, it is drawn from full resolution afterwards."""
+    image.__dict__.pop("pyramid_levels", None)
+
+def tiff_row_bands(path):
+    """
+    Open a grayscale 8 or 16 bit TIFF for reading strip by strip (or tile row by tile row).
+    Returns (width, height, bands), bands yields (y0, rows) with the rows scaled down to 8 bit,
+    or None for layouts it does not handle. Decoding errors surface as OSError from bands.
+    """
+    file = open(path, "rb")
+    def read(start, end):
+        file.seek(start)
+        return file.read(end - start)
+    try:
+        info = parse_tiff_header(read)
+    except (KeyError, IndexError, struct.error):
+        file.close()
+        return None
+    if info["bits"] not in (8, 16) or info["sample_format"] != 1 or info["samples"] != 1 or info["photometric"] not in (0, 1):
+        file.close()
+        return None
+    width, height = info["width"], info["height"]
+    block_width, block_height = info["block"]
+    blocks_across = math.ceil(width / block_width)
+
+    def bands():
+        with file:
+            for by in range(math.ceil(height / block_height)):
+                y0 = by * block_height
+                rows = block_height if info["tiled"] else min(block_height, height - y0)
+                band = np.empty((min(block_height, height - y0), width), dtype=np.uint8)
+                for bx in range(blocks_across):
+                    i = by * blocks_across + bx
+                    offset, bytecount = info["offsets"][i], info["bytecounts"][i]
+                    block = decode_tiff_block(info, read(offset, offset + bytecount), block_width, rows)
+                    if block.dtype == np.uint16:
+                        block = (block >> 8).astype(np.uint8)
+                    # Tiles at the right and bottom edges are padded
+                    x0 = bx * block_width
+                    band[:, x0:x0 + block_width] = block[:band.shape[0], :width - x0]
+                yield y0, band
+    return width, height, bands()
+
+def stream_tiff_overlay(path, progress=None):
+    """
+    Read a grayscale 8 or 16 bit TIFF strip by strip (or tile row by tile row) into an "L" image and its pyramid.
+    16 bit samples are scaled down block by block, so the full resolution data is never held in memory.
+    Returns None for layouts it does not handle. progress(done, total) is called after every row of blocks.
+    """
+    opened = tiff_row_bands(path)
+    if opened is None:
+        return None
+    width, height, bands = opened
+    image = Image.new("L", (width, height))
+    builder = OverlayPyramidBuilder(image)
+    try:
+        for y0, band in bands:
+            image.paste(Image.fromarray(band, "L"), (0, y0))
+            builder.rows_ready(y0 + len(band))
+            if progress is not None:
+                progress(y0 + len(band), height)
+    except OSError:
+        return None
+    return builder.finish()
+
+def overlay_row_bands(path, band_rows=256):
+    """
+    (width, height, bands) of an overlay file read as 8 bit rows, like tiff_row_bands. TIFFs are streamed,
+    other formats can only be decoded as a whole and are then handed out band by band.
+    """
+    opened = tiff_row_bands(path) if path.lower().endswith((".tif", ".tiff")) else None
+    if opened is not None:
+        return opened
+    image = np.asarray(load_overlay_file(path))
+    height, width = image.shape
+    return width, height, ((y0, image[y0:y0 + band_rows]) for y0 in range(0, height, band_rows))
+
+# Number of set bits of every byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+def pack_overlay(path, packed_path, threshold=128):
+    """Threshold an overlay file band by band into a bit packed (height, ceil(width / 8)) memmap on disk."""
+    width, height, bands = overlay_row_bands(path)
+    packed = np.lib.format.open_memmap(packed_path, mode="w+", dtype=np.uint8, shape=(height, (width + 7) // 8))
+    for y0, band in bands:
+        packed[y0:y0 + len(band)] = np.packbits(band >= threshold, axis=1)
+    packed.flush()
+    return width, height, packed
+
+def merge_overlay_band(packed, width, y0, y1, votes):
+    """
+    Consensus of the annotators over rows [y0, y1): union, intersection, k-of-N vote and agreement as 8 bit images,
+    with the per annotator areas and the pairwise intersection areas. The annotators are read one at a time.
+    """
+    count = np.zeros((y1 - y0, width), dtype=np.uint16)
+    areas = np.zeros(len(packed), dtype=np.int64)
+    intersections = np.zeros((len(packed), len(packed)), dtype=np.int64)
+    for i, annotator in enumerate(packed):
+        rows = np.array(annotator[y0:y1])
+        count += np.unpackbits(rows, axis=1, count=width)
+        areas[i] = POPCOUNT[rows].sum(dtype=np.int64)
+        # The other annotators' rows are read again from the memmaps rather than kept
+        for j in range(i):
+            intersections[i, j] = intersections[j, i] = POPCOUNT[rows & packed[j][y0:y1]].sum(dtype=np.int64)
+    outputs = {
+        "union": (count >= 1) * np.uint8(255),
+        "intersection": (count >= len(packed)) * np.uint8(255),
+        f"vote_{votes}_of_{len(packed)}": (count >= votes) * np.uint8(255),
+        "agreement": np.rint(count * (255.0 / len(packed))).astype(np.uint8),
+    }
+    return outputs, areas, intersections
+
+def merge_overlays(paths, output_folder, votes=None, threshold=128, tile_size=512, workers=None, progress=None):
+    """
+    Merge the overlays of several annotators into union, intersection, k-of-N vote (a majority by default) and
+    agreement (fraction of annotators labeling a pixel) tiled TIFFs, and pairwise IoU statistics in stats.json.
+    The overlays are bit packed to disk one at a time, then bands of rows are merged in parallel, so memory is
+    bounded by a band whatever the segment size or the number of annotators. progress(done, total) is called
+    after every packed overlay and every batch of bands. Returns the statistics.
+    """
+    votes = votes or len(paths) // 2 + 1
+    os.makedirs(output_folder, exist_ok=True)
+    work_folder = tempfile.mkdtemp(prefix="crackle_merge_")
+    packed = []
+    try:
+        size = None
+        for i, path in enumerate(paths):
+            width, height, annotator = pack_overlay(path, os.path.join(work_folder, f"{i}.npy"), threshold)
+            if size is not None and size != (width, height):
+                raise ValueError(f"{path} is {width}x{height}, the other overlays are {size[0]}x{size[1]}")
+            size = (width, height)
+            packed.append(annotator)
+            if progress is not None:
+                progress(i + 1, len(paths))
+
+        width, height = size
+        writers = {}
+        areas = np.zeros(len(paths), dtype=np.int64)
+        intersections = np.zeros((len(paths), len(paths)), dtype=np.int64)
+        bands = [(y0, min(height, y0 + tile_size)) for y0 in range(0, height, tile_size)]
+        workers = workers or os.cpu_count()
+        batch_size = 2 * workers
+
+        def merge(band):
+            outputs, band_areas, band_intersections = merge_overlay_band(packed, width, band[0], band[1], votes)
+            tiles = {name: [writers[name].encode_tile(image[:, x0:x0 + tile_size]) for x0 in range(0, width, tile_size)]
+                     for name, image in outputs.items()}
+            return tiles, band_areas, band_intersections
+
+        names = ["union", "intersection", f"vote_{votes}_of_{len(paths)}", "agreement"]
+        for name in names:
+            writers[name] = TiledTiffWriter(os.path.join(output_folder, f"{name}.tif"), tile_size, samples=1)
+            writers[name].begin_level(width, height)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for start in range(0, len(bands), batch_size):
+                    for tiles, band_areas, band_intersections in pool.map(merge, bands[start:start + batch_size]):
+                        for name, encoded in tiles.items():
+                            for data in encoded:
+                                writers[name].write_tile(data)
+                        areas += band_areas
+                        intersections += band_intersections
+                    if progress is not None:
+                        progress(len(paths) + min(len(bands), start + batch_size), len(paths) + len(bands))
+        finally:
+            for writer in writers.values():
+                writer.close()
+    finally:
+        # The memmaps have to be released before their files can be removed on Windows
+        packed.clear()
+        annotator = None
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    pairs = []
+    for i in range(len(paths)):
+        for j in range(i + 1, len(paths)):
+            union = areas[i] + areas[j] - intersections[i, j]
+            pairs.append({"a": paths[i], "b": paths[j], "intersection": int(intersections[i, j]), "union": int(union),
+                          "iou": float(intersections[i, j] / union) if union else 1.0})
+    stats = {
+        "width": width, "height": height, "threshold": threshold, "votes": votes,
+        "annotators": [{"path": path, "area": int(area)} for path, area in zip(paths, areas)],
+        "pairs": pairs,
+        "mean_iou": float(np.mean([pair["iou"] for pair in pairs])) if pairs else 1.0,
+    }
+    with open(os.path.join(output_folder, "stats.json"), "w") as file:
+        json.dump(stats, file, indent=2)
+    print(f"Merged {len(paths)} overlays into {output_folder}, mean pairwise IoU {stats['mean_iou']:.3f}")
+    return stats
+
+def load_overlay_file(path, progress=None):
+    """Load an overlay or sub-overlay image as 8 bit grayscale with its display pyramid, 16 bit tifs are scaled down."""
+    if ".png" in path:
+        return build_overlay_pyramid(Image.open(path).convert("L"))
+    elif ".tif" in path:
+        image = stream_tiff_overlay(path, progress)
+        if image is None:
+            # Compressions and layouts the streaming reader does not handle
+            image = build_overlay_pyramid(Image.fromarray(np.uint8(np.array(Image.open(path))//256)).convert("L"))
+        return image
+    else:
+        raise ValueError("File type not supported.")
+
+# Watched sub-overlay files are checked this often (seconds) and compared in tile squares of this size
+OVERLAY_WATCH_INTERVAL = 1.0
+OVERLAY_WATCH_TILE = 256
+
+def file_stat(path):
+    """(mtime, size) of a file, None if it is missing, e.g. while a writer replaces it."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def tile_digest(block):
+    return hashlib.blake2b(np.ascontiguousarray(block).tobytes(), digest_size=16).digest()
+
+def overlay_tile_hashes(image, tile=OVERLAY_WATCH_TILE):
+    """{(x0, y0): digest} of the tile squares of an "L" overlay."""
+    data = np.asarray(image)
+    return {(x0, y0): tile_digest(data[y0:y0 + tile, x0:x0 + tile])
+            for y0 in range(0, image.height, tile) for x0 in range(0, image.width, tile)}
+
+def tile_row_bands(bands, width, height, tile):
+    """Regroup the consecutive (y0, rows) bands of any height into bands of tile rows, the last one may be shorter."""
+    buffer = np.empty((tile, width), dtype=np.uint8)
+    filled = start = 0
+    for _, rows in bands:
+        while len(rows):
+            count = min(len(rows), tile - filled)
+            buffer[filled:filled + count] = rows[:count]
+            filled, rows = filled + count, rows[count:]
+            if filled == tile:
+                yield start, buffer
+                buffer, filled, start = np.empty((tile, width), dtype=np.uint8), 0, start + tile
+    if filled:
+        yield start, buffer[:filled]
+
+def reload_overlay_tiles(path, image, hashes=None, tile=OVERLAY_WATCH_TILE, job=None):
+    """
+    Re-read a changed overlay file and compare it tile by tile with hashes of the loaded image (computed
+    from image if None). Returns (hashes, changed, replacement): changed lists the (x0, y0, rows) tiles whose
+    content differs, replacement is a newly loaded image if the file does not have the size of image anymore.
+    """
+    if hashes is None:
+        hashes = overlay_tile_hashes(image, tile)
+    width, height, bands = overlay_row_bands(path, tile)
+    if (width, height) != image.size:
+        replacement = load_overlay_file(path)
+        return overlay_tile_hashes(replacement, tile), [], replacement
+    new_hashes, changed = {}, []
+    try:
+        for y0, rows in tile_row_bands(bands, width, height, tile):
+            if job is not None:
+                job.check()
+                job.report(y0 + len(rows), height)
+            for x0 in range(0, width, tile):
+                block = rows[:, x0:x0 + tile]
+                digest = tile_digest(block)
+                new_hashes[(x0, y0)] = digest
+                if hashes.get((x0, y0)) != digest:
+                    changed.append((x0, y0, block.copy()))
+    except OSError:
+        # Compressions the streaming reader does not handle, decode the whole file instead
+        data = np.asarray(load_overlay_file(path))
+        new_hashes, changed = {}, []
+        for (x0, y0), digest in overlay_tile_hashes(Image.fromarray(data, "L"), tile).items():
+            new_hashes[(x0, y0)] = digest
+            if hashes.get((x0, y0)) != digest:
+                changed.append((x0, y0, data[y0:y0 + tile, x0:x0 + tile].copy()))
+    return new_hashes, changed, None
+
+def apply_overlay_tiles(image, changed):
+    """
+    Paste reloaded tiles into an overlay and downsample the same areas of its display pyramid. Every level
+    is recomputed from the region of the overlay around the tiles that is aligned to its factor, for factors
+    above the tile size that region also covers unchanged neighbouring tiles.
+    """
+    levels = getattr(image, "pyramid_levels", None) or []
+    for x0, y0, block in changed:
+        image.paste(Image.fromarray(block, "L"), (x0, y0))
+    for i, level in enumerate(levels):
+        # Level i is reduced by 2 ** (i + 1)
+        factor = 2 ** (i + 1)
+        regions = {(x0 // factor * factor, y0 // factor * factor,
+                    min(image.width, math.ceil((x0 + block.shape[1]) / factor) * factor),
+                    min(image.height, math.ceil((y0 + block.shape[0]) / factor) * factor)) for x0, y0, block in changed}
+        for region in regions:
+            level.paste(image.crop(region).reduce(factor), (region[0] // factor, region[1] // factor))
+
+class OverlayWatcher:
+    """
+    Polls the files of loaded sub-overlays for changes of their mtime or size. A change is reported once the
+    file kept the same stat for a whole interval, so files that are still being written are not read half way.
+    """
+    def __init__(self, interval=OVERLAY_WATCH_INTERVAL):
+        self.interval = interval
+        self.watches = []
+        self.last_poll = 0.0
+
+    def watch(self, path, image):
+        self.watches.append({"path": path, "image": image, "stat": file_stat(path), "pending": None, "hashes": None})
+
+    def retain(self, images):
+        """Stop watching the files of overlays that were removed."""
+        self.watches = [watch for watch in self.watches if any(watch["image"] is image for image in images)]
+
+    def changed(self):
+        """The watches whose file changed and settled since it was last loaded, checked at most once per interval."""
+        now = time.monotonic()
+        if now - self.last_poll < self.interval:
+            return []
+        self.last_poll = now
+        ready = []
+        for watch in self.watches:
+            stat = file_stat(watch["path"])
+            if stat is None or stat == watch["stat"]:
+                watch["pending"] = None
+                continue
+            if stat == watch["pending"]:
+                ready.append(watch)
+            watch["pending"] = stat
+        return ready
+
+SESSION_VERSION = 1
+# ViewState fields that change the projection, the others only change how it is drawn
+PROJECTION_FIELDS = ("image_index", "radius", "direction", "operation", "min_value", "max_value", "contrast_enhance")
+
+class SessionRecorder:
+    """
+    Records an interaction session as the view state of every frame, labeled with the input event that caused it,
+    and the volume and overlay edits made before it. The recording can be replayed without a display.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.records = []
+        self.pending_ops = []
+        self.unlabeled = []
+        self.overlay_files = {}
+
+    def op(self, name, **params):
+        with self.lock:
+            self.pending_ops.append(dict(params, op=name))
+
+    def overlay_snapshot(self, image):
+        """Keep a copy of an overlay that exists when recording starts, it is saved next to the session."""
+        index = len(self.overlay_files)
+        self.overlay_files[index] = image.copy()
+        return index
+
+    def frame(self, state, seconds):
+        # Frames drawn by worker threads such as the flood fill belong to no input event
+        background = threading.current_thread() is not threading.main_thread()
+        record = {
+            "t": time.perf_counter() - self.start,
+            "event": "async" if background else None,
+            "seconds": seconds,
+            "state": state.to_dict(),
+        }
+        with self.lock:
+            record["ops"] = self.pending_ops
+            self.pending_ops = []
+            self.records.append(record)
+            if not background:
+                self.unlabeled.append(record)
+
+    def input(self, label):
+        """Label the frames drawn while handling an input event, the event handlers run before this is called."""
+        with self.lock:
+            for record in self.unlabeled:
+                record["event"] = label
+            self.unlabeled = []
+
+    def save(self, path):
+        base = os.path.splitext(path)[0]
+        overlay_names = {}
+        for index, image in self.overlay_files.items():
+            overlay_path = f"{base}_overlay{index}.png"
+            image.save(overlay_path)
+            overlay_names[index] = os.path.basename(overlay_path)
+        with self.lock:
+            records = list(self.records)
+        with open(path, "w") as file:
+            file.write(json.dumps({"session_version": SESSION_VERSION, "frames": len(records)}) + "\n")
+            for record in records:
+                for op in record["ops"]:
+                    if "snapshot" in op:
+                        op["path"] = overlay_names[op.pop("snapshot")]
+                if record["event"] is None:
+                    record["event"] = "unlabeled"
+                file.write(json.dumps(record) + "\n")
+        print(f"Saved {len(records)} frames to {path}")
+
+def load_session(path):
+    with open(path) as file:
+        header = json.loads(file.readline())
+        if header.get("session_version") != SESSION_VERSION:
+            raise ValueError(f"Unsupported session version {header.get('session_version')} in {path}")
+        return [json.loads(line) for line in file if line.strip()]
+
+class SessionReplay:
+    """Replays a recorded session on a RenderEngine and measures the time every frame takes."""
+    def __init__(self, path, engine=None):
+        self.folder = os.path.dirname(os.path.abspath(path))
+        self.records = load_session(path)
+        self.engine = engine or RenderEngine()
+        self.sub_overlays = []
+        self.projected = None
+        self.brush = Brush()
+
+    def resolve(self, path):
+        if path.startswith(("http://", "https://")) or os.path.isabs(path):
+            return path
+        return os.path.join(self.folder, path)
+
+    def apply_op(self, op):
+        name = op["op"]
+        if name == "open_volume":
+            self.engine.open_volume(open_volume_source(self.resolve(op["path"])))
+            self.projected = None
+        elif name == "load_overlay":
+            image = load_overlay_file(self.resolve(op["path"]))
+            self.sub_overlays[:1] = [image]
+        elif name == "create_overlay":
+            height, width = self.engine.volume_source.shape()
+            self.sub_overlays[:1] = [Image.new("L", (width, height), "black")]
+        elif name == "load_suboverlay":
+            self.sub_overlays.append(load_overlay_file(self.resolve(op["path"])))
+        elif name == "clear_suboverlays":
+            self.sub_overlays = self.sub_overlays[:1]
+        elif name == "select_suboverlay":
+            index = op["index"]
+            self.sub_overlays[0], self.sub_overlays[index] = self.sub_overlays[index], self.sub_overlays[0]
+        elif name == "paint":
+            # Sessions recorded before the brush modes store the pencil color
+            mode = op.get("mode", "erase" if op.get("color") == "black" else "paint")
+            self.brush.stroke(self.sub_overlays[0], op["points"][0], op["points"][1], op["width"], mode)
+        elif name == "flood_fill":
+            projection = self.engine.full_resolution_projection()
+            if projection is not None:
+                image, (x0, y0) = projection
+                x, y = op["start"]
+                mask = Image.new("L", image.size, "black")
+                flood_fill_image(image, mask, (x - x0, y - y0), op["threshold"], op["steps"])
+                paint_mask(self.sub_overlays[0], np.array(mask) > 0, (x0, y0))
+        elif name == "flood_fill_3d":
+            x, y = op["start"]
+            start_index = max(0, op["image_index"] - op["layers"])
+            end_index = min(len(self.engine.volume_source.layer_names), op["image_index"] + op["layers"] + 1)
+            y0, y1, x0, x1 = op["window"]
+            volume = self.engine.volume_source.read(start_index, end_index, (y0, y1, x0, x1))
+            mask = flood_fill_volume(volume, (op["image_index"] - start_index, y - y0, x - x0), op["threshold"], op["max_voxels"])
+            paint_mask(self.sub_overlays[0], mask.any(axis=0), (x0, y0))
+        else:
+            raise ValueError(f"Unknown session operation {name}")
+
+    def replay_frame(self, record):
+        for op in record["ops"]:
+            self.apply_op(op)
+        state = ViewState.from_dict(record["state"])
+        state.sub_overlays = self.sub_overlays
+        state.overlay_image = self.sub_overlays[0] if self.sub_overlays else None
+        # Project again when the layers or projection settings changed or the view left the loaded window
+        projection = tuple(getattr(state, field) for field in PROJECTION_FIELDS)
+        if projection != self.projected or not self.engine.visible_window_loaded(state):
+            self.engine.process_images(state)
+            self.projected = projection
+        if self.engine.pil_image is not None:
+            return self.engine.render_frame(state)
+
+    def run(self, on_frame=None):
+        """Replay every frame in order, returns a list of (event, seconds, recorded seconds)."""
+        latencies = []
+        for record in self.records:
+            start = time.perf_counter()
+            frame = self.replay_frame(record)
+            latencies.append((record["event"], time.perf_counter() - start, record.get("seconds")))
+            if on_frame is not None:
+                on_frame(record, frame)
+        return latencies
+
+def latency_percentiles(seconds, percentiles=(50, 90, 95, 99)):
+    values = np.percentile(np.asarray(seconds, dtype=np.float64), percentiles)
+    result = {f"p{p}": float(value) for p, value in zip(percentiles, values)}
+    result["max"] = float(np.max(seconds))
+    result["count"] = len(seconds)
+    return result
+
+class ViewportPane:
+    """
+    Another pane of a split view. It follows the zoom, rotation, position and layer of the main canvas,
+    has its own projection and overlay settings, and renders with a RenderEngine pane of the main engine.
+    """
+    def __init__(self, app, name):
+        self.app = app
+        self.engine = app.engine.add_pane(name)
+        self.frame = tk.Frame(app.master)
+        toolbar = tk.Frame(self.frame)
+        toolbar.pack(side=tk.TOP, fill=tk.X)
+        self.operation_var = tk.StringVar(value=app.operation_var.get())
+        tk.OptionMenu(toolbar, self.operation_var, "max", "min", "mean", command=lambda _: app.redraw_image()).pack(side=tk.LEFT)
+        tk.Label(toolbar, text="Radius:").pack(side=tk.LEFT)
+        self.radius_var = tk.StringVar(value=app.radius_var.get())
+        radius_entry = tk.Entry(toolbar, textvariable=self.radius_var, width=4)
+        radius_entry.pack(side=tk.LEFT)
+        radius_entry.bind("<Return>", lambda _: (app.master.focus(), app.redraw_image()))
+        self.overlay_visibility = tk.BooleanVar(value=app.overlay_visibility.get())
+        tk.Checkbutton(toolbar, text="Overlays", variable=self.overlay_visibility, command=app.redraw_image).pack(side=tk.LEFT)
+        tk.Button(toolbar, text="Close", command=lambda: app.close_pane(self)).pack(side=tk.RIGHT)
+        self.canvas = tk.Canvas(self.frame, background="black")
+        self.canvas.pack(expand=True, fill=tk.BOTH)
+        self.canvas_image_item = None
+        self.image = None
+        self.frame.pack(before=app.canvas, side=tk.RIGHT, expand=True, fill=tk.BOTH)
+
+    def view_state(self, state):
+        """The main view state with the settings of this pane, taken on the Tk thread."""
+        try:
+            radius = int(self.radius_var.get())
+        except ValueError:
+            radius = state.radius
+        return ViewState(**dict(vars(state), canvas_width=self.canvas.winfo_width(), canvas_height=self.canvas.winfo_height(),
+                                operation=self.operation_var.get(), radius=radius, overlay_visibility=self.overlay_visibility.get()))
+
+    def show(self, frame):
+        if frame is None:
+            return
+        self.image = ImageTk.PhotoImage(image=frame)
+        if self.canvas_image_item is None or not self.canvas.type(self.canvas_image_item):
+            self.canvas_image_item = self.canvas.create_image(0, 0, anchor='nw', image=self.image)
+        else:
+            self.canvas.itemconfig(self.canvas_image_item, image=self.image)
+
+    def destroy(self):
+        self.app.engine.remove_pane(self.engine)
+        self.frame.destroy()
+
 class Application(tk.Frame):
     def __init__(self, master=None):
         super().__init__(master)
+        self.engine = RenderEngine(cache=open_derived_cache(), track_memory=True)
         self.base_dir = os.path.dirname(os.path.abspath(__file__))
         self.my_title = "Vesuvius Crackle Viewer"
         self.master.title(self.my_title)
@@ -128,7 +3435,6 @@ class Application(tk.Frame):
         self.master.minsize(width=800, height=600)
         self.load_last_directory()  # Load the last directory
         self.images_folder = ""
-        self.pil_image = None
         self.min_value = 0.0
         self.max_value = 65535.0
         self.sub_overlays = []
@@ -141,6 +3447,13 @@ class Application(tk.Frame):
         self.create_widget()
         self.reset_transform()
         self.image_list = []
+        self.canvas_image_item = None
+        self.hud_item = None
+        # Split view panes, rendered next to the main canvas in their own threads
+        self.panes = []
+        self.pane_pool = ThreadPoolExecutor(max_workers=4)
+        self.volume_path = None
+        self.session_recorder = None
         self.image_index = 0
         self.last_directory_overlay = None
         self.last_directory_suboverlay = None
@@ -149,21 +3462,44 @@ class Application(tk.Frame):
         self.mouse_is_pressed = False
         self.overlay_image = None
         self.overlay_visibility = tk.BooleanVar(value=True)
-        self.pencil_color = 'white'
+        self.brush = Brush()
+        self.brush_mode = "paint"
+        self.redraw_pending = None
         self.pencil_size = 45
-        self.flood_fill_active = False
+        self.jobs = JobScheduler(max_workers=2)
+        self.preload_job = None
+        self.ink_statistics = OverlayStatistics()
+        self.overlay_watcher = OverlayWatcher()
+        memory.register("overlays", self.overlays_memory_usage, priority=MEMORY_PRIORITY_VISIBLE)
+        self.mesh_vertices = None
+        self.kd_tree = None
+        self.triangle_data = None
+        # Reverse lookup index of the mesh, built when first needed, and the image points of the last lookup
+        self.mesh_index_3d = None
+        self.markers = None
         self.ff_threshold = 10
         self.max_propagation_steps = 10
         self.global_scale_factor = 1.0
         self.micron_factor = 0.00324
-        self.resampling_methods = {
-            "NEAREST": Image.Resampling.NEAREST,
-            "BILINEAR": Image.Resampling.BILINEAR,
-            "BICUBIC": Image.Resampling.BICUBIC,
-        }
         self.resample_method = tk.StringVar(value="NEAREST")
+        self.render_backend_var = tk.StringVar(value="auto")
 
         self.create_overlay_controls()
+        self.poll_jobs()
+        # Load the heavy modules while the user picks a segment
+        self.master.after(100, lambda: threading.Thread(target=warm_up_imports, daemon=True).start())
+
+    @property
+    def pil_image(self):
+        return self.engine.pil_image
+
+    @pil_image.setter
+    def pil_image(self, image):
+        self.engine.pil_image = image
+
+    @property
+    def volume_source(self):
+        return self.engine.volume_source
 
     def menu_open_clicked(self, event=None):
         self.load_images()
@@ -172,6 +3508,13 @@ class Application(tk.Frame):
         except:
             pass
 
+    def menu_open_url_clicked(self, event=None):
+        url = tk.simpledialog.askstring("Open URL", "Segment URL (containing layers/ or surface_volume/):", parent=self.master)
+        if url:
+            self.volume_path = url.strip()
+            self.record_op("open_volume", path=self.volume_path)
+            self.open_volume(open_volume_source(self.volume_path))
+
     def menu_quit_clicked(self):
         self.master.destroy() 
 
@@ -182,11 +3525,33 @@ class Application(tk.Frame):
         self.menu_bar.add_cascade(label="File", menu=self.file_menu)
 
         self.file_menu.add_command(label="Open", command = self.menu_open_clicked, accelerator="Ctrl+O")
+        self.file_menu.add_command(label="Open URL", command = self.menu_open_url_clicked)
         self.file_menu.add_separator() 
         self.file_menu.add_command(label="Exit", command = self.menu_quit_clicked)
 
         self.menu_bar.bind_all("<Control-o>", self.menu_open_clicked)
 
+        self.view_menu = tk.Menu(self.menu_bar, tearoff=tk.OFF)
+        self.menu_bar.add_cascade(label="View", menu=self.view_menu)
+        self.show_hud_var = tk.BooleanVar(value=False)
+        self.record_trace_var = tk.BooleanVar(value=False)
+        self.view_menu.add_checkbutton(label="Performance HUD", variable=self.show_hud_var, command=self.toggle_hud, accelerator="F3")
+        self.view_menu.add_checkbutton(label="Record Trace", variable=self.record_trace_var, command=self.toggle_trace_recording)
+        self.record_session_var = tk.BooleanVar(value=False)
+        self.view_menu.add_checkbutton(label="Record Session", variable=self.record_session_var, command=self.toggle_session_recording)
+        self.show_ink_stats_var = tk.BooleanVar(value=True)
+        self.view_menu.add_checkbutton(label="Ink Statistics", variable=self.show_ink_stats_var)
+        self.watch_suboverlays_var = tk.BooleanVar(value=True)
+        self.view_menu.add_checkbutton(label="Reload Changed Sub-Overlays", variable=self.watch_suboverlays_var)
+        self.view_menu.add_separator()
+        self.view_menu.add_command(label="Add Split Pane", command=self.add_pane)
+        self.view_menu.add_command(label="Go to 3D Point...", command=self.goto_3d_point, accelerator="Ctrl+G")
+        self.view_menu.add_command(label="Load 3D Points...", command=self.load_3d_points)
+        self.view_menu.add_command(label="Clear 3D Markers", command=self.clear_markers)
+        self.view_menu.add_command(label="Memory Budget...", command=self.set_memory_budget)
+        self.menu_bar.bind_all("<F3>", self.toggle_hud_key)
+        self.menu_bar.bind_all("<Control-g>", self.goto_3d_point)
+
         self.help_menu = tk.Menu(self.menu_bar, tearoff=tk.OFF)
         self.menu_bar.add_command(label="Help", command=self.show_help)
 
@@ -209,19 +3574,29 @@ class Application(tk.Frame):
         self.save_combined_btn = tk.Button(self.overlay_frame, text="Save Combined Overlays", command=self.save_combined_overlays)
         self.save_combined_btn.pack(side=tk.LEFT)
 
+        self.merge_overlays_btn = tk.Button(self.overlay_frame, text="Merge Overlays", command=self.merge_annotator_overlays)
+        self.merge_overlays_btn.pack(side=tk.LEFT)
+
         self.save_displayed_btn = tk.Button(self.overlay_frame, text="Save Displayed Image", command=self.save_displayed_image)
         self.save_displayed_btn.pack(side=tk.LEFT)
 
+        self.export_composite_btn = tk.Button(self.overlay_frame, text="Export Composite", command=self.export_composite)
+        self.export_composite_btn.pack(side=tk.LEFT)
+
+        self.export_sweep_btn = tk.Button(self.overlay_frame, text="Export Sweep", command=self.export_layer_sweep)
+        self.export_sweep_btn.pack(side=tk.LEFT)
+
         
         self.overlay_check = tk.Checkbutton(self.overlay_frame, text="Show Overlay", variable=self.overlay_visibility, command=self.toggle_overlay)
         self.overlay_check.pack(side=tk.LEFT)
         
-        self.color_btn = tk.Button(self.overlay_frame, text="Toggle Color", command=self.toggle_color)
+        self.color_btn = tk.Button(self.overlay_frame, text="Paint", width=5, command=self.toggle_brush_mode)
         self.color_btn.pack(side=tk.LEFT)
 
-        self.color_label = tk.Label(self.overlay_frame, text="", width=5, background=self.pencil_color)
+        self.color_label = tk.Label(self.overlay_frame, text="", width=5)
         self.color_label.pack(side=tk.LEFT, padx=5)
-        self.color_label.bind("<Button-1>", lambda e: self.toggle_color()) # Add this line in create_overlay_controls method
+        self.color_label.bind("<Button-1>", lambda e: self.toggle_brush_mode()) # Add this line in create_overlay_controls method
+        self.update_brush_label()
 
         # Add slider for overlay opacity control
         self.overlay_opacity_scale = tk.Scale(self.overlay_frame, from_=0, to_=255, orient=tk.HORIZONTAL, label="Overlay Opacity", length=175)
@@ -281,11 +3656,23 @@ class Application(tk.Frame):
         self.resample_method_optionmenu = tk.OptionMenu(
             self.suboverlay_frame, 
             self.resample_method, 
-            *self.resampling_methods.keys(),
+            *RESAMPLING_METHODS.keys(),
             command=self.on_resample_method_changed
         )
         self.resample_method_optionmenu.pack(side=tk.LEFT)
 
+        # Dropdown menu for the render backend, "auto" benchmarks the backends on first use
+        self.render_backend_label = tk.Label(self.suboverlay_frame, text="Render Backend:")
+        self.render_backend_label.pack(side=tk.LEFT)
+        self.render_backend_optionmenu = tk.OptionMenu(
+            self.suboverlay_frame,
+            self.render_backend_var,
+            "auto",
+            *self.engine.render_backends.keys(),
+            command=lambda _: self.redraw_image()
+        )
+        self.render_backend_optionmenu.pack(side=tk.LEFT)
+
         # Set min and max values for the image
         self.minmax_label = tk.Label(self.overlay_frame, text="Min Max image values:")
         self.minmax_label.pack(side=tk.LEFT)
@@ -299,6 +3686,9 @@ class Application(tk.Frame):
         self.max_value_entry.insert(tk.END, '65535')
         self.max_value_entry.bind('<Return>', self.set_max_min_from_entry)
 
+        self.auto_window_var = tk.StringVar(value="Auto")
+        tk.OptionMenu(self.overlay_frame, self.auto_window_var, *AUTO_WINDOW_PRESETS, command=self.apply_auto_window).pack(side=tk.LEFT)
+
         # micron factor for the image
         self.micron_label = tk.Label(self.overlay_frame, text="Micron Factor:")
         self.micron_label.pack(side=tk.LEFT)
@@ -387,6 +3777,14 @@ class Application(tk.Frame):
             command=self.toggle_preload
         )
         self.preload_images_check.pack(side=tk.LEFT)
+        self.compress_preload_var = tk.BooleanVar(value=slice_codec(SLICE_CODEC) is not None)
+        self.compress_preload_check = tk.Checkbutton(
+            self.image_processing_frame,
+            text="Compressed",
+            variable=self.compress_preload_var,
+            command=self.toggle_preload
+        )
+        self.compress_preload_check.pack(side=tk.LEFT)
 
         self.layer_control_frame = tk.Frame(self.master)
         self.layer_control_frame.pack(side=tk.TOP, fill=tk.X, padx=10, pady=10)
@@ -402,12 +3800,34 @@ class Application(tk.Frame):
         self.set_layer_btn = tk.Button(self.layer_control_frame, text="Set Layer", command=self.set_layer_from_entry)
         self.set_layer_btn.pack(side=tk.LEFT, padx=5)
 
+        # 3D flood fill across the neighbouring layers
+        self.flood_fill_3d_var = tk.BooleanVar(value=False)
+        self.flood_fill_3d_check = tk.Checkbutton(self.layer_control_frame, text="3D Flood Fill", variable=self.flood_fill_3d_var)
+        self.flood_fill_3d_check.pack(side=tk.LEFT, padx=(20, 5))
+
+        tk.Label(self.layer_control_frame, text="FF Layers:").pack(side=tk.LEFT, padx=(5, 2))
+        self.ff_layers_var = tk.StringVar(value="5")
+        tk.Entry(self.layer_control_frame, textvariable=self.ff_layers_var, width=4).pack(side=tk.LEFT, padx=2)
+
+        tk.Label(self.layer_control_frame, text="Max Voxels:").pack(side=tk.LEFT, padx=(5, 2))
+        self.ff_max_voxels_var = tk.StringVar(value="5000000")
+        tk.Entry(self.layer_control_frame, textvariable=self.ff_max_voxels_var, width=9).pack(side=tk.LEFT, padx=2)
+
+        self.ff_output_var = tk.StringVar(value="Projection")
+        tk.OptionMenu(self.layer_control_frame, self.ff_output_var, "Projection", "Mask Stack").pack(side=tk.LEFT, padx=5)
+
     def create_widget(self):
 
         frame_statusbar = tk.Frame(self.master, bd=1, relief = tk.SUNKEN)
         self.label_image_info = tk.Label(frame_statusbar, text="image info", anchor=tk.E, padx = 5)
         self.label_image_pixel = tk.Label(frame_statusbar, text="2D: (x, y) 3D: (x, y, z)", anchor=tk.W, padx = 5)
         self.label_image_info.pack(side=tk.RIGHT)
+        self.label_jobs = tk.Label(frame_statusbar, text="", anchor=tk.E, padx = 5)
+        self.label_jobs.pack(side=tk.RIGHT)
+        self.label_memory = tk.Label(frame_statusbar, text="", anchor=tk.E, padx = 5)
+        self.label_memory.pack(side=tk.RIGHT)
+        self.label_ink_stats = tk.Label(frame_statusbar, text="", anchor=tk.E, padx = 5)
+        self.label_ink_stats.pack(side=tk.RIGHT)
         self.label_image_pixel.pack(side=tk.LEFT)
         frame_statusbar.pack(side=tk.BOTTOM, fill=tk.X)
 
@@ -431,7 +3851,11 @@ class Application(tk.Frame):
         self.master.bind("<KeyRelease-Control_R>", self.shift_release)
         self.master.bind("<space>", lambda _: {self.overlay_visibility.set(not self.overlay_visibility.get()), self.redraw_image()})           # Spacebar
         self.master.bind("r", self.reset_to_middle_image)
-        self.master.bind("c", self.toggle_color)
+        self.master.bind("c", self.toggle_brush_mode)
+        self.master.bind("<Escape>", self.cancel_jobs)
+        # Labels the frames of a recorded session with the input event that caused them
+        for sequence in ("<KeyPress>", "<ButtonPress>", "<B1-Motion>", "<B3-Motion>", "<MouseWheel>"):
+            self.master.bind_all(sequence, self.record_input, add="+")
 
         
         if sys.platform == 'linux':  # Linux OS
@@ -455,24 +3879,40 @@ class Application(tk.Frame):
         help_message = textwrap.dedent("""
         Vesuvius Crackle Viewer Usage:
 
-        - Open: Ctrl+O to open image.
+        - Open: Ctrl+O to open image. Select a segment folder with a layers or surface_volume folder of tif/png/jpg images, or a Zarr/OME-Zarr volume (layers.zarr, surface_volume.zarr or the store itself).
+        - Open URL: Open a segment served over HTTP (per layer tif files in layers/ or surface_volume/). Only the visible part of the layers is downloaded and kept in a local cache.
         - Exit: Close the application.
+        - View > Performance HUD (F3): Show the time spent in each part of the last frame and the cache hit rates.
+        - View > Record Session: Record the frames, input events and overlay edits until unchecked, then save them as a session that benchmark.py --replay replays without a display.
+        - View > Add Split Pane: Show the volume in another pane next to the main canvas, with its own projection (operation, radius) and overlay visibility, to compare settings side by side. Zoom, rotation, position and layer stay linked to the main view; the panes share the loaded layers and caches.
+        - View > Go to 3D Point (Ctrl+G): Enter x y z scroll coordinates (several separated by ;) to mark them on the segment and center the view on them. Needs the OBJ mesh of the segment.
+        - View > Load 3D Points: Locate a file of x y z points (one per line) at once, the image pixels are saved next to it as <file>_uv.csv.
+        - View > Memory Budget: Cap the memory of preloaded layers, pyramid levels, the projection and the overlays. Preloaded layers are dropped first when the cap is reached; the usage per category is shown in the status bar.
+        - View > Record Trace: Record timing spans until unchecked, then save them as a Chrome trace (chrome://tracing or ui.perfetto.dev).
         - Use the Ctrl key while dragging to draw on the overlay.
         - Double click to zoom fit.
         - Use the mouse wheel to zoom in/out.
         - Ctrl + Mouse wheel to rotate the image.
         - Space to toggle overlay visibility.
         - R to reset to the middle image.
-        - C to toggle the drawing color.
+        - C to switch the brush between paint and erase.
         - Double click inside the image to reset the zoom, rotation and slice.
         - F to flood fill from the selected point
+        - Preload Images: Read all layers into memory in the background. With Compressed they are kept losslessly compressed (lz4, or CRACKLE_SLICE_CODEC) and decompressed when shown, so several times more layers fit into the memory budget.
+        - Esc to cancel the running background jobs (preload, flood fill, OBJ loading, saving). Their progress is shown in the status bar.
 
         Overlay Controls:
         - Load Overlay: Load an overlay image.
         - Create Empty Image: Create an empty overlay.
         - Save Overlay: Save the current overlay.
         - Save Combined Overlays: Save the combined image of the overlay and all sub-overlays.
-        - Toggle Color: Switch between drawing colors.
+        - Auto (next to the Min Max image values): Set the value range from percentiles of the histograms of the current layers or of the visible projection.
+        - Reload Changed Sub-Overlays (View menu): Sub-overlay files rewritten on disk, e.g. by a running ink detection, are reloaded in the background. Only the changed parts are swapped in.
+        - Ink Statistics (View menu): Show the labeled area in \u00b5m\u00b2, the number of connected strokes and the area of every sub-overlay with the share of it that is labeled in the status bar, updated while you draw.
+        - Merge Overlays: Merge the overlays of several annotators into union, intersection, k-of-N vote and agreement images, and report their pairwise IoU. Also available without the viewer as merge_overlays.py.
+        - Export Sweep: Render the current view (zoom, rotation, projection, contrast, overlays) for every layer of a range, in parallel, into an MP4/AVI video or a folder of PNG frames. Enter the range as start-end@fps.
+        - Export Composite: Render the projection with the colored overlays and the ruler, as drawn on the canvas, at source (or a chosen) resolution into a tiled pyramidal BigTIFF.
+        - Paint / Erase: Switch the brush between painting labels and erasing them (also the "C" key).
         - Overlay Opacity: Adjust the opacity of the overlay.
         - Pick Color: Choose a custom drawing color.
         - Adjust the Pencil Size for drawing on the overlay.
@@ -484,6 +3924,7 @@ class Application(tk.Frame):
         - SubOverlay Opacity: Adjust the opacity of the SubOverlay.
         - Max Propagation: Select the max numbers of points to color with flood fill
         - FF Threshold: Specify the threshold to color adjacent points with flood fill
+        - 3D Flood Fill: F grows the region through FF Layers layers before and after the current one, up to Max Voxels voxels, in the visible part of the volume, about three bytes of memory per voxel of those layers times the visible window. Projection paints the grown region into the overlay, Mask Stack saves one mask image per layer to a folder.
         - Reset Slice: Reset to the middle image.
         - Composite image: Compose multiple tif images into one image. Can use min, max or mean operation. Can specify the number of slices and direction of the images to be composed.
         - Preload Images: Preload all images in the folder. This will speed up the navigation between images and composition of images.
@@ -509,38 +3950,58 @@ class Application(tk.Frame):
 
     def toggle_preload(self):
         if self.preload_images_var.get():
+            self.flush_preloaded_images()
             self.preload_all_images()
         else:
             self.flush_preloaded_images()
 
     def preload_all_images(self):
-        self.preloaded_images = {}
-
-        with Pool() as pool:
-            results = list(tqdm(pool.imap(load_image_parallel, self.image_list), total=len(self.image_list)))
-            
-        for filename, image in results:
-            self.preloaded_images[filename] = image
-
-    ## Single threaded version
-    # def preload_all_images(self):
-    #     self.preloaded_images = {}
-    #     for i, img_path in enumerate(tqdm(self.image_list)):
-    #         self.preloaded_images[img_path] = self.load_image(img_path, as_np=True)
+        if self.volume_source is None:
+            return
+        volume_source = self.volume_source
+        if hasattr(volume_source, "slice_codec"):
+            codec = SLICE_CODEC if slice_codec(SLICE_CODEC) is not None else "lz4"
+            volume_source.slice_codec = codec if self.compress_preload_var.get() else None
+        def preload(job):
+            volume_source.preload(progress=lambda done, total: (job.check(), job.report(done, total)))
+            # The layers are in memory now, their histograms come almost for free
+            if self.engine.volume_source is volume_source:
+                self.engine.index_layer_histograms(progress=lambda done, total: job.check())
+        self.preload_job = self.jobs.submit("Preload", preload, key=volume_source)
 
     def flush_preloaded_images(self):
-        self.preloaded_images = {}
+        if self.preload_job is not None:
+            self.preload_job.cancel()
+            self.preload_job = None
+        if self.volume_source is not None:
+            self.volume_source.flush()
+
+    def poll_jobs(self):
+        self.jobs.poll()
+        if self.session_recorder is not None:
+            # Frames drawn by the job callbacks
+            self.session_recorder.input("Job")
+        self.label_jobs["text"] = self.jobs.status()
+        self.label_memory["text"] = memory.status()
+        self.update_ink_statistics()
+        self.reload_changed_suboverlays()
+        self.master.after(50, self.poll_jobs)
+
+    def overlays_memory_usage(self):
+        images = {id(image): image for image in [self.overlay_image] + list(getattr(self, "sub_overlays", []))}
+        return sum(image_nbytes(image) + sum(image_nbytes(level) for level in getattr(image, "pyramid_levels", ()))
+                   for image in images.values())
+
+    def set_memory_budget(self):
+        budget = tk.simpledialog.askfloat("Memory Budget", "Memory budget in GB:", initialvalue=round(memory.budget / 1024**3, 1),
+                                          minvalue=0.1, parent=self.master)
+        if budget is not None:
+            memory.budget = int(budget * 1024**3)
+            memory.enforce()
+
+    def cancel_jobs(self, event=None):
+        self.jobs.cancel_all()
 
-    def load_image(self, filename, as_np=False):
-        if self.preload_images_var.get() and filename in self.preloaded_images:
-            pil_image = self.preloaded_images[filename]
-        else:
-            pil_image = load_image_disk(filename)
-        # pil_image = np.clip(pil_image, 0, 255)
-        if not as_np:
-            pil_image = Image.fromarray(np.uint8(pil_image)).convert("L")
-        return pil_image
-    
     def load_images(self):
         initial_dir =self.last_directory if self.last_directory else os.getcwd()
         images_path = tk.filedialog.askdirectory(
@@ -548,45 +4009,95 @@ class Application(tk.Frame):
         )
         if images_path:
             self.last_directory = images_path
-            # Create surface volume dir
-            surface_volume_path = os.path.join(images_path, "layers")
-            if not os.path.exists(surface_volume_path):
-                 surface_volume_path = os.path.join(images_path, "surface_volume")
-            print(surface_volume_path)
-            self.images_folder = surface_volume_path.rsplit('/', 1)[-1]
             self.save_last_directory()  # Save the last_directory
-            self.image_list = sorted(glob.glob(os.path.join(surface_volume_path, f'*.tif')))
-            #hacky way to get png and jpg file stacks
-            if len(self.image_list) == 0:
-                self.image_list = sorted(glob.glob(os.path.join(surface_volume_path, f'*.png')))
-            if len(self.image_list) == 0:
-                self.image_list = sorted(glob.glob(os.path.join(surface_volume_path, f'*.jpg')))
-            if len(self.image_list) == 0:
-                print("No tif, png or jpg images found in the directory.")
-            self.image_index = len(self.image_list) // 2
-            
-            if self.preload_images_var.get():
-                self.preload_all_images()
-            self.set_image(self.image_list[self.image_index])
+            self.volume_path = images_path
+            self.record_op("open_volume", path=images_path)
+            self.open_volume(open_volume_source(images_path))
+
+    def open_volume(self, volume_source):
+        self.engine.open_volume(volume_source)
+        self.images_folder = self.volume_source.folder.rsplit('/', 1)[-1]
+        self.image_list = self.volume_source.layer_names
+        if len(self.image_list) == 0:
+            print("No tif, png or jpg images found in the directory.")
+        self.image_index = len(self.image_list) // 2
+
+        if self.preload_images_var.get():
+            self.preload_all_images()
+        self.set_image(self.image_list[self.image_index])
     
     def load_obj(self):
-        # Load the obj file(s) from the self.last_directory
-        obj_files = sorted(glob.glob(os.path.join(self.last_directory, f'*.obj')))
-        # filter the obj files with uv coordinates. load and check
-        obj_file = None
-        for obj in obj_files:
-            # open3d open
-            mesh = o3d.io.read_triangle_mesh(obj)
-            if len(mesh.triangle_uvs) > 0:
-                obj_file = obj
-                break
-        if obj_file:
-            print(f"Loaded obj file: {obj_file}")
-            self.mesh = o3d.io.read_triangle_mesh(obj_file)
-            self.mesh_vertices = np.array(self.mesh.vertices)
-            print("Preprocessing obj transformation ... ")
-            self.kd_tree, self.triangle_data = preprocess_uv_triangles(self.mesh)
-            print("Preprocessing obj transformation done.")
+        folder = self.last_directory
+        self.jobs.submit("Load OBJ", lambda job: load_uv_mesh(folder, job), key="mesh", on_done=self.set_uv_mesh)
+
+    def set_uv_mesh(self, result):
+        if result is not None:
+            self.mesh, self.mesh_vertices, self.kd_tree, self.triangle_data = result
+            self.mesh_index_3d = None
+
+    def goto_3d_point(self, event=None):
+        text = tk.simpledialog.askstring("Go to 3D Point", "x y z of one or more points (separated by ;):", parent=self.master)
+        if text:
+            self.locate_3d_points(parse_points(text))
+
+    def load_3d_points(self):
+        file_path = tk.filedialog.askopenfilename(filetypes=[("Point lists", "*.txt *.csv *.xyz"), ("All files", "*.*")],
+                                                  initialdir=self.last_directory or os.getcwd())
+        if file_path:
+            with open(file_path) as file:
+                points = parse_points(file.read())
+            self.locate_3d_points(points, output_path=os.path.splitext(file_path)[0] + "_uv.csv")
+
+    def locate_3d_points(self, points, output_path=None):
+        """Find the image pixels of 3D points on the mesh in the background, then mark them and center the view on them."""
+        if self.kd_tree is None:
+            print("Load the OBJ mesh of the segment first.")
+            return
+        if len(points) == 0:
+            print("No x y z points found.")
+            return
+        height, width = self.volume_source.shape()
+
+        def locate(job):
+            if self.mesh_index_3d is None:
+                self.mesh_index_3d = build_mesh_index_3d(self.mesh_vertices, self.triangle_data)
+            job.check()
+            uv, distances = find_3d_points_uv(points, self.mesh_index_3d)
+            image_points = uv_to_image_points(uv, width, height)
+            if output_path is not None:
+                np.savetxt(output_path, np.column_stack([points, image_points, distances]), delimiter=",",
+                           header="x,y,z,image_x,image_y,distance", comments="", fmt="%.3f")
+                print(f"Saved the image points to {output_path}")
+            return image_points, distances
+
+        self.jobs.submit("Locate 3D points", locate, key="mesh", on_done=self.show_located_points)
+
+    def show_located_points(self, result):
+        image_points, distances = result
+        print(f"Located {len(image_points)} points, distance to the mesh: median {np.median(distances):.2f}, max {distances.max():.2f}")
+        self.markers = image_points
+        # Center on the points with some context around them
+        x0, y0 = image_points.min(axis=0) - 128
+        x1, y1 = image_points.max(axis=0) + 128
+        mat_affine = zoom_fit_affine(x1 - x0, y1 - y0, self.canvas.winfo_width(), self.canvas.winfo_height())
+        if mat_affine is not None:
+            self.mat_affine = affine_translate(mat_affine, *np.dot(mat_affine[:2, :2], (-x0, -y0)))
+            self.global_scale_factor = affine_scale_factor(self.mat_affine)
+        self.process_images()
+
+    def draw_markers(self):
+        """Draw the located 3D points as circles on the canvas, at most a few thousand of the visible ones."""
+        self.canvas.delete("marker")
+        if self.markers is None:
+            return
+        canvas_points = np.dot(np.column_stack([self.markers, np.ones(len(self.markers))]), self.mat_affine.T)[:, :2]
+        visible = (canvas_points >= 0).all(axis=1) & (canvas_points[:, 0] < self.canvas.winfo_width()) & (canvas_points[:, 1] < self.canvas.winfo_height())
+        for x, y in canvas_points[visible][:2000]:
+            self.canvas.create_oval(x - 5, y - 5, x + 5, y + 5, outline="cyan", width=2, tags="marker")
+
+    def clear_markers(self):
+        self.markers = None
+        self.canvas.delete("marker")
 
     def load_overlay_image(self):
         initial_dir = self.last_directory_overlay if self.last_directory_overlay else self.last_directory if self.last_directory else os.getcwd()
@@ -598,6 +4109,7 @@ class Application(tk.Frame):
             self.last_directory_overlay = file_path
             print(file_path, self.last_directory_overlay)
             self.overlay_image = Image.open(file_path).convert("L")
+            self.record_op("load_overlay", path=file_path)
             # self.overlay_image = Image.fromarray(np.uint8(np.array(Image.open(file_path)))).convert("L")
             if len(self.sub_overlays) == 0:
                 self.sub_overlays.append(self.overlay_image)
@@ -611,10 +4123,10 @@ class Application(tk.Frame):
     def create_empty_overlay_image(self):
         if not self.image_list:
             return
-        reference_image = Image.open(self.image_list[0])
-        width, height = reference_image.size
+        height, width = self.volume_source.shape()
         # Changed from RGBA to 'L' for grayscale and set initial color to black
         self.overlay_image = Image.new("L", (width, height), "black")
+        self.record_op("create_overlay")
         if len(self.sub_overlays) == 0:
             self.sub_overlays.append(self.overlay_image)
         else:
@@ -632,19 +4144,53 @@ class Application(tk.Frame):
             file_path = tk.filedialog.askopenfilename(filetypes=[('PNG files', '*.png'), ('TIF files', '*.tif')], initialdir=os.getcwd())
         if file_path:
             self.last_directory_suboverlay = file_path
-            if ".png" in file_path:
-                sub_overlay = Image.open(file_path).convert("L")
-            elif ".tif" in file_path:
-                sub_overlay = Image.fromarray(np.uint8(np.array(Image.open(file_path))//256)).convert("L")
-            else:
-                raise ValueError("File type not supported.")
-            self.sub_overlays.append(sub_overlay)
-            self.redraw_image()
-            # strip the file name from the path and save directory
-            self.sub_overlay_names.append(file_path.rsplit('/', 1)[-1])
-            if len(self.sub_overlay_names) >= len(self.sub_overlay_colors):
-                self.sub_overlay_colors.append(self.sub_overlay_colors[len(self.sub_overlay_colors)-1])
-            self.update_suboverlay_dropdown()
+            self.jobs.submit("Load sub-overlay", lambda job: load_overlay_file(file_path, progress=lambda done, total: (job.check(), job.report(done, total))),
+                             on_done=lambda sub_overlay: self.add_suboverlay(file_path, sub_overlay))
+
+    def add_suboverlay(self, file_path, sub_overlay):
+        self.record_op("load_suboverlay", path=file_path)
+        self.sub_overlays.append(sub_overlay)
+        self.overlay_watcher.watch(file_path, sub_overlay)
+        self.redraw_image()
+        # strip the file name from the path and save directory
+        self.sub_overlay_names.append(file_path.rsplit('/', 1)[-1])
+        if len(self.sub_overlay_names) >= len(self.sub_overlay_colors):
+            self.sub_overlay_colors.append(self.sub_overlay_colors[len(self.sub_overlay_colors)-1])
+        self.update_suboverlay_dropdown()
+
+    def reload_changed_suboverlays(self):
+        """Reload the sub-overlay files that were rewritten since they were loaded, e.g. by a running prediction."""
+        self.overlay_watcher.retain(self.sub_overlays)
+        if not self.watch_suboverlays_var.get():
+            return
+        for watch in self.overlay_watcher.changed():
+            # The active overlay is being edited, its file is not reloaded over the labels
+            if watch["image"] is self.sub_overlays[0]:
+                continue
+            # Still being reloaded, the watch reports the change until the reload is applied
+            if self.jobs.busy(watch["image"]):
+                continue
+            stat = watch["pending"]
+            self.jobs.submit("Reload sub-overlay", lambda job, watch=watch: reload_overlay_tiles(watch["path"], watch["image"], watch["hashes"], job=job),
+                             key=watch["image"], on_done=lambda result, watch=watch, stat=stat: self.apply_reloaded_suboverlay(watch, stat, result))
+
+    def apply_reloaded_suboverlay(self, watch, stat, result):
+        hashes, changed, replacement = result
+        watch["stat"], watch["hashes"] = stat, hashes
+        indices = [i for i, image in enumerate(self.sub_overlays) if image is watch["image"]]
+        if not indices or indices[0] == 0:
+            return
+        if replacement is not None:
+            self.sub_overlays[indices[0]] = watch["image"] = replacement
+        elif changed:
+            apply_overlay_tiles(watch["image"], changed)
+            if any(image is watch["image"] for image in self.ink_statistics.sub_overlays):
+                for x0, y0, block in changed:
+                    self.ink_statistics.mark_dirty(x0, y0, x0 + block.shape[1], y0 + block.shape[0])
+        else:
+            return
+        print(f"Reloaded {len(changed) if replacement is None else 'all'} tiles of {watch['path']}")
+        self.redraw_image()
 
     def update_suboverlay_dropdown(self):
         menu = self.select_suboverlay_optionmenu['menu']
@@ -657,6 +4203,7 @@ class Application(tk.Frame):
         selected_name = self.current_sub_overlay.get()
         try:
             selected_index = self.sub_overlay_names.index(selected_name)
+            self.record_op("select_suboverlay", index=selected_index)
 
             # Swap the 0-th element with the selected_index element
             name0, name1 = self.sub_overlay_names[selected_index], self.sub_overlay_names[0]
@@ -679,8 +4226,7 @@ class Application(tk.Frame):
             self.current_sub_overlay.set(self.sub_overlay_names[0])
 
             self.redraw_image()
-            self.toggle_color()
-            self.toggle_color()
+            self.update_brush_label()
 
         except ValueError:
             print("Selected value is not in the list.")
@@ -697,12 +4243,12 @@ class Application(tk.Frame):
             if save_path:
                 # Convert to grayscale and remove alpha channel
                 bw_image = self.overlay_image.convert("1")
-                bw_image.save(save_path)
+                self.jobs.submit("Save overlay", lambda job: bw_image.save(save_path))
 
     def save_combined_overlays(self):
         if self.pil_image:
             # Create a base image
-            combined = Image.new("L", (self.pil_image.width, self.pil_image.height), color="black")
+            combined = Image.new("L", self.engine.image_size(), color="black")
 
             # Add sub-overlays
             for sub_overlay in self.sub_overlays:
@@ -721,7 +4267,28 @@ class Application(tk.Frame):
 
             if save_path:
                 bw_combined = combined.convert("1")
-                bw_combined.save(save_path)
+                self.jobs.submit("Save combined overlays", lambda job: bw_combined.save(save_path))
+
+    def merge_annotator_overlays(self):
+        initial_dir = self.last_directory_overlay if self.last_directory_overlay else os.getcwd()
+        paths = tk.filedialog.askopenfilenames(title="Overlays of the annotators", filetypes=[('PNG files', '*.png'), ('TIF files', '*.tif')],
+                                               initialdir=initial_dir)
+        if len(paths) < 2:
+            return
+        votes = tk.simpledialog.askinteger("Merge Overlays", f"Annotators that must agree for the vote (of {len(paths)}):",
+                                           initialvalue=len(paths) // 2 + 1, minvalue=1, maxvalue=len(paths), parent=self.master)
+        if votes is None:
+            return
+        output_folder = tk.filedialog.askdirectory(title="Folder for the merged overlays", initialdir=initial_dir)
+        if not output_folder:
+            return
+
+        def show_stats(stats):
+            lines = [f"{os.path.basename(pair['a'])} / {os.path.basename(pair['b'])}: IoU {pair['iou']:.3f}" for pair in stats["pairs"]]
+            tk.messagebox.showinfo("Merge Overlays", f"Mean pairwise IoU {stats['mean_iou']:.3f}\n\n" + "\n".join(lines))
+        self.jobs.submit("Merge overlays", lambda job: merge_overlays(list(paths), output_folder, votes,
+                                                                       progress=lambda done, total: (job.check(), job.report(done, total))),
+                         on_done=show_stats)
 
     def save_displayed_image(self):
         if self.pil_image is None:
@@ -750,9 +4317,53 @@ class Application(tk.Frame):
         # The current state of the image is in self.pil_image
         # You might need to apply any additional transformations or overlays
         # that you want to be included in the saved image
-        self.pil_image.save(file_path)
+        pil_image = self.pil_image
+        self.jobs.submit("Save image", lambda job: pil_image.save(file_path))
 
 
+    def export_composite(self):
+        if self.pil_image is None:
+            tk.messagebox.showerror("Error", "No image to save.")
+            return
+        scale = tk.simpledialog.askfloat("Export Composite", "Resolution relative to the source (1 = full resolution):",
+                                         initialvalue=1.0, minvalue=0.01, maxvalue=4.0, parent=self.master)
+        if scale is None:
+            return
+        initial_dir = self.last_directory_overlay if self.last_directory_overlay else os.getcwd()
+        file_path = tk.filedialog.asksaveasfilename(defaultextension=".tif", filetypes=[("TIFF files", "*.tif")], initialdir=initial_dir)
+        if not file_path:
+            return
+        state = self.view_state()
+        self.jobs.submit("Export", lambda job: self.engine.export_tiff(state, file_path, scale, progress=lambda done, total: (job.check(), job.report(done, total))))
+
+    def export_layer_sweep(self):
+        if self.volume_source is None:
+            tk.messagebox.showerror("Error", "No image to save.")
+            return
+        layer_range = tk.simpledialog.askstring("Export Sweep", "Layers (start-end) and frames per second (start-end@fps):",
+                                                initialvalue=f"0-{len(self.image_list) - 1}@10", parent=self.master)
+        if not layer_range:
+            return
+        try:
+            layers, _, fps = layer_range.partition("@")
+            start, end = (int(value) for value in layers.split("-"))
+            fps = float(fps) if fps else 10.0
+        except ValueError:
+            tk.messagebox.showerror("Error", "Invalid layer range.")
+            return
+        start, end = max(0, start), min(len(self.image_list), end + 1)
+        if end <= start:
+            tk.messagebox.showerror("Error", "Layer index out of range.")
+            return
+        initial_dir = self.last_directory_overlay if self.last_directory_overlay else os.getcwd()
+        file_path = tk.filedialog.asksaveasfilename(defaultextension=".mp4", initialdir=initial_dir,
+                                                    filetypes=[("MP4 video", "*.mp4"), ("AVI video", "*.avi"), ("PNG sequence folder", "*")])
+        if not file_path:
+            return
+        state = self.view_state()
+        self.jobs.submit("Export sweep", lambda job: self.engine.export_layer_sweep(state, start, end, file_path, fps,
+                                                                                    progress=lambda done, total: (job.check(), job.report(done, total))))
+
     def toggle_overlay(self):
         self.redraw_image()
 
@@ -785,6 +4396,20 @@ class Application(tk.Frame):
         except ValueError:
             pass
 
+    def apply_auto_window(self, preset):
+        self.auto_window_var.set("Auto")
+        if self.volume_source is None:
+            return
+        scope, low, high = AUTO_WINDOW_PRESETS[preset]
+        window = (0.0, 65535.0) if scope is None else self.engine.auto_window(self.view_state(), scope, low, high)
+        if window is None:
+            return
+        self.min_value, self.max_value = window
+        for entry, value in ((self.min_value_entry, self.min_value), (self.max_value_entry, self.max_value)):
+            entry.delete(0, tk.END)
+            entry.insert(tk.END, f"{value:.0f}")
+        self.set_image(self.image_list[self.image_index])
+
     def set_micron_factor(self, event=None):
         self.master.focus()
         try:
@@ -799,64 +4424,172 @@ class Application(tk.Frame):
         if color and color[1]:
             self.sub_overlay_colors[0] = color[1]
 
-        self.toggle_color()
-        self.toggle_color()
+        self.update_brush_label()
         self.redraw_image()
 
-    def toggle_color(self, event=None):
-        self.pencil_color = 'white' if self.pencil_color == 'black' else 'black'
-        label_color = 'black' if self.pencil_color == 'black' else self.sub_overlay_colors[0]
+    def toggle_brush_mode(self, event=None):
+        self.brush_mode = "erase" if self.brush_mode == "paint" else "paint"
+        self.update_brush_label()
+
+    def update_brush_label(self):
+        label_color = 'black' if self.brush_mode == "erase" else self.sub_overlay_colors[0]
         self.color_label.config(background=label_color) # Update the color preview$
+        self.color_btn.config(text=self.brush_mode.capitalize())
+        if self.cursor_circle is not None:
+            self.canvas.itemconfig(self.cursor_circle, outline=self.cursor_color())
+
+    def cursor_color(self):
+        return 'white' if self.brush_mode == "paint" else 'black'
 
     def on_resample_method_changed(self, selected_method):
         self.resample_method.set(selected_method)
         self.redraw_image()
 
-    def calculate_image_range(self, radius, direction):
-        if direction == "omi":
-            start_index = max(0, self.image_index - radius)
-            end_index = min(len(self.image_list), self.image_index + radius + 1)
-        elif direction == "front":
-            start_index = self.image_index
-            end_index = min(len(self.image_list), self.image_index + radius + 1)
-        elif direction == "back":
-            start_index = max(0, self.image_index - radius)
-            end_index = self.image_index + 1
-        return start_index, end_index
-    
-    def enhance_image(self, image):
-        if self.toggle_contrast_var.get():
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(12,12))
-            image = clahe.apply(image.astype(np.uint8))
-        return image
-    
-    def process_images(self):
-        radius = int(self.radius_var.get())
-        direction = self.direction_var.get()
-        start_index, end_index = self.calculate_image_range(radius, direction)
+    def view_state(self):
+        """Snapshot of the widget state the render engine reads, taken on the Tk thread."""
+        overlay_visibility = self.overlay_visibility.get()
+        return ViewState(
+            canvas_width=self.canvas.winfo_width(),
+            canvas_height=self.canvas.winfo_height(),
+            mat_affine=self.mat_affine.copy(),
+            image_index=self.image_index,
+            radius=int(self.radius_var.get()),
+            direction=self.direction_var.get(),
+            operation=self.operation_var.get(),
+            min_value=self.min_value,
+            max_value=self.max_value,
+            contrast_enhance=self.toggle_contrast_var.get(),
+            sub_overlays=self.sub_overlays,
+            sub_overlay_colors=self.sub_overlay_colors,
+            overlay_image=self.overlay_image,
+            overlay_visibility=overlay_visibility,
+            overlay_opacity=self.overlay_opacity_scale.get() if overlay_visibility else 1.0,
+            suboverlay_opacity=self.suboverlay_opacity_scale.get() if overlay_visibility else 0.4,
+            suboverlay_brightness=self.suboverlay_brightness_scale.get() if overlay_visibility else 1.0,
+            resample_method=self.resample_method.get(),
+            render_backend=self.render_backend_var.get(),
+            micron_factor=self.micron_factor,
+            )
 
-        # Stack images as a 3D NumPy array
-        images = np.stack([self.load_image(self.image_list[i], as_np=True) for i in tqdm(range(start_index, end_index))])
-        if images.size > 0:
-            if images.size == 1:
-                result_image = images[0]
-            else:
-                operation = self.operation_var.get()
-                if operation == "max":
-                    result_image = np.max(images, axis=0)
-                elif operation == "min":
-                    result_image = np.min(images, axis=0)
-                elif operation == "mean":
-                    result_image = np.mean(images, axis=0)
-
-            if self.min_value != 0 or self.max_value != 65535:
-                result_image = (result_image - (self.min_value / 256.0)) * ( 65535.0 / (self.max_value - self.min_value))
-                result_image = np.clip(result_image, 0, 255)
-            result_image = result_image.astype(np.uint8)
-
-            result_image = self.enhance_image(result_image)
-
-            self.pil_image = Image.fromarray(result_image).convert("L")
+    def add_pane(self):
+        pane = ViewportPane(self, f"pane {len(self.panes) + 1}")
+        # Pan, zoom and draw in a pane like in the main canvas, its view is linked to it
+        pane.canvas.bind("<Button-1>", self.mouse_down_left)
+        pane.canvas.bind("<B1-Motion>", self.mouse_move_left)
+        pane.canvas.bind("<Button-3>", self.mouse_down_right)
+        pane.canvas.bind("<B3-Motion>", self.mouse_move_right)
+        if sys.platform == 'linux':
+            pane.canvas.bind("<Button-4>", self.mouse_wheel)
+            pane.canvas.bind("<Button-5>", self.mouse_wheel)
+        self.panes.append(pane)
+        # Draw once the pane has its size
+        self.master.after_idle(self.redraw_image)
+
+    def close_pane(self, pane):
+        self.panes.remove(pane)
+        pane.destroy()
+        self.master.after_idle(self.redraw_image)
+
+    def toggle_hud_key(self, event=None):
+        self.show_hud_var.set(not self.show_hud_var.get())
+        self.toggle_hud()
+
+    def update_ink_statistics(self):
+        """Refresh the dirty tiles of the ink statistics and show them in the status bar."""
+        if not self.show_ink_stats_var.get():
+            self.label_ink_stats["text"] = ""
+            return
+        overlay, sub_overlays = self.overlay_image, self.sub_overlays[1:]
+        if overlay is not self.ink_statistics.overlay or [id(image) for image in sub_overlays] != [id(image) for image in self.ink_statistics.sub_overlays]:
+            self.ink_statistics.reset(overlay, sub_overlays)
+        if overlay is None:
+            self.label_ink_stats["text"] = ""
+            return
+        self.ink_statistics.update()
+        stats = self.ink_statistics.summary(self.micron_factor)
+        parts = [f"Ink {stats['area_um2']:.4g} \u00b5m\u00b2", f"{stats['strokes']} strokes"]
+        for name, coverage, overlap in zip(self.sub_overlay_names[1:], stats["coverage"], stats["overlap"]):
+            parts.append(f"{name}: {coverage * (self.micron_factor * 1000.0) ** 2:.4g} \u00b5m\u00b2, {100.0 * overlap / coverage if coverage else 0.0:.0f}% labeled")
+        self.label_ink_stats["text"] = " | ".join(parts) + ("" if stats["complete"] else " ...")
+
+    def toggle_hud(self):
+        if not self.show_hud_var.get() and self.hud_item is not None:
+            self.canvas.delete(self.hud_item)
+            self.hud_item = None
+        self.redraw_image()
+
+    def update_hud(self):
+        """Show the last frame breakdown and cache hit rates in the top right corner of the canvas."""
+        if not self.show_hud_var.get():
+            return
+        text = "\n".join(profiler.summary_lines())
+        if self.hud_item is None or not self.canvas.type(self.hud_item):
+            self.hud_item = self.canvas.create_text(self.canvas.winfo_width() - 10, 10, anchor='ne', justify='left',
+                                                    fill='yellow', font='TkFixedFont', text=text)
+        else:
+            self.canvas.coords(self.hud_item, self.canvas.winfo_width() - 10, 10)
+            self.canvas.itemconfig(self.hud_item, text=text)
+        self.canvas.tag_raise(self.hud_item)
+
+    def toggle_trace_recording(self):
+        if self.record_trace_var.get():
+            profiler.start_recording()
+            print("Recording trace ...")
+            return
+        profiler.stop_recording()
+        file_path = tk.filedialog.asksaveasfilename(
+            defaultextension=".json",
+            initialfile="crackle_trace.json",
+            filetypes=[("Chrome trace", "*.json"), ("All files", "*.*")],
+            initialdir=os.getcwd()
+        )
+        if file_path:
+            profiler.save_trace(file_path)
+
+    def record_op(self, name, **params):
+        if self.session_recorder is not None:
+            self.session_recorder.op(name, **params)
+
+    def record_input(self, event):
+        """Label the frames drawn for this event, bound to all widgets so it runs after the event handlers."""
+        if self.session_recorder is None:
+            return
+        widget = event.widget.winfo_class() if hasattr(event.widget, "winfo_class") else "Menu"
+        if event.type == tk.EventType.KeyPress:
+            name = f"Key-{event.keysym}"
+        elif event.type == tk.EventType.MouseWheel or (event.type == tk.EventType.ButtonPress and event.num in (4, 5)):
+            name = "Wheel"
+        elif event.type == tk.EventType.ButtonPress:
+            name = f"Button-{event.num}"
+        else:
+            name = "Drag"
+        self.session_recorder.input(f"{widget}:{name}")
+
+    def toggle_session_recording(self):
+        if self.record_session_var.get():
+            self.session_recorder = SessionRecorder()
+            # Start from the volume and overlays that are open now
+            if self.volume_path:
+                self.record_op("open_volume", path=self.volume_path)
+            for i, sub_overlay in enumerate(self.sub_overlays):
+                index = self.session_recorder.overlay_snapshot(sub_overlay)
+                self.record_op("load_overlay" if i == 0 else "load_suboverlay", snapshot=index)
+            print("Recording session ...")
+            self.redraw_image()
+            return
+        recorder, self.session_recorder = self.session_recorder, None
+        file_path = tk.filedialog.asksaveasfilename(
+            defaultextension=".jsonl",
+            initialfile="crackle_session.jsonl",
+            filetypes=[("Crackle session", "*.jsonl"), ("All files", "*.*")],
+            initialdir=os.getcwd()
+        )
+        if file_path and recorder is not None:
+            recorder.save(file_path)
+
+    def process_images(self):
+        profiler.begin_frame()
+        if self.engine.process_images(self.view_state()) is not None:
             self.redraw_image()
 
     def set_image(self, filename):
@@ -867,11 +4600,14 @@ class Application(tk.Frame):
         # self.draw_image(self.pil_image)
 
         self.master.title(self.my_title + " - " + os.path.basename(filename))
-        self.label_image_info["text"] = f"{self.pil_image.format} : {self.pil_image.width} x {self.pil_image.height} {self.pil_image.mode}"
-        os.chdir(os.path.dirname(filename))
+        width, height = self.engine.image_size()
+        self.label_image_info["text"] = f"{self.pil_image.format} : {width} x {height} {self.pil_image.mode}"
+        if os.path.isdir(os.path.dirname(filename)):
+            os.chdir(os.path.dirname(filename))
 
     # Method to clear all SubOverlays
     def clear_suboverlays(self):
+        self.record_op("clear_suboverlays")
         self.sub_overlays = [self.sub_overlays[0]]
         self.sub_overlay_names = [self.sub_overlay_names[0]]
         self.redraw_image()
@@ -907,15 +4643,22 @@ class Application(tk.Frame):
             self.set_image(self.image_list[self.image_index])
 
     def generate_line(self, event):
-        draw = ImageDraw.Draw(self.overlay_image)
         old_point = tuple(self.to_image_point(self.__old_event.x, self.__old_event.y)[:2])
         new_point = tuple(self.to_image_point(event.x, event.y)[:2])
         width = self.size_scale.get()
-        draw.line([old_point, new_point], fill=self.pencil_color, width=width, joint='curve')
-        # Draw circle with radius with/2
-        draw.ellipse([old_point[0]-width/2, old_point[1]-width/2, old_point[0]+width/2, old_point[1]+width/2], fill=self.pencil_color)
-        draw.ellipse([new_point[0]-width/2, new_point[1]-width/2, new_point[0]+width/2, new_point[1]+width/2], fill=self.pencil_color)
-
+        self.record_op("paint", points=[[float(v) for v in old_point], [float(v) for v in new_point]], width=width, mode=self.brush_mode)
+        with profiler.span("brush"):
+            box = self.brush.stroke(self.overlay_image, old_point, new_point, width, self.brush_mode)
+        if box is not None and self.overlay_image is self.ink_statistics.overlay:
+            self.ink_statistics.mark_dirty(*box)
+
+    def schedule_redraw(self):
+        """Redraw once the queued events are handled, every motion event of a fast stroke is drawn but rendered once."""
+        if self.redraw_pending is None:
+            self.redraw_pending = self.master.after_idle(self.scheduled_redraw)
+
+    def scheduled_redraw(self):
+        self.redraw_pending = None
         self.redraw_image()
 
     def mouse_down_left(self, event):
@@ -943,10 +4686,11 @@ class Application(tk.Frame):
         # Check if shift is pressed and mouse is dragged to draw
         if self.shift_pressed and self.mouse_is_pressed and self.overlay_image:
             self.generate_line(event)
+            self.schedule_redraw()
         else: # Else case for dragging
             self.translate(event.x - self.__old_event.x, event.y - self.__old_event.y)
+            self.redraw_image()
 
-        self.redraw_image()
         self.__old_event = event
 
     def mouse_move_right(self, event):
@@ -956,27 +4700,31 @@ class Application(tk.Frame):
         if self.overlay_image:
             self.generate_line(event)
 
-        self.redraw_image()
+        self.schedule_redraw()
         self.__old_event = event
 
     def mouse_move(self, event):
-        # Remove the old circle if it exists
-        if self.cursor_circle:
-            self.canvas.delete(self.cursor_circle)
-        
-        # Draw the new circle
+        # Move the brush circle, it is created once and hidden while the mouse is outside
         x, y = event.x, event.y 
 
         r = (self.size_scale.get() * self.global_scale_factor)// 2  # radius of circle
-        self.cursor_circle = self.canvas.create_oval(x-r, y-r, x+r, y+r, outline=self.pencil_color)
+        if self.cursor_circle is None or not self.canvas.type(self.cursor_circle):
+            self.cursor_circle = self.canvas.create_oval(x-r, y-r, x+r, y+r, outline=self.cursor_color())
+        else:
+            self.canvas.coords(self.cursor_circle, x-r, y-r, x+r, y+r)
+            self.canvas.itemconfig(self.cursor_circle, state='normal')
 
         if (self.pil_image == None):
             return
         
         image_point = self.to_image_point(event.x, event.y)
         if image_point != []:
-            uv_point = np.array([image_point[0] / self.pil_image.width, 1.0 - image_point[1] / self.pil_image.height])
-            point_3d = find_uv_triangle(self.mesh_vertices, uv_point, self.kd_tree, self.triangle_data)
+            width, height = self.engine.image_size()
+            uv_point = np.array([image_point[0] / width, 1.0 - image_point[1] / height])
+            point_3d = None
+            if self.kd_tree is not None:
+                with profiler.span("hover_lookup"):
+                    point_3d = find_uv_triangle(self.mesh_vertices, uv_point, self.kd_tree, self.triangle_data)
             if point_3d is None:
                 point_3d = ["--", "--", "--"]
             else:
@@ -986,15 +4734,14 @@ class Application(tk.Frame):
             self.label_image_pixel["text"] = ("2D: (x: --, y: --) 3D: (x: --, y: --, z: --)")
 
     def mouse_leave_canvas(self, event):
-        if self.cursor_circle:
-            self.canvas.delete(self.cursor_circle)
-            self.cursor_circle = None
+        if self.cursor_circle is not None:
+            self.canvas.itemconfig(self.cursor_circle, state='hidden')
 
 
     def mouse_double_click_left(self, event):
         if self.pil_image == None:
             return
-        self.zoom_fit(self.pil_image.width, self.pil_image.height)
+        self.zoom_fit(*self.engine.image_size())
         self.redraw_image()
         self.reset_to_middle_image()
 
@@ -1023,28 +4770,11 @@ class Application(tk.Frame):
         self.mat_affine = np.eye(3) 
 
     def translate(self, offset_x, offset_y):
-        mat = np.eye(3)
-        mat[0, 2] = float(offset_x)
-        mat[1, 2] = float(offset_y)
-
-        self.mat_affine = np.dot(mat, self.mat_affine)
+        self.mat_affine = affine_translate(self.mat_affine, offset_x, offset_y)
 
     def scale(self, scale:float):
-        mat = np.eye(3)
-        mat[0, 0] = scale
-        mat[1, 1] = scale
-
-        self.mat_affine = np.dot(mat, self.mat_affine)
-        scale_x = (self.mat_affine[0, 0]**2 + self.mat_affine[0, 1]**2)**0.5
-        scale_y = (self.mat_affine[1, 0]**2 + self.mat_affine[1, 1]**2)**0.5
-        self.global_scale_factor = scale_x
-        # Correct small errors in the affine matrix
-        scale_y = scale_x
-        self.mat_affine[1, 1] = self.mat_affine[0, 0]
-        self.mat_affine[1, 0] = -self.mat_affine[0, 1]
-        # assert self.mat_affine[0, 0] == self.mat_affine[1, 1], f"Non-uniform scaling is not supported on affine (0,0) vs (1,1) {self.mat_affine[0, 0]} != {self.mat_affine[1, 1]}"
-        # assert self.mat_affine[0, 1] == -self.mat_affine[1, 0], f"Non-uniform scaling is not supported on affine (0,1) -(1,0) {self.mat_affine[0, 1]} != {self.mat_affine[1, 0]}"
-        # assert scale_x == scale_y, f"Non-uniform scaling is not supported on scale {scale_x} != {scale_y}"
+        self.mat_affine = affine_scale(self.mat_affine, scale)
+        self.global_scale_factor = affine_scale_factor(self.mat_affine)
 
     def scale_at(self, scale:float, cx:float, cy:float):
         self.translate(-cx, -cy)
@@ -1052,13 +4782,7 @@ class Application(tk.Frame):
         self.translate(cx, cy)
 
     def rotate(self, deg:float):
-        mat = np.eye(3) 
-        mat[0, 0] = math.cos(math.pi * deg / 180)
-        mat[1, 0] = math.sin(math.pi * deg / 180)
-        mat[0, 1] = -mat[1, 0]
-        mat[1, 1] = mat[0, 0]
-
-        self.mat_affine = np.dot(mat, self.mat_affine)
+        self.mat_affine = affine_rotate(self.mat_affine, deg)
 
     def rotate_at(self, deg:float, cx:float, cy:float):
 
@@ -1067,70 +4791,25 @@ class Application(tk.Frame):
         self.translate(cx, cy)
 
     def zoom_fit(self, image_width, image_height):
-
-        canvas_width = self.canvas.winfo_width()
-        canvas_height = self.canvas.winfo_height()
-
-        if (image_width * image_height <= 0) or (canvas_width * canvas_height <= 0):
+        mat_affine = zoom_fit_affine(image_width, image_height, self.canvas.winfo_width(), self.canvas.winfo_height())
+        if mat_affine is None:
             return
-
-        self.reset_transform()
-
-        scale = 1.0
-        offsetx = 0.0
-        offsety = 0.0
-
-        if (canvas_width * image_height) > (image_width * canvas_height):
-            scale = canvas_height / image_height
-            offsetx = (canvas_width - image_width * scale) / 2
-        else:
-            scale = canvas_width / image_width
-            offsety = (canvas_height - image_height * scale) / 2
-
-        self.scale(scale)
-        self.translate(offsetx, offsety)
+        self.mat_affine = mat_affine
+        self.global_scale_factor = affine_scale_factor(self.mat_affine)
     
     def to_image_point_unchecked(self, x, y):
-        mat_inv = np.linalg.inv(self.mat_affine)
-        image_point = np.dot(mat_inv, (x, y, 1.))
-        return image_point
+        return canvas_to_image(self.mat_affine, x, y)
     
     def to_image_point(self, x, y):
         if self.pil_image == None:
             return []
         image_point = self.to_image_point_unchecked(x, y)
-        if  image_point[0] < 0 or image_point[1] < 0 or image_point[0] > self.pil_image.width or image_point[1] > self.pil_image.height:
+        width, height = self.engine.image_size()
+        if  image_point[0] < 0 or image_point[1] < 0 or image_point[0] > width or image_point[1] > height:
             return []
 
         return image_point
     
-    def create_ruler(self, img_width, img_height, width, height, unit_size, min_unit_length=15):
-        """
-        Create a ruler image with the specified width, height, and unit size.
-        """
-        unit_size = int(unit_size)
-        unit_size = max(1, unit_size)  # Ensure unit size is at least 1
-        ruler = Image.new('RGBA', (img_width, img_height), (255, 255, 255, 0))
-        draw = ImageDraw.Draw(ruler)
-
-        unit_range = range(height, width, unit_size)
-        if len(unit_range) < min_unit_length:
-            unit_range = [i for i in range(height, height + min_unit_length*unit_size, unit_size)]
-
-        # Draw ruler lines and numbers
-        for i in unit_range:
-            line_height = height // 2 if (i - height) % (5 * unit_size) else height
-            draw.line([(i + height, 0), (i + height, line_height)], fill="white", width=1)
-            draw.text((i + height, line_height), str((i - height) // unit_size), fill="white")
-
-        # Draw ruler lines and numbers
-        for i in unit_range:
-            line_height = height // 2 if (i - height) % (5 * unit_size) else height
-            draw.line([(0, i + height), (line_height, i + height)], fill="white", width=1)
-            draw.text((line_height, i + height), str((i - height) // unit_size), fill="white")
-
-        return ruler
-    
     def update_threshold_value(self, val):
         self.ff_threshold = int(float(val))
         self.bucket_threshold_var.set(f"{self.ff_threshold}")
@@ -1141,165 +4820,131 @@ class Application(tk.Frame):
         self.max_propagation_var.set(f"{self.max_propagation_steps}")
 
     def threaded_flood_fill(self, event):
-        if self.flood_fill_active:
+        if self.overlay_image is None or self.jobs.busy(self.overlay_image):
             return
-        self.flood_fill_active = True
         click_coordinates = self.to_image_point(event.x, event.y)[:2]
-        click_coordinates[0] = int(click_coordinates[0])
-        click_coordinates[1] = int(click_coordinates[1])
-        click_coordinates = tuple(click_coordinates)
-        # Run flood_fill_3d in a separate thread
-        thread = threading.Thread(target=self.flood_fill_2d, args=(click_coordinates,))
-        thread.start()
-
-    def flood_fill_2d(self, start_coord):
-        pil_image = self.pil_image
-        queue = deque([start_coord])
-        target_color = int(pil_image.getpixel(start_coord))
-        visited = set()
-        counter = 0
-        if self.overlay_image.mode == 'RGB':
-            # Convert to a tuple of integers for RGB
-            value = (int(255), int(255), int(255))
+        if len(click_coordinates) == 0:
+            return
+        click_coordinates = (int(click_coordinates[0]), int(click_coordinates[1]))
+        if self.flood_fill_3d_var.get():
+            self.flood_fill_3d(click_coordinates)
         else:
-            value = int(255)
-        while self.flood_fill_active and queue and counter < self.max_propagation_steps:
-            cx, cy = queue.popleft()
+            self.flood_fill_2d(click_coordinates)
+
+    def apply_flood_fill(self, overlay, mask, offset=(0, 0)):
+        # Runs on the Tk thread, the workers never touch the displayed overlay
+        paint_mask(overlay, mask, offset)
+        if overlay is self.ink_statistics.overlay and mask.any():
+            rows, columns = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+            self.ink_statistics.mark_dirty(offset[0] + columns[0], offset[1] + rows[0], offset[0] + columns[-1] + 1, offset[1] + rows[-1] + 1)
+        self.redraw_image()
 
-            if (cx, cy) in visited or not (0 <= cx < pil_image.width and 0 <= cy < pil_image.height):
-                continue
+    def flood_fill_3d(self, start_coord):
+        try:
+            layers = int(self.ff_layers_var.get())
+            max_voxels = int(float(self.ff_max_voxels_var.get()))
+        except ValueError:
+            print("Invalid FF Layers or Max Voxels value.")
+            return
+        # Only the visible part of the layers is grown into, one byte per voxel for each of the volume,
+        # the visited states and the mask over the whole layer range times the visible window
+        window = self.engine.get_visible_window(self.view_state())
+        volume_source, image_index, threshold = self.volume_source, self.image_index, self.ff_threshold
+        start_index = max(0, image_index - layers)
+        end_index = min(len(self.image_list), image_index + layers + 1)
+        y0, y1, x0, x1 = window
+        fill_bytes = FLOOD_FILL_BYTES_PER_VOXEL * (end_index - start_index) * (y1 - y0) * (x1 - x0)
+        if not memory.reserve(fill_bytes, MEMORY_PRIORITY_VISIBLE):
+            print(f"3D flood fill needs {format_bytes(fill_bytes)} for {end_index - start_index} layers of the visible window, "
+                  f"more than the memory budget of {format_bytes(memory.budget)}. Zoom in or lower FF Layers.")
+            return
+        mask_folder = None
+        if self.ff_output_var.get() == "Mask Stack":
+            mask_folder = tk.filedialog.askdirectory(initialdir=self.last_directory or os.getcwd(), title="Folder for the mask layers")
+            if not mask_folder:
+                return
+        else:
+            self.record_op("flood_fill_3d", start=list(start_coord), image_index=self.image_index, layers=layers,
+                           threshold=self.ff_threshold, max_voxels=max_voxels, window=[int(v) for v in window])
+
+        def fill(job):
+            volume = volume_source.read(start_index, end_index, window)
+            seed = (image_index - start_index, start_coord[1] - y0, start_coord[0] - x0)
+            start = time.perf_counter()
+            mask = flood_fill_volume(volume, seed, threshold, max_voxels, is_active=lambda: not job.cancelled, on_progress=job.report)
+            job.check()
+            print(f"3D flood fill: {np.count_nonzero(mask)} voxels in layers {start_index}-{end_index - 1} in {time.perf_counter() - start:.2f} s")
+            if mask_folder:
+                height, width = volume_source.shape()
+                save_mask_stack(mask_folder, mask, start_index, (x0, y0), (width, height))
+                return None
+            return mask.any(axis=0)
+
+        overlay = self.overlay_image
+        self.jobs.submit("3D flood fill", fill, key=overlay,
+                         on_done=lambda mask: mask is not None and self.apply_flood_fill(overlay, mask, (x0, y0)))
 
-            visited.add((cx, cy))
+    def flood_fill_2d(self, start_coord):
+        projection = self.engine.full_resolution_projection()
+        if projection is None:
+            print("Zoom in to flood fill, the view is drawn from a coarser pyramid level.")
+            return
+        self.record_op("flood_fill", start=list(start_coord), threshold=self.ff_threshold, steps=self.max_propagation_steps)
+        overlay, (pil_image, offset) = self.overlay_image, projection
+        threshold, max_steps = self.ff_threshold, self.max_propagation_steps
+        start = (start_coord[0] - offset[0], start_coord[1] - offset[1])
 
+        def fill(job):
+            # Filled into a separate mask of the projection's window that is painted into the overlay on the Tk thread
+            mask = Image.new("L", pil_image.size, "black")
+            flood_fill_image(pil_image, mask, start, threshold, max_steps, is_active=lambda: not job.cancelled)
+            job.check()
+            return np.array(mask) > 0
 
-            pixel_value = int(pil_image.getpixel((cx,cy)))
-
-            if abs(pixel_value - target_color) <= self.ff_threshold:
-                try:
-                    self.overlay_image.putpixel((int(cx), int(cy)), value)
-                except TypeError as e:
-                    print(f"Error: {e}, Coordinates: ({cx}, {cy}), Value: {value}, Mode: {self.overlay_image.mode}")
-                counter += 1
-                for dx in [-1, 0, 1]:
-                    for dy in [-1, 0, 1]:
-                        if dx == 0 and dy == 0:
-                            continue
-                        queue.append((cx + dx, cy + dy))
-
-            if counter % 10 == 0:
-                self.redraw_image()
-
-        if self.flood_fill_active == True:
-            self.flood_fill_active = False
-            self.redraw_image()
+        self.jobs.submit("Flood fill", fill, key=overlay, on_done=lambda mask: self.apply_flood_fill(overlay, mask, offset))
 
     def draw_image(self, pil_image):
         if pil_image == None:
             return
 
         self.pil_image = pil_image
+        profiler.begin_frame()
+        state = self.view_state()
+        if not self.engine.visible_window_loaded(state):
+            # Panned or zoomed out of the part of the volume read so far
+            self.process_images()
+            return
 
-        canvas_width = self.canvas.winfo_width()
-        canvas_height = self.canvas.winfo_height()
-
-        mat_inv = np.linalg.inv(self.mat_affine)
-
-        affine_inv = (
-            mat_inv[0, 0], mat_inv[0, 1], mat_inv[0, 2],
-            mat_inv[1, 0], mat_inv[1, 1], mat_inv[1, 2]
-            )
-
-        dst = self.pil_image.transform(
-                    (canvas_width, canvas_height),
-                    Image.Transform.AFFINE,   
-                    affine_inv,   
-                    self.resampling_methods[self.resample_method.get()]
-                    )
-        
-        if dst.mode != 'RGBA':
-            dst = dst.convert('RGBA')
-
-        if self.overlay_visibility.get():
-            # Overlaying SubOverlays
-            for i, sub_overlay in enumerate(self.sub_overlays):
-                if i == 0: continue # skip overlay image
-
-                sub_overlay_transformed = sub_overlay.transform(
-                    (canvas_width, canvas_height),
-                    Image.Transform.AFFINE,
-                    affine_inv,
-                    self.resampling_methods[self.resample_method.get()]
-                )
-                
-                # Ensure the image is RGBA (has an alpha channel)
-                if sub_overlay_transformed.mode != 'RGBA':
-                    sub_overlay_transformed = sub_overlay_transformed.convert('RGBA')
-
-                r, g, b, a = sub_overlay_transformed.split()
-                grayscale = sub_overlay_transformed.convert("L")
-                # Scale the RGB values based on the brightness slider
-                grayscale = ImageEnhance.Brightness(grayscale).enhance(self.suboverlay_brightness_scale.get())
-                alpha = grayscale  # Use grayscale directly, without inverting
-                sub_overlay_color = Image.new('RGB', sub_overlay_transformed.size, self.sub_overlay_colors[i])
-                final_sub_overlay = Image.composite(sub_overlay_color, sub_overlay_transformed, grayscale)
-                final_sub_overlay.putalpha(alpha)
-
-
-                # Adjust the opacity based on the value of the slider
-                alpha = ImageEnhance.Brightness(alpha).enhance(self.suboverlay_opacity_scale.get())
-                final_sub_overlay.putalpha(alpha)
-
-                dst.paste(final_sub_overlay, (0, 0), final_sub_overlay)
-
-        # Overlaying the additional PNG
-        if self.overlay_visibility.get() and self.overlay_image:
-            overlay_transformed = self.overlay_image.transform(
-                (canvas_width, canvas_height),
-                Image.Transform.AFFINE,
-                affine_inv,
-                self.resampling_methods[self.resample_method.get()]
-            )
-            
-            # Ensure the image is RGBA (has an alpha channel)
-            if overlay_transformed.mode != 'RGBA':
-                overlay_transformed = overlay_transformed.convert('RGBA')
-
-            r, g, b, a = overlay_transformed.split()
-            grayscale = overlay_transformed.convert("L")
-            alpha = grayscale  # Use grayscale directly, without inverting
-            yellow = Image.new('RGB', overlay_transformed.size, self.sub_overlay_colors[0])
-            final_overlay = Image.composite(yellow, overlay_transformed, grayscale)
-            final_overlay.putalpha(alpha)
-
-            # Adjust the opacity based on the value of the slider
-            alpha = ImageEnhance.Brightness(alpha).enhance(self.overlay_opacity_scale.get())
-            final_overlay.putalpha(alpha)
-
-            dst.paste(final_overlay, (0, 0), final_overlay)
-
-        # Add a ruler to the bottom right of the image
-        ruler_width, ruler_height = 500, 100  # Customize as needed
-        unit_size = self.global_scale_factor * (1.0 / self.micron_factor)  # Customize the unit size for the ruler
-        image_width, image_height = dst.size
-        ruler = self.create_ruler(image_width, image_height, ruler_width, ruler_height, unit_size)
-
-        # Calculate position for the ruler (bottom right)
-        ruler_position = (0, 0)
-
-        # Paste the ruler onto the image
-        dst.paste(ruler, ruler_position, ruler)
-
-        im = ImageTk.PhotoImage(image=dst)
-
-        item = self.canvas.create_image(
-                0, 0, 
-                anchor='nw',
-                image=im  
-                )
+        with profiler.span("render_frame"):
+            # The panes render concurrently with the main view, from the same slices and caches
+            pane_frames = [self.pane_pool.submit(pane.engine.render_view, pane.view_state(state)) for pane in self.panes]
+            dst = self.engine.render_frame(state)
+            pane_frames = [frame.result() for frame in pane_frames]
+
+        with profiler.span("photoimage"):
+            for pane, frame in zip(self.panes, pane_frames):
+                pane.show(frame)
+            im = ImageTk.PhotoImage(image=dst)
+
+            # Reuse one canvas item instead of stacking a new one per frame
+            if self.canvas_image_item is None or not self.canvas.type(self.canvas_image_item):
+                self.canvas_image_item = self.canvas.create_image(
+                        0, 0, 
+                        anchor='nw',
+                        image=im  
+                        )
+                self.canvas.tag_lower(self.canvas_image_item)
+            else:
+                self.canvas.itemconfig(self.canvas_image_item, image=im)
 
         self.image = im
         # Update the layer index display
         self.layer_index_var.set(str(self.image_index))
+        profiler.end_frame()
+        self.draw_markers()
+        self.update_hud()
+        if self.session_recorder is not None:
+            self.session_recorder.frame(state, profiler.last_frame_seconds)
 
     def redraw_image(self):
         if self.pil_image == None:
@@ -1308,6 +4953,9 @@ class Application(tk.Frame):
 
 
 if __name__ == "__main__":
+    import multiprocessing
+    # The spawned layer sweep workers of the PyInstaller builds start here
+    multiprocessing.freeze_support()
     root = tk.Tk()
     app = Application(master=root)
     app.mainloop()